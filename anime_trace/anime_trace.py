@@ -1,16 +1,27 @@
+import asyncio
 import io
 import mimetypes
 import re
-from time import gmtime
-from time import strftime
-from typing import Tuple, Any, Type
+import sqlite3
+import time
+from contextlib import asynccontextmanager, suppress
+from contextvars import ContextVar
+from dataclasses import replace
+from hashlib import sha256
+from typing import Tuple, Any, Type, AsyncIterator, Awaitable, Callable
+from urllib.parse import urlsplit
+from uuid import uuid4
 
-from aiohttp import ClientError
+from aiohttp import ClientError, ClientResponseError
 from PIL import Image, UnidentifiedImageError
-from mautrix.errors import MatrixResponseError
+from mautrix.errors import DecryptionError, MatrixRequestError, MatrixResponseError, MNotFound
 from mautrix.types import (
+    EncryptedEvent,
+    EventType,
     MessageType,
+    PaginationDirection,
     EventID,
+    RoomID,
     ContentURI,
     TextMessageEventContent,
     MediaMessageEventContent,
@@ -19,11 +30,49 @@ from mautrix.types import (
     VideoInfo,
     ThumbnailInfo
 )
+from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command
+from maubot.handlers import command, event
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-from .resources.datastructures import MessageData
+from .resources.anilist import AnilistIndex
+from .resources.backend import Endpoint, LatencyBackend, PriorityBackend, SearchBackend
+from .resources.blurhash import BLURHASH_KEY, blurhash_available, encode_blurhash
+from .resources.cache import ResultCache, TTLCache
+from .resources.datastructures import (
+    BackfillCheckpoint,
+    MessageData,
+    QuotaInfo,
+    QuotaState,
+    SearchResponse,
+    TraceResult
+)
+from .resources.db import AnsweredStore, BackfillStore, ResultStore, upgrade_table
+from .resources.executor import CPUPool, PoolFullError
+from .resources.fair_queue import FairQueue, RoomBudgets
+from .resources.fetch import FetchStrategySelector, LOCAL, REMOTE
+from .resources.hedge import HedgePolicy
+from .resources.load import BUSY, FEWER_RESULTS, FULL, NO_PREVIEW, LoadMonitor
+from .resources.media_cache import MediaDiskCache
+from .resources.media_info import image_dimensions, video_info
+from .resources.preview import PreviewSizer, PreviewStream
+from .resources.renderer import (
+    render_batch,
+    render_history_entry,
+    render_history_summary,
+    render_results
+)
+from .resources.shared import SharedBackend, LocalBackend, SQLiteBackend
+from .resources.urls import canonicalize_url
+
+# Room and sender of the command that is being handled, they take turns in the search queue
+requester: ContextVar[Tuple[str, str] | None] = ContextVar("requester", default=None)
+# AniList ID the searches of the command that is being handled are limited to
+search_filter: ContextVar[int | None] = ContextVar("search_filter", default=None)
 
 
 class Config(BaseProxyConfig):
@@ -33,12 +82,70 @@ class Config(BaseProxyConfig):
         helper.copy("mute")
         helper.copy("cut_borders")
         helper.copy("max_results")
+        helper.copy("cache_size")
+        helper.copy("cache_ttl")
+        helper.copy("db_cache_size")
+        helper.copy("cache_warm_start")
+        helper.copy("shared_backend")
+        helper.copy("quota_ttl")
+        helper.copy("default_concurrency")
+        helper.copy("event_cache_size")
+        helper.copy("answered_size")
+        helper.copy("answered_ttl")
+        helper.copy("media_cache_dir")
+        helper.copy("media_cache_size")
+        helper.copy("validation_cache_size")
+        helper.copy("validation_cache_ttl")
+        helper.copy("speculative_search")
+        helper.copy("fetch_strategy")
+        helper.copy("pixiv_proxy")
+        helper.copy("downscale")
+        helper.copy("cpu_workers")
+        helper.copy("cpu_queue_size")
+        helper.copy("batch_size")
+        helper.copy("batch_parallelism")
+        helper.copy("batch_reply")
+        helper.copy("adaptive_preview")
+        helper.copy("preview_budget")
+        helper.copy("hedge_budget")
+        helper.copy("thumbnail_format")
+        helper.copy("thumbnail_size")
+        helper.copy("blurhash")
+        helper.copy("shed_commands")
+        helper.copy("shed_memory")
+        helper.copy("shed_quota")
+        helper.copy("shed_max_results")
+        helper.copy("room_weights")
+        helper.copy("room_requests")
+        helper.copy("room_megabytes")
+        helper.copy("room_window")
+        helper.copy("anilist_index")
+        helper.copy("anime_lookup_size")
+        helper.copy("anime_lookup_ttl")
+        helper.copy("endpoints")
+        helper.copy("search_routing")
+        helper.copy("admins")
+        helper.copy("history_output")
+        helper.copy("history_quota_reserve")
+        helper.copy("history_interval")
 
 
 class AnimeTraceBot(Plugin):
     size_limit = 25000000  # 25 MB
-    api_url = "https://api.trace.moe/search?anilistInfo"
-    api_me = "https://api.trace.moe/me"
+    api_url = "https://api.trace.moe"
+    search_params = "anilistInfo"
+    lock_ttl = 60
+    lock_timeout = 30
+    event_cache_ttl = 86400
+    # A misspelled title or one missing from the index for now is looked up again soon
+    unknown_anime_ttl = 60
+    host_failure_ttl = 60
+    trusted_host_checks = 5
+    trusted_host_ttl = 86400
+    downscale_size = 1280
+    chunk_size = 65536
+    history_page_size = 100
+    history_summary_size = 50
     headers = {
         "User-Agent": "AnimeTraceBot/1.2.6"
     }
@@ -46,10 +153,113 @@ class AnimeTraceBot(Plugin):
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
+        self.anilist_index = self._create_anilist_index()
+        # Lowercase title -> AniList ID, or None if the title is unknown
+        self.anime_lookup = TTLCache(
+            self._get_int_config("anime_lookup_size", 1000, 0),
+            self._get_int_config("anime_lookup_ttl", 86400, 0)
+        )
+        # With the index the titles are filled in locally, and the search responses are smaller
+        params = [] if self.anilist_index else ["anilistInfo"]
         if self._get_cut_borders():
-            self.api_url += "&cutBorders"
+            params.append("cutBorders")
+        self.search_params = "&".join(params)
+        self.search_backend = self._create_search_backend()
         if self.config.get("api_key", ""):
             self.headers["x-trace-key"] = self.config["api_key"]
+        self.shared = self._create_shared_backend()
+        # Locks, slots and the quota fall back to this instance's state when the shared one fails
+        self.local_state = self.shared if isinstance(self.shared, LocalBackend) else LocalBackend()
+        self.event_cache = TTLCache(
+            self._get_int_config("event_cache_size", 1000, 0),
+            self.event_cache_ttl
+        )
+        self.result_cache = ResultCache(
+            max_size=self._get_int_config("cache_size", 256, 0),
+            ttl=self._get_int_config("cache_ttl", 86400, 1),
+            store=ResultStore(self.database) if self.database else None,
+            store_size=self._get_int_config("db_cache_size", 10000, 0),
+            shared=None if isinstance(self.shared, LocalBackend) else self.shared,
+            log=self.log
+        )
+        loaded = await self.result_cache.warm_up(self._get_int_config("cache_warm_start", 100, 0))
+        if loaded:
+            self.log.debug(f"Loaded {loaded} cached results from database")
+        self.quota = QuotaState()
+        await self._get_quota_state()
+        self.answered = TTLCache(
+            self._get_int_config("answered_size", 1000, 0),
+            self._get_int_config("answered_ttl", 604800, 0)
+        )
+        self.answered_store = AnsweredStore(self.database) if self.database else None
+        self.media_cache = self._create_media_cache()
+        self.backfill_store = BackfillStore(self.database) if self.database else None
+        # Checkpoints of room history traces when there is no database
+        self.backfill_checkpoints: dict[RoomID, BackfillCheckpoint] = {}
+        self.backfill_jobs: dict[RoomID, asyncio.Task] = {}
+        self.validation_cache = TTLCache(
+            self._get_int_config("validation_cache_size", 1000, 0),
+            self._get_int_config("validation_cache_ttl", 300, 0)
+        )
+        self.speculative_search = self._get_speculative_search()
+        # Host -> number of its links in a row that passed validation
+        self.trusted_hosts = TTLCache(
+            self._get_int_config("validation_cache_size", 1000, 0),
+            self.trusted_host_ttl
+        )
+        self.fetch_strategy = self._get_fetch_strategy()
+        self.downscale = self._get_downscale()
+        self.fetch_selector = FetchStrategySelector(
+            self._get_int_config("validation_cache_size", 1000, 0),
+            self.trusted_host_ttl
+        )
+        self.cpu_pool = CPUPool(
+            self._get_int_config("cpu_workers", 2, 1),
+            self._get_int_config("cpu_queue_size", 16, 0)
+        )
+        self.load = LoadMonitor()
+        self.preview_sizer = PreviewSizer()
+        # Videos take much longer than thumbnails, each kind keeps its own response times
+        hedge_ratio = self._get_int_config("hedge_budget", 10, 0) / 100
+        self.hedge_policies = {kind: HedgePolicy(hedge_ratio) for kind in ("image", "video")}
+        if self._get_blurhash() and not blurhash_available():
+            self.log.warning("Blurhash is enabled, but NumPy isn't installed")
+        self.fair_queue = FairQueue(self._get_api_concurrency(), self._get_room_weights())
+        self.room_budgets = RoomBudgets(
+            self._get_int_config("room_requests", 0, 0),
+            self._get_int_config("room_megabytes", 0, 0) * 1024 * 1024,
+            self._get_int_config("room_window", 3600, 1)
+        )
+        if self.answered_store:
+            try:
+                await self.answered_store.delete_expired(int(time.time()))
+            except Exception as e:
+                self.log.error(f"Cleaning up answered events failed: {e}")
+
+    async def stop(self) -> None:
+        await self._stop_backfill_jobs()
+        self.log.debug(f"CPU pool: {self.cpu_pool.stats()}")
+        self.log.debug(f"Commands by degradation level: {self.load.shed}")
+        for kind, policy in self.hedge_policies.items():
+            self.log.debug(
+                f"Preview requests ({kind}): {policy.requests}, hedged: {policy.hedged}, "
+                f"won by the hedged request: {policy.hedge_wins}"
+            )
+        self.cpu_pool.shutdown()
+        await self.shared.close()
+        if self.anilist_index:
+            self.anilist_index.close()
+        await super().stop()
+
+    async def _stop_backfill_jobs(self) -> None:
+        """
+        Cancel the room history traces and wait until they saved their checkpoints
+        and sent their status messages
+        """
+        jobs = list(self.backfill_jobs.values())
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
 
     @command.new(
         name="trace",
@@ -58,7 +268,12 @@ class AnimeTraceBot(Plugin):
         arg_fallthrough=False,
         msgtypes=[MessageType.TEXT, MessageType.IMAGE, MessageType.VIDEO]
     )
-    @command.argument("query", pass_raw=True, required=False, matches=r"(https?://\S+)")
+    @command.argument(
+        "query",
+        pass_raw=True,
+        required=False,
+        matches=r"((?:(?:--anime\s+(?:\"[^\"]+\"|\S+)|(?:https?://|\$)\S+)\s*)+)"
+    )
     async def trace(self, evt: MessageEvent, query: Tuple[str, Any]) -> None:
         await evt.mark_read()
 
@@ -71,104 +286,739 @@ class AnimeTraceBot(Plugin):
                 "`!trace`  \n"
                 "> In a message that contains a link to a screenshot: `!trace <link>`  \n"
                 "> In a message that contains a screenshot as an attachment: `!trace`  \n"
+                "> To trace several screenshots at once: `!trace <link or event ID> ...`, "
+                "or reply to a message with several links or a gallery  \n"
+                "> To search only one anime, add `--anime <AniList ID or title>`  \n"
                 "> To check the search quota and limit: `!trace quota`"
             )
             await evt.reply(help_msg)
             return
 
-        media_ext_url, media_url, content_type = await self._extract_media_url(evt, event_id, query)
-
-        if media_ext_url:
-            try:
-                await self._validate_external_url(media_ext_url)
-                trace_json = await self._trace_by_external_url(media_ext_url)
-            except ValueError as e:
-                await evt.reply(f"> File validation failed - {e}")
-                return
-            except ClientError as e:
-                await evt.reply(f"> {e}")
+        anime = None
+        if query and query[0]:
+            text, anime = self._split_anime_option(query[0])
+            query = (text,)
+        anilist_id = None
+        if anime:
+            anilist_id = await self._resolve_anime(anime)
+            if anilist_id is None:
+                await evt.reply(f"> Couldn't find anime \"{anime}\" in the AniList index.")
                 return
-        elif media_url:
-            try:
-                data = await self._get_matrix_media(media_url)
-                trace_json = await self._trace_by_media(data, content_type)
-            except ClientError as e:
-                await evt.reply(f"> {e}")
-                return
-        else:
+
+        items = await self._extract_media_items(evt, event_id, query)
+        if not items:
             await evt.reply("> No media found for analysis.")
             return
-        msg_data = await self._prepare_message_content(trace_json)
+        # A stale quota is refreshed, so that the bot recovers on its own after the quota reset
+        await self._get_quota_state()
+        # When busy, commands still get earlier answers and cached results, which need no search
+        level = self._get_load_level()
+        token = requester.set((evt.room_id, evt.sender))
+        filter_token = search_filter.set(anilist_id)
+        try:
+            with self.load.command(len(items)):
+                if len(items) > 1:
+                    await self._trace_batch(evt, items, level)
+                    return
+                media_ext_url, media_url, content_type = items[0]
+                await self._trace_media(
+                    evt,
+                    event_id or media_url or media_ext_url,
+                    media_ext_url,
+                    media_url,
+                    content_type,
+                    level
+                )
+        finally:
+            search_filter.reset(filter_token)
+            requester.reset(token)
+
+    @staticmethod
+    def _split_anime_option(text: str) -> Tuple[str, str | None]:
+        """
+        Take the --anime option out of the command arguments
+        :param text: command arguments
+        :return: the other arguments, and the value of the option without quotes
+        """
+        match = re.search(r"--anime\s+(?:\"([^\"]+)\"|(\S+))", text)
+        if not match:
+            return text, None
+        return text[:match.start()] + text[match.end():], match.group(1) or match.group(2)
+
+    async def _resolve_anime(self, anime: str) -> int | None:
+        """
+        Get the AniList ID of an anime given by its ID or title.
+        Titles are looked up in the AniList index.
+        :param anime: AniList ID or title
+        :return: AniList ID, None if the title is unknown
+        """
+        if anime.isdigit():
+            return int(anime)
+        key = anime.strip().lower()
+        if key in self.anime_lookup:
+            return self.anime_lookup.get(key)
+        if not self.anilist_index:
+            return None
+        try:
+            anilist_id = await self.anilist_index.find(anime)
+        except sqlite3.Error as e:
+            self.log.error(f"Reading AniList index failed: {e}")
+            return None
+        self.anime_lookup.set(
+            key,
+            anilist_id,
+            None if anilist_id else min(self.unknown_anime_ttl, self.anime_lookup.ttl)
+        )
+        return anilist_id
+
+    def _get_search_url(self, endpoint: Endpoint | None = None) -> str:
+        """
+        Get the search URL, limited to one anime if the command asked for it
+        :param endpoint: endpoint, the public API if None
+        :return: search URL
+        """
+        url = endpoint.search_url if endpoint else f"{self.api_url}/search"
+        params = [self.search_params] if self.search_params else []
+        anilist_id = search_filter.get()
+        if anilist_id is not None:
+            params.append(f"anilistID={anilist_id}")
+        return f"{url}?{'&'.join(params)}" if params else url
+
+    async def _trace_media(
+        self,
+        evt: MessageEvent,
+        source: str,
+        media_ext_url: str,
+        media_url: str,
+        content_type: str,
+        level: int = FULL
+    ) -> None:
+        """
+        Trace one media and reply with the result and its preview
+        :param evt: user's message
+        :param source: ID of the replied-to event or URL of the media
+        :param media_ext_url: external image URL
+        :param media_url: matrix content URL
+        :param content_type: content type of matrix media
+        :param level: degradation level of the reply
+        """
+        # Replies to scoped searches are kept apart from the ones to full searches
+        if search_filter.get() is not None:
+            source = f"{source}#anilistID={search_filter.get()}"
+        reply_id = await self._get_answer(evt.room_id, source)
+        if reply_id:
+            await evt.reply(f"> Already traced: https://matrix.to/#/{evt.room_id}/{reply_id}")
+            return
+
+        try:
+            trace_response = await self._search(
+                media_ext_url,
+                media_url,
+                content_type,
+                cached_only=level == BUSY
+            )
+        except ValueError as e:
+            await evt.reply(f"> File validation failed - {e}")
+            return
+        except ClientError as e:
+            await evt.reply(f"> {e}")
+            return
+        msg_data = self._prepare_message_content(trace_response, level)
         message = await self._prepare_message(msg_data)
         if message:
-            await evt.reply(message)
+            reply_id = await evt.reply(message)
+            await self._remember_answer(evt.room_id, source, reply_id)
         else:
             await evt.reply("> Couldn't find an anime based on the provided screenshot/video.")
 
-    async def _extract_media_url(
+    async def _trace_batch(
+        self,
+        evt: MessageEvent,
+        items: list[Tuple[str, str, str]],
+        level: int = FULL
+    ) -> None:
+        """
+        Trace several media concurrently, and reply either once with the best match
+        of each, or with a separate message for each of them
+        :param evt: user's message
+        :param items: external image URLs, matrix content URLs and content types
+        :param level: degradation level of the replies
+        """
+        batch_size = self._get_int_config("batch_size", 10, 1)
+        skipped = max(0, len(items) - batch_size)
+        items = items[:batch_size]
+        semaphore = asyncio.Semaphore(self._get_int_config("batch_parallelism", 3, 1))
+
+        if self._get_batch_reply() == "separate":
+            if skipped:
+                await evt.reply(
+                    f"> Tracing the first {batch_size} media, {skipped} more left out."
+                )
+
+            async def trace_item(item: Tuple[str, str, str]) -> None:
+                async with semaphore:
+                    await self._trace_media(evt, item[1] or item[0], *item, level)
+
+            await asyncio.gather(*(trace_item(item) for item in items))
+            return
+
+        async def search_item(item: Tuple[str, str, str]) -> TraceResult | str:
+            async with semaphore:
+                try:
+                    response = await self._search(*item, cached_only=level == BUSY)
+                except ValueError as e:
+                    return f"File validation failed - {e}"
+                except ClientError as e:
+                    return str(e)
+            if response.error:
+                self.log.error(response.error)
+            if not response.results:
+                return "Couldn't find an anime based on the provided screenshot/video."
+            return response.results[0]
+
+        entries = await asyncio.gather(*(search_item(item) for item in items))
+        html, body = render_batch(entries, skipped)
+        await evt.reply(
+            TextMessageEventContent(
+                msgtype=MessageType.NOTICE,
+                format=Format.HTML,
+                body=body,
+                formatted_body=html
+            )
+        )
+
+    async def _get_answer(self, room_id: RoomID, source: str) -> EventID | None:
+        """
+        Find the reply of the bot to media that was already traced in the room
+        :param room_id: room ID
+        :param source: ID of the replied-to event or URL of the media
+        :return: event ID of the reply
+        """
+        reply_id = self.answered.get((room_id, source))
+        if reply_id or not self.answered_store:
+            return reply_id
+        try:
+            reply_id = await self.answered_store.get(room_id, source, int(time.time()))
+        except Exception as e:
+            self.log.error(f"Reading answered events from database failed: {e}")
+            return None
+        if reply_id:
+            self.answered.set((room_id, source), EventID(reply_id))
+        return reply_id
+
+    async def _remember_answer(self, room_id: RoomID, source: str, reply_id: EventID) -> None:
+        """
+        Remember the reply of the bot to traced media
+        :param room_id: room ID
+        :param source: ID of the replied-to event or URL of the media
+        :param reply_id: event ID of the reply
+        """
+        self.answered.set((room_id, source), reply_id)
+        if not self.answered_store:
+            return
+        try:
+            await self.answered_store.put(
+                room_id,
+                source,
+                reply_id,
+                int(time.time()) + int(self.answered.ttl)
+            )
+        except Exception as e:
+            self.log.error(f"Writing answered event to database failed: {e}")
+
+    async def _extract_media_items(
         self,
         evt: MessageEvent,
         event_id: EventID,
         query: Tuple[str, Any]
-    ) -> Tuple[str, str, str]:
+    ) -> list[Tuple[str, str, str]]:
         """
-        Extracts the image from matrix message
+        Extracts all media the user requested to analyze: the ones in the message user
+        replied to, in the events whose IDs are listed in the command and the links in it
         :param evt: user's message
         :param event_id: ID of the message user replied to
         :param query: user's message content
-        :return: external image URL if user requested to analyze a link, and two empty strings;
-        empty string, matrix content URL and content type of matrix URL if user requested
-        to analyze an attachment
+        :return: external image URLs, matrix content URLs and content types of matrix URLs
         """
-        media_external_url = ""
-        media_url = ""
-        content_type = ""
+        tokens = query[0].split() if query and query[0] else []
+        items = []
         # User requested to analyze the content of the message
         # with the ID obtained in the previous step
         if event_id:
+            items += await self._get_event_media(evt.room_id, event_id)
+        # User requested to analyze the content of their own message
+        elif evt.content.msgtype != MessageType.TEXT:
+            items.append(("", evt.content.url, evt.content.info.mimetype))
+        for token in tokens:
+            if token.startswith("$"):
+                try:
+                    items += await self._get_event_media(evt.room_id, EventID(token))
+                except (MatrixRequestError, MatrixResponseError) as e:
+                    self.log.error(f"Getting event {token} failed: {e}")
+            else:
+                items.append((canonicalize_url(token, self._get_pixiv_proxy()), "", ""))
+        # The same media may be listed more than once
+        return list(dict.fromkeys(items))
+
+    async def _get_event_media(
+        self,
+        room_id: RoomID,
+        event_id: EventID
+    ) -> list[Tuple[str, str, str]]:
+        """
+        Get the media of a message, from the cache if the bot saw it before
+        :param room_id: room ID
+        :param event_id: message ID
+        :return: external image URLs, matrix content URLs and content types of matrix URLs
+        """
+        key = (room_id, event_id)
+        sources = self.event_cache.get(key)
+        if sources is None:
             # Get message for analysis
-            message: MessageEvent = await self.client.get_event(
-                room_id=evt.room_id,
-                event_id=event_id
+            message: MessageEvent = await self.client.get_event(room_id=room_id, event_id=event_id)
+            sources = self._get_media_sources(message)
+            self.event_cache.set(key, sources)
+        return sources
+
+    def _get_media_sources(self, message: MessageEvent) -> list[Tuple[str, str, str]]:
+        """
+        Get the media a message points to
+        :param message: matrix message
+        :return: external image URLs, matrix content URLs and content types of matrix URLs
+        """
+        content = message.content
+        if content.msgtype == MessageType.TEXT:
+            links = re.findall(r"(https?://\S+)", content.body or "", re.I)
+            pixiv_proxy = self._get_pixiv_proxy()
+            return list(dict.fromkeys(
+                (canonicalize_url(link, pixiv_proxy), "", "") for link in links
+            ))
+        if "itemtypes" in content:
+            # Gallery message (MSC4274), a list of media items
+            sources = []
+            items = content["itemtypes"]
+            for item in items if isinstance(items, list) else ():
+                if not isinstance(item, dict) or item.get("itemtype") not in ("m.image", "m.video"):
+                    continue
+                if item.get("url"):
+                    info = item.get("info") or {}
+                    sources.append(("", item["url"], info.get("mimetype", "")))
+            return sources
+        if not content.url or not content.info:
+            return []
+        return [("", content.url, content.info.mimetype)]
+
+    @event.on(EventType.ROOM_MESSAGE)
+    async def remember_media(self, evt: MessageEvent) -> None:
+        """
+        Remember the media of messages the bot sees, so that replies to them
+        can be traced without fetching the event from the homeserver
+        :param evt: matrix message
+        """
+        msgtype = evt.content.msgtype
+        if msgtype == MessageType.TEXT:
+            if "http" not in (evt.content.body or ""):
+                return
+        elif msgtype not in (MessageType.IMAGE, MessageType.VIDEO):
+            if "itemtypes" not in evt.content:
+                return
+        sources = self._get_media_sources(evt)
+        if sources:
+            self.event_cache.set((evt.room_id, evt.event_id), sources)
+
+    async def _search(
+        self,
+        media_ext_url: str,
+        media_url: str,
+        content_type: str,
+        cached_only: bool = False
+    ) -> SearchResponse:
+        """
+        Search for the media, using cached results when possible
+        :param media_ext_url: external image URL
+        :param media_url: matrix content URL
+        :param content_type: content type of matrix media
+        :param cached_only: whether to only look up cached results, when the bot is busy
+        :return: decoded API response
+        :raises ValueError: if the external file failed validation
+        :raises ClientError: if download or request to API failed, or there is no cached result
+         when only cached results are looked up
+        """
+        key = self._get_cache_key(media_ext_url or media_url)
+        response = await self.result_cache.get(key) or self._get_failed_search(key)
+        if response:
+            return response
+        if cached_only:
+            raise ClientError(self._get_busy_message())
+
+        # Single flight: only one request (of any bot instance) searches for the same media,
+        # the others wait for the lock and take its result from the cache
+        owner = uuid4().hex
+        lock_backend = self.shared
+        try:
+            locked = await lock_backend.lock(key, owner, self.lock_ttl, self.lock_timeout)
+        except sqlite3.Error as e:
+            self.log.warning(f"Taking a shared lock failed, using local state: {e}")
+            lock_backend = self.local_state
+            locked = await lock_backend.lock(key, owner, self.lock_ttl, self.lock_timeout)
+        try:
+            if locked:
+                response = await self.result_cache.get(key) or self._get_failed_search(key)
+                if response:
+                    return response
+
+            if media_ext_url:
+                try:
+                    response = await self._search_external_url(media_ext_url)
+                except ClientError as e:
+                    self._remember_failed_search(e, key)
+                    raise
+                await self.result_cache.put(key, response)
+                self._remember_failed_search(response, key)
+                return response
+
+            # The same file may have been uploaded before under a different content URL
+            data = await self._get_matrix_media(media_url)
+            digest_key = self._get_cache_key(await self._get_media_digest(data))
+            response = (
+                await self.result_cache.get(digest_key) or self._get_failed_search(digest_key)
             )
-            if message.content.msgtype == MessageType.TEXT:
-                media_external_url = re.search(r"(https?://\S+)", message.content.body, re.I)
-                media_external_url = media_external_url.group(1) if media_external_url else ""
+            if not response:
+                try:
+                    with self.load.hold(len(data)):
+                        async with self._api_slot(len(data)):
+                            response = await self._trace_by_media(data, content_type)
+                except ClientError as e:
+                    self._remember_failed_search(e, key, digest_key)
+                    raise
+                await self.result_cache.put(digest_key, response)
+            await self.result_cache.put(key, response)
+            self._remember_failed_search(response, key, digest_key)
+            return response
+        finally:
+            if locked:
+                await self._release_shared(lock_backend.unlock, key, owner)
+
+    async def _search_external_url(self, media_url: str) -> SearchResponse:
+        """
+        Search for an external URL, either by letting trace.moe fetch it or by downloading
+        and uploading it. In auto mode the faster and more reliable way is chosen per host,
+        and a link trace.moe couldn't fetch is downloaded instead.
+        :param media_url: external image URL
+        :return: decoded API response
+        :raises ValueError: if the file validation failed
+        :raises ClientError: if download or request to API failed
+        """
+        host = urlsplit(media_url).hostname
+        strategy = self.fetch_strategy
+        if strategy == "auto":
+            strategy = self.fetch_selector.choose(host)
+        try:
+            return await self._search_external_url_with(media_url, host, strategy)
+        except ClientError as e:
+            # Outages and limits of the API would fail the upload too
+            if self.fetch_strategy != "auto" or strategy != REMOTE \
+                    or not self._is_rejection(e.__cause__):
+                raise
+        return await self._search_external_url_with(media_url, host, LOCAL)
+
+    async def _search_external_url_with(
+        self,
+        media_url: str,
+        host: str,
+        strategy: str
+    ) -> SearchResponse:
+        """
+        Search for an external URL and record how long it took and whether it failed
+        :param media_url: external image URL
+        :param host: host of the URL
+        :param strategy: REMOTE or LOCAL
+        :return: decoded API response
+        """
+        start = time.monotonic()
+        downloaded = False
+        try:
+            if strategy == LOCAL:
+                data, content_type = await self._download_external_media(media_url)
+                downloaded = True
+                response = await self._search_downloaded_media(data, content_type)
             else:
-                media_url = message.content.url
-                content_type = message.content.info.mimetype
-        # User requested to analyze the content of their own message
-        else:
-            if evt.content.msgtype == MessageType.TEXT:
-                if query:
-                    media_external_url = query[0]
+                response = await self._search_remote_url(media_url, host)
+        except ClientError as e:
+            # Only failures to fetch the link count against the host,
+            # not outages and limits of the API
+            if strategy == LOCAL:
+                failed = not downloaded
             else:
-                media_url = evt.content.url
-                content_type = evt.content.info.mimetype
-        return media_external_url, media_url, content_type
+                failed = self._is_rejection(e.__cause__)
+            if failed:
+                self.fetch_selector.record(host, strategy, time.monotonic() - start, True)
+            raise
+        self.fetch_selector.record(host, strategy, time.monotonic() - start, bool(response.error))
+        return response
+
+    async def _search_downloaded_media(self, data: bytes, content_type: str) -> SearchResponse:
+        """
+        Upload downloaded external media to the API, downscaled if enabled
+        :param data: media data
+        :param content_type: content type of the media
+        :return: decoded API response
+        """
+        if self.downscale:
+            try:
+                data, content_type = await self.cpu_pool.run(
+                    self._downscale_image,
+                    data,
+                    content_type
+                )
+            except PoolFullError as e:
+                self.log.warning(f"Uploading image without downscaling: {e}")
+        with self.load.hold(len(data)):
+            async with self._api_slot(len(data)):
+                return await self._trace_by_media(data, content_type)
+
+    async def _search_remote_url(self, media_url: str, host: str) -> SearchResponse:
+        """
+        Validate the external URL and let the API fetch it. In speculative mode the validation
+        and the search run at the same time, and the validation is skipped for hosts
+        whose links repeatedly passed it.
+        :param media_url: external image URL
+        :param host: host of the URL
+        :return: decoded API response
+        """
+        if not self.speculative_search:
+            await self._validate_external_url(media_url)
+            return await self._trace_external_url_in_slot(media_url)
+
+        if self.trusted_hosts.get(host, 0) >= self.trusted_host_checks:
+            try:
+                response = await self._trace_external_url_in_slot(media_url)
+            except ClientError as e:
+                # trace.moe couldn't use the link, check the links of this host again
+                if isinstance(e.__cause__, ClientResponseError):
+                    self.trusted_hosts.pop(host)
+                raise
+            if response.error:
+                self.trusted_hosts.pop(host)
+            return response
+
+        search = asyncio.create_task(self._trace_external_url_in_slot(media_url))
+        try:
+            await self._validate_external_url(media_url)
+        except BaseException:
+            search.cancel()
+            with suppress(asyncio.CancelledError, ClientError, ValueError):
+                await search
+            raise
+        return await search
+
+    async def _trace_external_url_in_slot(self, media_url: str) -> SearchResponse:
+        async with self._api_slot():
+            return await self._trace_by_external_url(media_url)
+
+    @asynccontextmanager
+    async def _api_slot(self, size: int = 0) -> AsyncIterator[None]:
+        """
+        Keep the searches of a room within its budget, and let rooms and their senders
+        take fair turns in the search queue. Cached results never get here.
+        :param size: bytes of media uploaded by the search
+        :raises ClientError: if the room used up its budget
+        """
+        request = requester.get()
+        if request is None:
+            yield
+            return
+        room_id, sender = request
+        wait = self.room_budgets.reserve(room_id, size)
+        reserved = time.monotonic()
+        if wait:
+            raise ClientError(
+                f"This room used up its search budget, try again in {int(wait // 60) + 1} min."
+            )
+        self.fair_queue.concurrency = self._get_search_concurrency()
+        started = False
+        try:
+            async with self.fair_queue.slot(room_id, sender):
+                started = True
+                yield
+        finally:
+            if not started:
+                # The search never got its turn
+                self.room_budgets.release(room_id, size, reserved)
+
+    def _get_search_concurrency(self) -> int:
+        """
+        Get the number of searches that can run at the same time on all endpoints
+        :return: number of searches, at least 1
+        """
+        api_concurrency = self._get_api_concurrency()
+        concurrency = api_concurrency
+        for endpoint in self.search_backend.endpoints[1:]:
+            # Replicas without a limit are assumed to take as many searches as the API key
+            concurrency += endpoint.concurrency or api_concurrency
+        return concurrency
+
+    def _get_api_concurrency(self) -> int:
+        """
+        Get the number of searches the API key may run at the same time. Until the limit
+        is loaded from the API, the configured default is used.
+        :return: number of searches, at least 1
+        """
+        return self.quota.concurrency or self._get_int_config("default_concurrency", 1, 1)
+
+    @asynccontextmanager
+    async def _endpoint_slot(self, endpoint: Endpoint, wait: bool) -> AsyncIterator[None]:
+        """
+        Keep the searches sent to an endpoint within its concurrency limit. The primary
+        endpoint follows the limit and quota of its API key, shared by all bot instances.
+        :param endpoint: endpoint
+        :param wait: whether to wait for a free slot, otherwise a busy endpoint is skipped
+        :raises ClientError: if no slot was freed in time or the quota is exhausted
+        """
+        if endpoint is self.search_backend.primary:
+            async with self._api_key_slot(wait):
+                yield
+            return
+        deadline = time.monotonic() + (self.lock_timeout if wait else 0)
+        while endpoint.concurrency and endpoint.active >= endpoint.concurrency:
+            if time.monotonic() >= deadline:
+                raise ClientError(f"{endpoint.url} is busy, try again later.")
+            await asyncio.sleep(self.shared.poll_interval)
+        endpoint.active += 1
+        try:
+            yield
+        finally:
+            endpoint.active -= 1
+
+    @asynccontextmanager
+    async def _api_key_slot(self, wait: bool = True) -> AsyncIterator[None]:
+        """
+        Keep the searches of all bot instances within the concurrency limit and quota of the API key
+        :param wait: whether to wait for a free slot
+        :raises ClientError: if no slot was freed in time or the quota is exhausted
+        """
+        owner = uuid4().hex
+        concurrency = self._get_api_concurrency()
+        timeout = self.lock_timeout if wait else 0
+        slot_backend = self.shared
+        try:
+            acquired = await slot_backend.acquire_slot(owner, concurrency, self.lock_ttl, timeout)
+        except sqlite3.Error as e:
+            self.log.warning(f"Taking a shared slot failed, using local state: {e}")
+            slot_backend = self.local_state
+            acquired = await slot_backend.acquire_slot(owner, concurrency, self.lock_ttl, timeout)
+        if not acquired:
+            if wait:
+                self.log.error("Timed out waiting for a free trace.moe API slot")
+            raise ClientError("trace.moe API is busy, try again later.")
+        try:
+            # The shared quota bucket is synced with the API whenever the quota gets stale
+            await self._get_quota_state()
+            try:
+                available = await self.shared.take_quota()
+            except sqlite3.Error as e:
+                self.log.warning(f"Taking shared quota failed, using local state: {e}")
+                available = await self.local_state.take_quota()
+            if not available:
+                self.log.error("trace.moe search quota exhausted")
+                raise ClientError("trace.moe search quota exhausted.")
+            yield
+        finally:
+            await self._release_shared(slot_backend.release_slot, owner)
+
+    async def _release_shared(self, release: Callable[..., Awaitable[None]], *args: str) -> None:
+        """
+        Release a lock or a slot. If the shared backend fails, it expires on its own.
+        :param release: release method of the backend
+        :param args: arguments of the method
+        """
+        try:
+            await release(*args)
+        except sqlite3.Error as e:
+            self.log.warning(f"Releasing in the shared backend failed: {e}")
+
+    def _get_failed_search(self, key: str) -> SearchResponse | None:
+        """
+        Get a recent search that found nothing or was rejected by the API
+        :param key: cache key
+        :return: search response without results
+        :raises ClientError: if the API recently rejected the media
+        """
+        failure = self.validation_cache.get(("search", key))
+        if isinstance(failure, str):
+            raise ClientError(failure)
+        return failure
+
+    def _remember_failed_search(self, outcome: SearchResponse | ClientError, *keys: str) -> None:
+        """
+        Remember for a short time that a search found nothing or was rejected by the API.
+        Only rejections of the media itself are remembered, not connection problems or limits.
+        :param outcome: search response or error
+        :param keys: cache keys of the media
+        """
+        if isinstance(outcome, SearchResponse):
+            if outcome.error or not outcome.results:
+                for key in keys:
+                    self.validation_cache.set(("search", key), outcome)
+            return
+        if self._is_rejection(outcome.__cause__):
+            for key in keys:
+                self.validation_cache.set(("search", key), str(outcome))
+
+    @staticmethod
+    def _is_rejection(error: BaseException | None) -> bool:
+        """
+        Check whether an error response rejected the media itself, e.g. because it couldn't
+        be fetched or decoded, rather than reporting an outage or a used up quota
+        :param error: error
+        :return: True if the media was rejected
+        """
+        return isinstance(error, ClientResponseError) and 400 <= error.status < 500 \
+            and error.status not in (402, 429)
+
+    def _get_cache_key(self, source: str) -> str:
+        """
+        Build the result cache key. Search options are part of the key,
+        because they change the results. The endpoint isn't, all of them
+        return the same results.
+        :param source: media URL or digest of media file
+        :return: cache key
+        """
+        return sha256(f"{self._get_search_url()}\n{source}".encode()).hexdigest()
+
+    async def _get_media_digest(self, data: bytes) -> str:
+        """
+        Hash a media file in the CPU pool, large files would block the event loop
+        :param data: media data
+        :return: hex digest of the file
+        """
+        try:
+            return await self.cpu_pool.run(self._hash_media, data)
+        except PoolFullError as e:
+            self.log.warning(f"Hashing media in the event loop: {e}")
+            return self._hash_media(data)
 
-    async def _trace_by_external_url(self, media_url: str) -> Any:
+    @staticmethod
+    def _hash_media(data: bytes) -> str:
+        """
+        Compute the SHA-256 hex digest of a media file
+        :param data: media data
+        :return: hex digest
+        """
+        return sha256(data).hexdigest()
+
+    async def _trace_by_external_url(self, media_url: str) -> SearchResponse:
         """
         Query the API with external image URL
         :param media_url: external image URL
-        :return: API response
+        :return: decoded API response
         """
         # Send request as a link
         params = {
             "url": media_url
         }
-        try:
-            response = await self.http.get(
-                self.api_url,
-                headers=self.headers,
-                params=params,
-                raise_for_status=True
-            )
-            response_json = await response.json()
-            return response_json
-        except ClientError as e:
-            self.log.error(f"Connection to trace.moe API failed: {e}")
-            raise ClientError("Connection to trace.moe API failed.") from e
+        response = await self._request_search(params=params)
+        return await self._decode_search_response(response)
 
     async def _validate_external_url(self, media_url: str) -> None:
         """
@@ -177,27 +1027,118 @@ class AnimeTraceBot(Plugin):
         :raises Exception: if the size of an image is too big or content type
          is not of image or video types
         """
+        if self._check_validation_cache(media_url):
+            return
+        host = urlsplit(media_url).hostname
+
         # Check the headers for size and type
         headers = {"User-Agent": "WhatsApp/2"}
         try:
             res = await self.http.head(media_url, headers=headers, raise_for_status=True)
             content_type = res.content_type if res.content_type is not None else "unknown"
             content_length = res.content_length if res.content_length is not None else 0
-        except ClientError as e:
+        except (ClientError, asyncio.TimeoutError) as e:
             self.log.error(f"Connection failed during checks of image from external URL: {e}")
+            # An error status concerns only this link, anything else the whole host
+            if not isinstance(e, ClientResponseError):
+                self.validation_cache.set(("host", host), True, ttl=self.host_failure_ttl)
+            self.trusted_hosts.pop(host)
             raise ClientError(f"Connection to {media_url} failed.") from e
 
-        # Verify if content conforms trace.moe requirements
+        error = self._check_external_media(content_type, content_length)
+        self.validation_cache.set(("url", media_url), error)
+        if error:
+            self.trusted_hosts.pop(host)
+            raise ValueError(error)
+        self.trusted_hosts.set(host, self.trusted_hosts.get(host, 0) + 1)
+
+    def _check_validation_cache(self, media_url: str) -> bool:
+        """
+        Decide about links that were checked recently, or whose host is down, without a request
+        :param media_url: external image URL
+        :return: True if the link passed the check recently
+        :raises ValueError: if the link was rejected recently
+        :raises ClientError: if the host of the link is down
+        """
+        outcome = self.validation_cache.get(("url", media_url))
+        if outcome is not None:
+            if outcome:
+                raise ValueError(outcome)
+            return True
+        if ("host", urlsplit(media_url).hostname) in self.validation_cache:
+            raise ClientError(f"Connection to {media_url} failed.")
+        return False
+
+    def _check_external_media(self, content_type: str, content_length: int) -> str:
+        """
+        Verify if content conforms trace.moe requirements
+        :param content_type: content type of the file
+        :param content_length: size of the file in bytes
+        :return: error message, empty if the file is supported
+        """
         if not content_type.startswith(("image/", "video/")):
             self.log.error(f"External file type not supported: {content_type}")
-            raise ValueError(f"External file type not supported: {content_type}")
+            return f"External file type not supported: {content_type}"
         if content_length > self.size_limit:
             formatted_length = f"{content_length:,}".replace(",", " ")
             formatted_limit = f"{self.size_limit:,}".replace(",", " ")
             self.log.error(f"External image size too big: {formatted_length}")
-            raise ValueError(
-                f"External image size too big: {formatted_length} bytes (max {formatted_limit})"
-            )
+            return f"External image size too big: {formatted_length} bytes (max {formatted_limit})"
+        return ""
+
+    async def _download_external_media(self, media_url: str) -> tuple[bytes, str]:
+        """
+        Download media from an external URL. The size is checked while reading,
+        so files whose size isn't known up front are never read past the limit.
+        :param media_url: external image URL
+        :return: media file and its content type
+        :raises ValueError: if the file is too big or isn't an image or video
+        :raises ClientError: if download failed
+        """
+        self._check_validation_cache(media_url)
+        headers = {"User-Agent": "WhatsApp/2"}
+        data = bytearray()
+        try:
+            async with self.http.get(media_url, headers=headers, raise_for_status=True) as res:
+                content_type = res.content_type if res.content_type is not None else "unknown"
+                error = self._check_external_media(content_type, res.content_length or 0)
+                if not error:
+                    async for chunk in res.content.iter_chunked(self.chunk_size):
+                        data += chunk
+                        if len(data) > self.size_limit:
+                            error = self._check_external_media(content_type, len(data))
+                            break
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.log.error(f"Download of image from external URL failed: {e}")
+            if not isinstance(e, ClientResponseError):
+                host = urlsplit(media_url).hostname
+                self.validation_cache.set(("host", host), True, ttl=self.host_failure_ttl)
+            raise ClientError(f"Connection to {media_url} failed.") from e
+        self.validation_cache.set(("url", media_url), error)
+        if error:
+            raise ValueError(error)
+        return bytes(data), content_type
+
+    def _downscale_image(self, data: bytes, content_type: str) -> tuple[bytes, str]:
+        """
+        Shrink a big still image before uploading it. Videos and animations are kept as they are.
+        :param data: media file
+        :param content_type: content type of the file
+        :return: media file and its content type
+        """
+        if not content_type.startswith("image/"):
+            return data, content_type
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if getattr(image, "n_frames", 1) > 1 or max(image.size) <= self.downscale_size:
+                    return data, content_type
+                image.thumbnail((self.downscale_size, self.downscale_size))
+                output = io.BytesIO()
+                image.convert("RGB").save(output, format="JPEG", quality=90)
+        except (UnidentifiedImageError, OSError, ValueError) as e:
+            self.log.warning(f"Downscaling image failed: {e}")
+            return data, content_type
+        return output.getvalue(), "image/jpeg"
 
     async def _get_matrix_media(self, media_url: str) -> bytes:
         """
@@ -206,106 +1147,184 @@ class AnimeTraceBot(Plugin):
         :return: media file
         :raises Exception: if download failed
         """
+        if self.media_cache:
+            try:
+                data = await self.media_cache.get(media_url)
+            except OSError as e:
+                self.log.error(f"Reading media from disk cache failed: {e}")
+                data = None
+            if data is not None:
+                return data
         try:
-            return await self.client.download_media(ContentURI(media_url))
+            data = await self.client.download_media(ContentURI(media_url))
         except (ValueError, ClientError) as e:
             self.log.error(f"Media download from Matrix server failed: {e}")
             raise ClientError("Media download from Matrix server failed.") from e
+        if self.media_cache:
+            try:
+                await self.media_cache.put(media_url, data)
+            except OSError as e:
+                self.log.error(f"Writing media to disk cache failed: {e}")
+        return data
 
-    async def _trace_by_media(self, data: bytes, content_type: str) -> str:
+    async def _trace_by_media(self, data: bytes, content_type: str) -> SearchResponse:
         """
         Query the API with internal matrix image URL
         :param data: image data
         :param content_type: image type
-        :return: API response
+        :return: decoded API response
         :raises Exception: if request to API failed
         """
         # Send media file to trace.moe
-        headers = self.headers.copy()
-        headers["Content-Type"] = content_type
-        try:
-            response = await self.http.post(
-                self.api_url,
-                data=data,
+        response = await self._request_search(data=data, content_type=content_type)
+        return await self._decode_search_response(response)
+
+    async def _request_search(
+        self,
+        params: dict[str, str] | None = None,
+        data: bytes | None = None,
+        content_type: str = ""
+    ) -> Any:
+        """
+        Send a search to the endpoint chosen by the search backend, and fail over
+        to the next one if it can't be reached, is overloaded or its quota is exhausted.
+        Busy endpoints are skipped, only the last one is waited for.
+        :param params: query parameters of a search by URL
+        :param data: media file of a search by upload
+        :param content_type: content type of the media file
+        :return: API response
+        :raises ClientError: if the media was rejected or no endpoint answered
+        """
+        error = None
+        slot_error = None
+        endpoints = self.search_backend.route()
+        for endpoint in endpoints:
+            start = None
+            try:
+                async with self._endpoint_slot(endpoint, endpoint is endpoints[-1]):
+                    start = time.monotonic()
+                    response = await self._send_search(endpoint, params, data, content_type)
+            except ClientError as e:
+                if start is None:
+                    # The endpoint wasn't tried, its slots or quota are used up
+                    error = slot_error = e
+                    continue
+                self.log.error(f"Connection to trace.moe API failed: {e}")
+                error = e
+                # Other endpoints would reject the media too
+                rejected = self._is_rejection(e)
+                self.search_backend.record(endpoint, time.monotonic() - start, not rejected)
+                if rejected:
+                    break
+                continue
+            self.search_backend.record(endpoint, time.monotonic() - start, False)
+            # Quota and limits are followed for the API key of the primary endpoint
+            if endpoint is self.search_backend.primary:
+                self.quota.update_from_headers(response.headers)
+            return response
+        if error is slot_error:
+            raise error
+        raise ClientError("Connection to trace.moe API failed.") from error
+
+    async def _send_search(
+        self,
+        endpoint: Endpoint,
+        params: dict[str, str] | None,
+        data: bytes | None,
+        content_type: str
+    ) -> Any:
+        """
+        Send a search to an endpoint
+        :param endpoint: endpoint
+        :param params: query parameters of a search by URL
+        :param data: media file of a search by upload
+        :param content_type: content type of the media file
+        :return: API response
+        :raises ClientError: if the request failed
+        """
+        headers = self._get_endpoint_headers(endpoint)
+        if data is None:
+            return await self.http.get(
+                self._get_search_url(endpoint),
                 headers=headers,
+                params=params,
                 raise_for_status=True
             )
-            response_json = await response.json()
-            return response_json
-        except ClientError as e:
-            self.log.error(f"Connection to trace.moe API failed: {e}")
-            raise ClientError("Connection to trace.moe API failed.") from e
+        headers["Content-Type"] = content_type
+        return await self.http.post(
+            self._get_search_url(endpoint),
+            data=data,
+            headers=headers,
+            raise_for_status=True
+        )
+
+    def _get_endpoint_headers(self, endpoint: Endpoint) -> dict[str, str]:
+        headers = {"User-Agent": self.headers["User-Agent"]}
+        if endpoint.api_key:
+            headers["x-trace-key"] = endpoint.api_key
+        return headers
+
+    async def _decode_search_response(self, response: Any) -> SearchResponse:
+        """
+        Decode and validate the search response
+        :param response: API response
+        :return: decoded API response
+        :raises ClientError: if the response is malformed
+        """
+        try:
+            data = SearchResponse.from_json(await response.json(loads=json_loads))
+        except (ValueError, ClientError) as e:
+            self.log.error(f"Invalid response from trace.moe API: {e}")
+            raise ClientError("Invalid response from trace.moe API.") from e
+        return await self._fill_anilist_info(data)
+
+    async def _fill_anilist_info(self, data: SearchResponse) -> SearchResponse:
+        """
+        Fill in the AniList metadata of a bare search response from the AniList index
+        :param data: decoded API response
+        :return: search response with titles
+        """
+        ids = [result.anilist.id for result in data.results if not result.anilist.title_romaji]
+        if not self.anilist_index or not ids:
+            return data
+        try:
+            infos = await self.anilist_index.get_many(ids)
+        except sqlite3.Error as e:
+            self.log.error(f"Reading AniList index failed: {e}")
+            infos = {}
+        missing = sorted(set(ids) - infos.keys())
+        if missing:
+            self.log.warning(f"Anime missing from AniList index: {missing}")
+        results = []
+        for result in data.results:
+            info = infos.get(result.anilist.id)
+            if info is None and not result.anilist.title_romaji:
+                info = replace(result.anilist, title_romaji=f"AniList {result.anilist.id}")
+            results.append(replace(result, anilist=info) if info else result)
+        return replace(data, results=tuple(results))
 
-    async def _prepare_message_content(self, data: Any) -> MessageData:
+    def _prepare_message_content(self, data: SearchResponse, level: int = FULL) -> MessageData:
         """
         Prepare the message content
-        :param data: JSON API response
+        :param data: decoded API response
+        :param level: degradation level, under load the video preview is left out
+         and fewer results are shown
         :return: message data to be embedded in the final message
         """
         body = ""
         html = ""
         video_url = ""
         image_url = ""
-        if data["error"]:
-            self.log.error(f"{data["error"]}")
-        elif len(data["result"]) > 0:
-            result = data["result"][0]
-            video_url = result["video"]
-            image_url = result["image"]
-            html += "<blockquote>"
-
-            # Titles
-            html += await self._get_titles(
-                result["anilist"]["title"]["romaji"],
-                result["anilist"]["title"]["english"],
-                result["anilist"]["id"]
-            )
-            body += await self._get_titles(
-                result["anilist"]["title"]["romaji"],
-                result["anilist"]["title"]["english"],
-                result["anilist"]["id"],
-                False
-            )
-
-            # AniList, MyAnimeList links
-            html += await self._get_al_mal_links(
-                result["anilist"]["id"],
-                result["anilist"]["idMal"]
-            )
-            body += await self._get_al_mal_links(
-                result["anilist"]["id"],
-                result["anilist"]["idMal"],
-                False
-            )
-
-            # Alternative titles
-            html += await self._get_alternative_titles(result["anilist"]["synonyms"])
-            body += await self._get_alternative_titles(result["anilist"]["synonyms"], False)
-
-            # Similarity, filename, episode, time
-            html += await self._get_match_data(result)
-            body += await self._get_match_data(result, False)
-
-            # Other results
+        if data.error:
+            self.log.error(data.error)
+        elif len(data.results) > 0:
             max_results = self._get_max_results()
-            if len(data["result"]) > 1 and max_results > 1:
-                html += (
-                    "<p><details>"
-                    "<summary><b>Other results:</b></summary>"
-                )
-                body += "> **Other results:**  \n"
-                end = min(max_results, len(data["result"]))
-                for i in range(1, end):
-                    html += await self._get_other_result(data["result"][i], i)
-                    body += await self._get_other_result(data["result"][i], i, False)
-                html += "</details></p>"
-
-            # Footer
-            html += (
-                "<p><b><sub>Results from trace.moe</sub></b></p>"
-                "</blockquote>"
-            )
-            body += "> **Results from trace.moe**"
+            if level >= FEWER_RESULTS:
+                max_results = min(max_results, self._get_int_config("shed_max_results", 1, 1))
+            html, body = render_results(data.results, max_results)
+            if level < NO_PREVIEW:
+                video_url = data.results[0].video
+                image_url = data.results[0].image
 
         return MessageData(
             html=html,
@@ -314,187 +1333,6 @@ class AnimeTraceBot(Plugin):
             image_url=image_url
         )
 
-    async def _get_link(self, url: str, text: str, is_html: bool = True) -> str:
-        """
-        Return a link as HTML or Markdown
-        :param url: address
-        :param text: displayed text
-        :param is_html: True for HTML, False for Markdown
-        :return: formatted link
-        """
-        # HTML
-        if is_html:
-            return f"<a href=\"{url}\">{text}</a>"
-
-        # Markdown
-        return f"[{text}]({url})"
-
-    async def _get_titles(
-        self,
-        title_ro: str,
-        title_en: str,
-        al_id: int,
-        is_html: bool = True
-    ) -> str:
-        """
-        Get title section of formatted message
-        :param title_ro: Romaji title
-        :param title_en: English title
-        :param al_id: Anilist ID
-        :param is_html: True for HTML, False for Markdown
-        :return: Formatted title section
-        """
-
-        url = f"https://anilist.co/anime/{al_id}"
-        result = ""
-
-        # HTML
-        if is_html:
-            result += f"{await self._get_link(url, f"<h3>{title_ro}</h3>")}"
-            if title_en:
-                result += f"<blockquote><b>English title:</b> {title_en}</blockquote>"
-            return result
-
-        # Markdown
-        result = f"> ### {await self._get_link(url, title_ro, False)}  \n>  \n"
-        if title_en:
-            result += f"> > **English title:** {title_en}  \n>  \n"
-        return result
-
-    async def _get_al_mal_links(self, al_id: int, mal_id: int, is_html: bool = True) -> str:
-        """
-        Return links section of formatted message
-        :param al_id: AniList ID
-        :param mal_id: MyAnimeList ID
-        :param is_html: True for HTML, False for Markdown
-        :return: Links section
-        """
-        if not mal_id:
-            return ""
-
-        al_url = f"https://anilist.co/anime/{al_id}"
-        mal_url = f"https://myanimelist.net/anime/{mal_id}"
-        result = ""
-
-        # HTML
-        if is_html:
-            result += (
-                "<blockquote>"
-                f"{await self._get_link(al_url, "AniList")}, "
-                f"{await self._get_link(mal_url, "MyAnimeList")}"
-                "</blockquote>"
-            )
-            return result
-
-        # Markdown
-        result += (
-            f"> > {await self._get_link(al_url, "AniList", False)}, "
-            f"{await self._get_link(mal_url, "MyAnimeList", False)}"
-            "  \n>  \n"
-        )
-        return result
-
-    async def _get_alternative_titles(self, synonyms: list[str], is_html: bool = True) -> str:
-        """
-        Get alternative titles
-        :param synonyms: list of synonyms
-        :param is_html: True for HTML, False for Markdown
-        :return: formatted alternative titles
-        """
-        if not synonyms:
-            return ""
-
-        # HTML
-        if is_html:
-            return (
-                "<blockquote>"
-                f"<b>Alternative titles:</b> {", ".join(synonyms)}"
-                "</blockquote>"
-            )
-
-        # Markdown
-        return f"> > **Alternative titles:** {", ".join(synonyms)}  \n>  \n"
-
-    async def _get_match_data(self, data: Any, is_html: bool = True) -> str:
-        """
-        Get medatada of the main result
-        :param data: raw data
-        :param is_html: True for HTML, False for Markdown
-        :return: Formatted metadata for the main result
-        """
-        result = ""
-        episode = data["episode"] if data["episode"] else "-"
-        tfrom = strftime("%H:%M:%S", gmtime(data["from"]))
-        tto = strftime("%H:%M:%S", gmtime(data["to"]))
-
-        # HTML
-        if is_html:
-            result += (
-                f"<blockquote><b>Similarity:</b> {(data["similarity"] * 100):.2f}%</blockquote>"
-                f"<blockquote><b>Filename:</b> {data["filename"]}</blockquote>"
-                f"<blockquote><b>Episode:</b> {episode}</blockquote>"
-                f"<blockquote><b>Time:</b> {tfrom} - {tto}</blockquote>"
-            )
-            return result
-
-        # Markdown
-        result += (
-            f"> > **Similarity:** {(data["similarity"] * 100):.2f}%  \n>  \n"
-            f"> > **Filename:** {data["filename"]}  \n>  \n"
-            f"> > **Episode:** {episode}  \n>  \n"
-            f"> > **Time:** {tfrom} - {tto}  \n>  \n"
-        )
-        return result
-
-    async def _get_other_result(self, data: Any, number: int, is_html: bool = True) -> str:
-        """
-        Get data for other results
-        :param data: raw data
-        :param number: number of the result
-        :param is_html: True for HTML, False for Markdown
-        :return: Formatted data for the given result
-        """
-        result = ""
-        tfrom = strftime("%H:%M:%S", gmtime(data["from"]))
-        tto = strftime("%H:%M:%S", gmtime(data["to"]))
-        al_url = f"https://anilist.co/anime/{data["anilist"]["id"]}"
-        mal_url = ""
-        if data["anilist"]["idMal"]:
-            mal_url = f"https://myanimelist.net/anime/{data["anilist"]["idMal"]}"
-        title_en = data["anilist"]["title"]["english"]
-        title_ro = data["anilist"]["title"]["romaji"]
-        title = title_en if title_en else title_ro
-
-        # HTML
-        if is_html:
-            result += (
-                "<blockquote>"
-                f"{number}. {await self._get_link(al_url, title)}"
-            )
-            if mal_url:
-                result += f" ({await self._get_link(mal_url, "MAL")})"
-            result += (
-                f" <b>S:</b> {(data["similarity"] * 100):.2f}%,"
-                f"{(" <b>Ep:</b> " + str(data["episode"]) + ",") if data["episode"] else ""}"
-                f" <b>T:</b> {tfrom} - {tto}"
-                "</blockquote>"
-            )
-            return result
-
-        # Markdown
-        result += (
-            f"> > {number}."
-            f" {await self._get_link(al_url, title, False)}"
-        )
-        if mal_url:
-            result += f" ({await self._get_link(mal_url, "MAL", False)})"
-        result += (
-            f" **S:** {(data["similarity"] * 100):.2f}%,"
-            f"{(" **Ep:** " + str(data["episode"]) + ",") if data["episode"] else ""}"
-            f" **T:** {tfrom} - {tto}  \n>  \n"
-        )
-        return result
-
     async def _prepare_message(self, msg_data: MessageData) -> MessageEventContent | None:
         """
         Prepares the final message for the user
@@ -507,56 +1345,99 @@ class AnimeTraceBot(Plugin):
         video_type = None
         video_duration = 0
         image_type = None
+        streamed = False
         # Download preview data
         if msg_data.video_url:
-            video, video_type, video_duration = await self._get_video_preview(msg_data.video_url)
-            image, image_type = await self._get_preview_thumbnail(msg_data.image_url)
+            size = self._choose_preview_size()
+            start = time.monotonic()
+            image, image_type = await self._get_preview_thumbnail(msg_data.image_url, size)
+            elapsed = time.monotonic() - start
+            if image:
+                original = image
+                # The thumbnail is processed before the video is requested, so that the video
+                # response doesn't wait unread. It is a frame of the video in its original size,
+                # the video gets its dimensions if they can't be read from the video itself.
+                with self.load.hold(len(original)):
+                    width, height = await self._probe_image_dimensions(original)
+                    image, image_type, thumbnail_hash = await self._optimize_thumbnail(
+                        original,
+                        image_type
+                    )
+                    image_width, image_height = width, height
+                    if image is not original:
+                        image_width, image_height = await self._probe_image_dimensions(image)
+                start = time.monotonic()
+                video, video_type, video_duration = await self._get_video_preview(
+                    msg_data.video_url,
+                    size
+                )
+                elapsed += time.monotonic() - start
+            if video and image:
+                # A streamed video is downloaded while it's uploaded
+                streamed = isinstance(video, PreviewStream)
+                downloaded = len(original) if streamed else len(video) + len(original)
+                self.preview_sizer.record_transfer(downloaded, elapsed)
+                self.preview_sizer.record_preview(size, len(video) + len(original))
 
         # Prepare message content
         if video and image:
-            width, height = await self.loop.run_in_executor(
-                None,
-                self._get_image_dimensions,
-                image
-            )
-            try:
-                video_extension = mimetypes.guess_extension(video_type)
-                image_extension = mimetypes.guess_extension(image_type)
-                video_uri = await self.client.upload_media(
-                    data=video,
-                    mime_type=video_type,
-                    filename=f"anime-preview{video_extension}",
-                    size=len(video))
-                image_uri = await self.client.upload_media(
-                    data=image,
-                    mime_type=image_type,
-                    filename=f"anime-preview-thumbnail{image_extension}",
-                    size=len(image))
-                content = MediaMessageEventContent(
-                    format=Format.HTML,
-                    formatted_body=msg_data.html,
-                    url=video_uri,
-                    body=msg_data.body,
-                    filename=f"anime-preview{video_extension}",
-                    msgtype=MessageType.VIDEO,
-                    external_url=msg_data.video_url,
-                    info=VideoInfo(
-                        mimetype=video_type,
-                        size=len(video),
-                        duration=video_duration,
-                        height=height,
-                        width=width,
-                        thumbnail_url=image_uri,
-                        thumbnail_info=ThumbnailInfo(
-                            mimetype=image_type,
-                            size=len(image),
+            held = len(image) if streamed else len(video) + len(image)
+            with self.load.hold(held):
+                try:
+                    start = time.monotonic()
+                    video_extension = mimetypes.guess_extension(video_type)
+                    image_extension = mimetypes.guess_extension(image_type)
+                    video_uri = await self.client.upload_media(
+                        data=video.iter_chunks() if streamed else video,
+                        mime_type=video_type,
+                        filename=f"anime-preview{video_extension}",
+                        size=len(video))
+                    image_uri = await self.client.upload_media(
+                        data=image,
+                        mime_type=image_type,
+                        filename=f"anime-preview-thumbnail{image_extension}",
+                        size=len(image))
+                    # A streamed video went through both the download and the upload
+                    self.preview_sizer.record_transfer(
+                        (2 if streamed else 1) * len(video) + len(image),
+                        time.monotonic() - start
+                    )
+                    info = video_info(video.head if streamed else video)
+                    if info:
+                        width, height, duration = info
+                        video_duration = duration or video_duration
+                    content = MediaMessageEventContent(
+                        format=Format.HTML,
+                        formatted_body=msg_data.html,
+                        url=video_uri,
+                        body=msg_data.body,
+                        filename=f"anime-preview{video_extension}",
+                        msgtype=MessageType.VIDEO,
+                        external_url=msg_data.video_url,
+                        info=VideoInfo(
+                            mimetype=video_type,
+                            size=len(video),
+                            duration=video_duration,
                             height=height,
-                            width=width
+                            width=width,
+                            thumbnail_url=image_uri,
+                            thumbnail_info=ThumbnailInfo(
+                                mimetype=image_type,
+                                size=len(image),
+                                height=image_height,
+                                width=image_width
+                            )
                         )
                     )
-                )
-            except (ValueError, MatrixResponseError) as e:
-                self.log.error(f"Error uploading video preview to Matrix server: {e}")
+                    if thumbnail_hash:
+                        # The thumbnail is a frame of the video, its blurhash fits both
+                        content.info[BLURHASH_KEY] = thumbnail_hash
+                        content.info.thumbnail_info[BLURHASH_KEY] = thumbnail_hash
+                except (ValueError, MatrixResponseError, ClientError) as e:
+                    self.log.error(f"Error uploading video preview to Matrix server: {e}")
+                finally:
+                    if streamed:
+                        video.close()
         if not content and msg_data.html:
             content = TextMessageEventContent(
                 msgtype=MessageType.NOTICE,
@@ -566,50 +1447,127 @@ class AnimeTraceBot(Plugin):
             )
         return content
 
-    async def _get_video_preview(self, url: str) -> Tuple[bytes, str, int]:
+    async def _probe_image_dimensions(self, image: bytes) -> Tuple[int, int]:
+        """
+        Get the dimensions of a preview image. Headers are read in place,
+        Pillow is used only for images they can't describe.
+        :param image: image data
+        :return: width and height
+        """
+        dimensions = image_dimensions(image)
+        if dimensions is None:
+            try:
+                dimensions = await self.cpu_pool.run(self._get_image_dimensions, image)
+            except PoolFullError as e:
+                self.log.warning(f"Using default preview dimensions: {e}")
+                dimensions = 640, 360
+        return dimensions
+
+    async def _optimize_thumbnail(
+        self,
+        image: bytes,
+        image_type: str
+    ) -> Tuple[bytes, str, str | None]:
+        """
+        Re-encode the preview thumbnail and compute its blurhash in the CPU pool, if enabled
+        :param image: thumbnail
+        :param image_type: type of the thumbnail
+        :return: thumbnail, its type and blurhash, or None if it wasn't computed
         """
-        Download video preview
+        image_format = self._get_thumbnail_format()
+        with_blurhash = self._get_blurhash() and blurhash_available()
+        if not image_format and not with_blurhash:
+            return image, image_type, None
+        try:
+            return await self.cpu_pool.run(
+                self._process_thumbnail,
+                image,
+                image_type,
+                image_format,
+                self._get_int_config("thumbnail_size", 320, 16),
+                with_blurhash
+            )
+        except PoolFullError as e:
+            self.log.warning(f"Sending thumbnail as it is: {e}")
+            return image, image_type, None
+
+    def _process_thumbnail(
+        self,
+        image: bytes,
+        image_type: str,
+        image_format: str,
+        max_size: int,
+        with_blurhash: bool
+    ) -> Tuple[bytes, str, str | None]:
+        """
+        Shrink the preview thumbnail and compute its blurhash.
+        The re-encoded thumbnail is used only if it's smaller.
+        :param image: thumbnail
+        :param image_type: type of the thumbnail
+        :param image_format: "webp" or "jpeg", empty to keep the thumbnail as it is
+        :param max_size: maximum width and height of the re-encoded thumbnail
+        :param with_blurhash: whether to compute the blurhash
+        :return: thumbnail, its type and blurhash
+        """
+        thumbnail_hash = None
+        try:
+            with Image.open(io.BytesIO(image)) as img:
+                if with_blurhash:
+                    thumbnail_hash = encode_blurhash(img)
+                if image_format:
+                    img = img.convert("RGB")
+                    img.thumbnail((max_size, max_size))
+                    output = io.BytesIO()
+                    img.save(output, format=image_format.upper(), quality=80)
+                    if output.tell() < len(image):
+                        image, image_type = output.getvalue(), f"image/{image_format}"
+        except (UnidentifiedImageError, OSError, ValueError) as e:
+            self.log.warning(f"Processing preview thumbnail failed: {e}")
+        return image, image_type, thumbnail_hash
+
+    async def _get_video_preview(
+        self,
+        url: str,
+        size: str = ""
+    ) -> Tuple[bytes | PreviewStream, str, int]:
+        """
+        Request video preview. The body is streamed if the response has its length,
+        otherwise it's downloaded.
         :param url: video preview url
+        :param size: preview size, the configured one if empty
         :return: video preview, video type, video duration
         """
         params = {
-            "size": self._get_preview_size()
+            "size": size or self._get_preview_size()
         }
         if self._get_mute():
             url += "&mute"
         try:
-            response = await self.http.get(
-                url,
-                headers=self.headers,
-                params=params,
-                raise_for_status=True
-            )
+            response = await self._get_preview(url, params, "video")
             video_type = response.content_type
             video_start = float(response.headers.get("x-video-start", 0))
             video_end = float(response.headers.get("x-video-end", 0))
             video_duration = int((video_end - video_start) * 1000)
+            if response.content_length:
+                return PreviewStream(response, response.content_length), video_type, video_duration
             video = await response.read()
         except ClientError as e:
             self.log.error(f"Error downloading video preview from API: {e}")
             return b"", "", 0
         return video, video_type, video_duration
 
-    async def _get_preview_thumbnail(self, url: str) -> Tuple[bytes, str]:
+    async def _get_preview_thumbnail(self, url: str, size: str = "") -> Tuple[bytes, str]:
         """
         Download preview thumbnail
         :param url: thumbnail url
+        :param size: preview size, the configured one if empty
         :return: thumbnail, image type
         """
         params = {
-            "size": self._get_preview_size()
+            "size": size or self._get_preview_size()
         }
         try:
-            response = await self.http.get(
-                url,
-                headers=self.headers,
-                params=params,
-                raise_for_status=True
-            )
+            response = await self._get_preview(url, params, "image")
             image_type = response.content_type
             image = await response.read()
         except ClientError as e:
@@ -617,50 +1575,431 @@ class AnimeTraceBot(Plugin):
             return b"", ""
         return image, image_type
 
+    async def _get_preview(self, url: str, params: dict[str, str], kind: str) -> Any:
+        """
+        Request preview media. If the response headers don't arrive within the 90th percentile
+        of recent response times of the same kind, a second request is sent and the first
+        response is used.
+        :param url: preview url
+        :param params: query parameters
+        :param kind: "image" or "video"
+        :return: response whose body hasn't been read yet
+        :raises ClientError: if all requests failed
+        """
+        policy = self.hedge_policies[kind]
+        delay = policy.delay() if policy.ratio else None
+        starts = {}
+
+        def request() -> asyncio.Task:
+            task = asyncio.create_task(
+                self.http.get(url, headers=self.headers, params=params, raise_for_status=True)
+            )
+            starts[task] = time.monotonic()
+            return task
+
+        tasks = [request()]
+        winner = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and policy.take():
+                    tasks.append(request())
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+                if winner:
+                    break
+            if not winner:
+                raise error
+            # The time of the first request is recorded even when the hedged one won, as long as
+            # it has taken so far. Recording the winner's time would pull the percentile down.
+            policy.record(time.monotonic() - starts[tasks[0]])
+            if winner is not tasks[0]:
+                policy.hedge_wins += 1
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and not task.cancelled() and task.exception() is None:
+                    # The slower response is dropped without reading its body
+                    task.result().release()
+
     @trace.subcommand("quota", help="Check the search quota and limit")
     async def check_quota(self, evt: MessageEvent) -> None:
         await evt.mark_read()
-        response = await self._get_quota()
-        if not response:
+        quota = await self._get_quota_state()
+        if not quota:
             await evt.reply("> Connection to trace.moe API failed")
             return
-        content = await self._prepare_message_quota(response)
+        content = await self._prepare_message_quota(quota)
         await evt.reply(content)
 
-    async def _get_quota(self) -> Any:
+    @trace.subcommand("history", help="Trace media in the room history (bot admins only)")
+    @command.argument("action", required=False)
+    async def trace_history(self, evt: MessageEvent, action: str | None) -> None:
+        await evt.mark_read()
+        if evt.sender not in self.config.get("admins", []):
+            await evt.reply("> Only bot admins can trace the room history.")
+            return
+        action = (action or "").strip().lower()
+        job = self.backfill_jobs.get(evt.room_id)
+        running = job is not None and not job.done()
+        if action == "stop":
+            if not running:
+                await evt.reply("> Room history trace isn't running.")
+                return
+            job.cancel()
+            return
+        if running:
+            await evt.reply("> Room history trace is already running in this room.")
+            return
+        if not self.client.crypto and await self._is_room_encrypted(evt.room_id):
+            await evt.reply(
+                "> The room is encrypted and the bot can't decrypt messages, "
+                "so its history can't be traced."
+            )
+            return
+
+        if action == "resume":
+            checkpoint = await self._get_backfill_checkpoint(evt.room_id)
+            if not checkpoint:
+                await evt.reply("> There's no room history trace to resume.")
+                return
+        else:
+            try:
+                days = int(action)
+            except ValueError:
+                days = 0
+            if days <= 0:
+                await evt.reply(
+                    "> **Usage:**  \n"
+                    "> To trace the media of the last number of days: `!trace history <days>`  \n"
+                    "> To continue an interrupted trace: `!trace history resume`  \n"
+                    "> To stop the trace: `!trace history stop`"
+                )
+                return
+            checkpoint = BackfillCheckpoint(
+                room_id=evt.room_id,
+                since=int((time.time() - days * 86400) * 1000)
+            )
+        # The job takes turns in the search queue with the commands of other rooms
+        token = requester.set((evt.room_id, evt.sender))
+        self.backfill_jobs[evt.room_id] = asyncio.create_task(self._trace_history(evt, checkpoint))
+        requester.reset(token)
+
+    async def _trace_history(self, evt: MessageEvent, checkpoint: BackfillCheckpoint) -> None:
+        """
+        Page backward through the room history and trace the media of every message
+        newer than the checkpoint's start. The progress is saved after every page,
+        and the trace pauses when the search quota drops to the reserve.
+        :param evt: user's message
+        :param checkpoint: where to start
+        """
+        room_id = evt.room_id
+        thread = self._get_history_output() == "thread"
+        summary: list[tuple[str, str, TraceResult | str]] = []
+        if thread and not checkpoint.thread_id:
+            checkpoint.thread_id = await evt.reply(
+                "> Tracing the room history, the results follow in this thread."
+            )
+        types = [str(EventType.ROOM_MESSAGE)]
+        if self.client.crypto:
+            types.append(str(EventType.ROOM_ENCRYPTED))
+        status = "Room history trace finished"
+        finished = False
+        try:
+            while not finished:
+                page = await self.client.get_messages(
+                    room_id,
+                    PaginationDirection.BACKWARD,
+                    from_token=checkpoint.token or None,
+                    limit=self.history_page_size,
+                    filter_json={"types": types}
+                )
+                finished = not page.events or not page.end
+                for message in page.events:
+                    if message.timestamp < checkpoint.since:
+                        finished = True
+                        break
+                    if message.sender == self.client.mxid:
+                        continue
+                    message = await self._prepare_history_event(message)
+                    if not message:
+                        continue
+                    for link, source, entry in await self._trace_history_message(message):
+                        if entry is None:
+                            status = (
+                                "Room history trace paused, the search quota reserve was reached. "
+                                "Continue with `!trace history resume`"
+                            )
+                            return
+                        if isinstance(entry, str):
+                            checkpoint.failed += 1
+                        else:
+                            checkpoint.traced += 1
+                        if not thread:
+                            summary.append((link, source, entry))
+                            continue
+                        html, body = render_history_entry(link, entry)
+                        content = TextMessageEventContent(
+                            msgtype=MessageType.NOTICE,
+                            format=Format.HTML,
+                            body=body,
+                            formatted_body=html
+                        )
+                        content.set_thread_parent(checkpoint.thread_id)
+                        reply_id = await self.client.send_message(room_id, content)
+                        if isinstance(entry, TraceResult):
+                            await self._remember_answer(room_id, source, reply_id)
+                    if len(summary) >= self.history_summary_size:
+                        await self._send_history_summary(room_id, summary)
+                        summary = []
+                # Media of a page that was cut short are traced again on resume,
+                # from the answered messages or the result cache
+                checkpoint.token = page.end or ""
+                await self._save_backfill_checkpoint(checkpoint)
+        except asyncio.CancelledError:
+            status = "Room history trace stopped. Continue with `!trace history resume`"
+            raise
+        except (MatrixRequestError, MatrixResponseError) as e:
+            self.log.error(f"Room history trace failed: {e}")
+            status = "Room history trace failed. Continue with `!trace history resume`"
+        finally:
+            self.backfill_jobs.pop(room_id, None)
+            if finished:
+                await self._delete_backfill_checkpoint(room_id)
+            else:
+                await self._save_backfill_checkpoint(checkpoint)
+            if summary:
+                await self._send_history_summary(room_id, summary)
+            content = TextMessageEventContent(
+                msgtype=MessageType.NOTICE,
+                body=f"> {status}. Traced: {checkpoint.traced}, failed: {checkpoint.failed}."
+            )
+            if thread:
+                content.set_thread_parent(checkpoint.thread_id)
+            await self.client.send_message(room_id, content)
+
+    async def _is_room_encrypted(self, room_id: RoomID) -> bool:
+        """
+        Check whether encryption is enabled in a room
+        :param room_id: room ID
+        :return: True if the room is encrypted
+        """
+        try:
+            await self.client.get_state_event(room_id, EventType.ROOM_ENCRYPTION)
+        except MNotFound:
+            return False
+        return True
+
+    async def _prepare_history_event(self, message: Any) -> Any:
+        """
+        Decrypt an event of the room history and trim the reply fallback of the message,
+        which maubot does only for the events it gets one by one
+        :param message: raw event from the room history
+        :return: message, or None if it couldn't be decrypted or isn't a message
+        """
+        if isinstance(message, EncryptedEvent):
+            try:
+                message = await self.client.crypto.decrypt_megolm_event(message)
+            except DecryptionError as e:
+                self.log.warning(f"Decrypting {message.event_id} failed: {e}")
+                return None
+        if message.type != EventType.ROOM_MESSAGE:
+            return None
+        message.content.trim_reply_fallback()
+        return message
+
+    async def _trace_history_message(
+        self,
+        message: MessageEvent
+    ) -> list[tuple[str, str, TraceResult | str | None]]:
+        """
+        Trace the media of one message of the room history that haven't been answered yet
+        :param message: message from the room history
+        :return: link to the message, answered source and the best match, the reason
+         why there is none, or None if the search quota reserve was reached
+        """
+        if not hasattr(message.content, "msgtype"):
+            return []
+        sources = self._get_media_sources(message)
+        link = f"https://matrix.to/#/{message.room_id}/{message.event_id}"
+        entries = []
+        for media_ext_url, media_url, content_type in sources:
+            source = message.event_id if len(sources) == 1 else media_url or media_ext_url
+            if await self._get_answer(message.room_id, source):
+                continue
+            if not await self._wait_for_history_quota():
+                entries.append((link, source, None))
+                break
+            entry = await self._search_history_item(media_ext_url, media_url, content_type)
+            entries.append((link, source, entry))
+        return entries
+
+    async def _wait_for_history_quota(self) -> bool:
+        """
+        Keep the room history trace within the search quota, the rate limit and the room budget
+        :return: False if the search quota dropped to the reserve
+        """
+        quota = await self._get_quota_state() or self.quota
+        reserve = self._get_int_config("history_quota_reserve", 100, 0)
+        if quota.quota and quota.quota_remaining <= reserve:
+            return False
+        if quota.rate_remaining == 0 and quota.rate_reset:
+            await asyncio.sleep(max(0.0, quota.rate_reset - time.time()))
+        request = requester.get()
+        if request:
+            await asyncio.sleep(self.room_budgets.check(request[0]))
+        return True
+
+    async def _search_history_item(
+        self,
+        media_ext_url: str,
+        media_url: str,
+        content_type: str
+    ) -> TraceResult | str:
+        """
+        Search for media of the room history, pausing after searches that used the quota
+        :param media_ext_url: external image URL
+        :param media_url: matrix content URL
+        :param content_type: content type of matrix media
+        :return: best match, or the reason why there is none
+        """
+        quota_used = self.quota.quota_used
+        try:
+            response = await self._search(media_ext_url, media_url, content_type)
+        except ValueError as e:
+            return f"File validation failed - {e}"
+        except ClientError as e:
+            return str(e)
+        finally:
+            if self.quota.quota_used != quota_used:
+                await asyncio.sleep(self._get_int_config("history_interval", 1, 0))
+        if not response.results:
+            return "Couldn't find an anime based on the provided screenshot/video."
+        return response.results[0]
+
+    async def _send_history_summary(
+        self,
+        room_id: RoomID,
+        entries: list[tuple[str, str, TraceResult | str]]
+    ) -> None:
+        """
+        Send a summary of traced media of the room history, and remember it as the answer
+        to the found ones, so that they aren't searched again on resume
+        :param room_id: room ID
+        :param entries: links to the traced messages, answered sources and the best matches
+         or the reasons why there are none
+        """
+        html, body = render_history_summary([(link, entry) for link, _, entry in entries])
+        reply_id = await self.client.send_message(
+            room_id,
+            TextMessageEventContent(
+                msgtype=MessageType.NOTICE,
+                format=Format.HTML,
+                body=body,
+                formatted_body=html
+            )
+        )
+        for _, source, entry in entries:
+            if isinstance(entry, TraceResult):
+                await self._remember_answer(room_id, source, reply_id)
+
+    async def _get_backfill_checkpoint(self, room_id: RoomID) -> BackfillCheckpoint | None:
+        if not self.backfill_store:
+            return self.backfill_checkpoints.get(room_id)
+        try:
+            return await self.backfill_store.get(room_id)
+        except Exception as e:
+            self.log.error(f"Reading room history trace checkpoint failed: {e}")
+            return None
+
+    async def _save_backfill_checkpoint(self, checkpoint: BackfillCheckpoint) -> None:
+        if not self.backfill_store:
+            self.backfill_checkpoints[RoomID(checkpoint.room_id)] = checkpoint
+            return
+        try:
+            await self.backfill_store.put(checkpoint)
+        except Exception as e:
+            self.log.error(f"Writing room history trace checkpoint failed: {e}")
+
+    async def _delete_backfill_checkpoint(self, room_id: RoomID) -> None:
+        if not self.backfill_store:
+            self.backfill_checkpoints.pop(room_id, None)
+            return
+        try:
+            await self.backfill_store.delete(room_id)
+        except Exception as e:
+            self.log.error(f"Deleting room history trace checkpoint failed: {e}")
+
+    async def _get_quota_state(self) -> QuotaState | None:
+        """
+        Get the quota state, refreshing it from API only when it's stale
+        :return: quota state, None if it was never loaded
+        """
+        if self.quota.is_stale(self._get_int_config("quota_ttl", 300, 0)):
+            info = await self._get_quota()
+            if info:
+                self.quota.update(info)
+                await self.local_state.sync_quota(info.quota, info.quota_used)
+                try:
+                    await self.shared.sync_quota(info.quota, info.quota_used)
+                except sqlite3.Error as e:
+                    self.log.warning(f"Syncing quota to the shared backend failed: {e}")
+        return self.quota if self.quota.updated else None
+
+    async def _get_quota(self) -> QuotaInfo | None:
         """
         Request quota and limit data from API
-        :return: json response
+        :return: decoded API response
         """
         try:
-            response = await self.http.get(self.api_me, headers=self.headers, raise_for_status=True)
-            return await response.json()
+            endpoint = self.search_backend.primary
+            response = await self.http.get(
+                endpoint.me_url,
+                headers=self._get_endpoint_headers(endpoint),
+                raise_for_status=True
+            )
+            return QuotaInfo.from_json(await response.json(loads=json_loads))
         except ClientError as e:
             self.log.error(f"Connection to trace.moe API failed: {e}")
             return None
+        except ValueError as e:
+            self.log.error(f"Invalid response from trace.moe API: {e}")
+            return None
 
-    async def _prepare_message_quota(self, response: Any) -> TextMessageEventContent:
+    async def _prepare_message_quota(self, quota: QuotaState) -> TextMessageEventContent:
         """
         Prepare the quota message
-        :param response: json response from API
+        :param quota: quota state
         :return: formatted message response
         """
         body = (
             "> ### trace.moe quota  \n"
-            f"> **Priority:** {response['priority']}  \n"
-            f"> **Concurrency:** {response['concurrency']}  \n"
-            f"> **Quota:** {response['quota']}  \n"
-            f"> **Quota used:** {response['quotaUsed']}"
+            f"> **Priority:** {quota.priority}  \n"
+            f"> **Concurrency:** {quota.concurrency}  \n"
+            f"> **Quota:** {quota.quota}  \n"
+            f"> **Quota used:** {quota.quota_used}"
         )
         html = (
             "<blockquote>"
             "<h3>trace.moe quota</h3>"
-            f"<p><b>Priority:</b> {response['priority']}"
-            f"<br><b>Concurrency:</b> {response['concurrency']}"
-            f"<br><b>Quota:</b> {response['quota']}"
-            f"<br><b>Quota used:</b> {response['quotaUsed']}"
-            "</p></blockquote>"
+            f"<p><b>Priority:</b> {quota.priority}"
+            f"<br><b>Concurrency:</b> {quota.concurrency}"
+            f"<br><b>Quota:</b> {quota.quota}"
+            f"<br><b>Quota used:</b> {quota.quota_used}"
         )
+        if quota.rate_limit is not None and quota.rate_remaining is not None:
+            body += f"  \n> **Rate limit remaining:** {quota.rate_remaining}/{quota.rate_limit}"
+            html += f"<br><b>Rate limit remaining:</b> {quota.rate_remaining}/{quota.rate_limit}"
+        html += "</p></blockquote>"
         return TextMessageEventContent(
             msgtype=MessageType.NOTICE,
             format=Format.HTML,
@@ -679,6 +2018,35 @@ class AnimeTraceBot(Plugin):
             return size
         return "m"
 
+    def _choose_preview_size(self) -> str:
+        """
+        Get the preview size for a reply. In adaptive mode it's the largest size, up to
+        the configured one, that fits in the latency budget at the current throughput and load.
+        :return: preview size parameter
+        """
+        size = self._get_preview_size()
+        if not self._get_adaptive_preview():
+            return size
+        return self.preview_sizer.choose(
+            size,
+            self._get_int_config("preview_budget", 5, 0),
+            self.load.commands
+        )
+
+    def _get_adaptive_preview(self) -> bool:
+        """
+        Get information from configuration whether to adapt the preview size to the load
+        :return: adaptive preview status
+        """
+        base_adaptive_preview = {
+            "yes": True,
+            "no": False
+        }
+        return base_adaptive_preview.get(
+            self.config.get("adaptive_preview", "no"),
+            base_adaptive_preview["no"]
+        )
+
     def _get_mute(self) -> bool:
         """
         Get the mute status of preview video from configuration
@@ -701,6 +2069,133 @@ class AnimeTraceBot(Plugin):
         }
         return base_cut_borders.get(self.config.get("cut_borders", "yes"), base_cut_borders["yes"])
 
+    def _get_speculative_search(self) -> bool:
+        """
+        Get information from configuration whether to validate external URLs
+        and search for them at the same time
+        :return: speculative search status
+        """
+        base_speculative_search = {
+            "yes": True,
+            "no": False
+        }
+        return base_speculative_search.get(
+            self.config.get("speculative_search", "no"),
+            base_speculative_search["no"]
+        )
+
+    def _get_fetch_strategy(self) -> str:
+        """
+        Get the way of searching for external URLs from configuration
+        :return: fetch strategy
+        """
+        strategy = self.config.get("fetch_strategy", REMOTE)
+        if strategy in (REMOTE, LOCAL, "auto"):
+            return strategy
+        return REMOTE
+
+    def _get_pixiv_proxy(self) -> str:
+        """
+        Get the host of the proxy pixiv images are fetched through from configuration
+        :return: host, empty if pixiv links are kept as they are
+        """
+        return str(self.config.get("pixiv_proxy", "") or "").strip().lower()
+
+    def _get_thumbnail_format(self) -> str:
+        """
+        Get the format preview thumbnails are re-encoded to from configuration
+        :return: "webp" or "jpeg", empty if thumbnails are sent as they are
+        """
+        base_format = {
+            "original": "",
+            "webp": "webp",
+            "jpeg": "jpeg"
+        }
+        return base_format.get(
+            self.config.get("thumbnail_format", "original"),
+            base_format["original"]
+        )
+
+    def _get_blurhash(self) -> bool:
+        """
+        Get information from configuration whether to compute blurhashes of preview thumbnails
+        :return: blurhash status
+        """
+        base_blurhash = {
+            "yes": True,
+            "no": False
+        }
+        return base_blurhash.get(self.config.get("blurhash", "no"), base_blurhash["no"])
+
+    def _get_downscale(self) -> bool:
+        """
+        Get information from configuration whether to downscale downloaded images
+        :return: downscale status
+        """
+        base_downscale = {
+            "yes": True,
+            "no": False
+        }
+        return base_downscale.get(self.config.get("downscale", "yes"), base_downscale["yes"])
+
+    def _get_load_level(self) -> int:
+        """
+        Get the degradation level of new commands from the load and configured limits
+        :return: FULL, NO_PREVIEW, FEWER_RESULTS or BUSY
+        """
+        return self.load.level(
+            self._get_int_config("shed_commands", 10, 0),
+            self._get_int_config("shed_memory", 200, 0) * 1024 * 1024,
+            self._get_int_config("shed_quota", 20, 0),
+            self.quota.quota_remaining if self.quota.quota else None
+        )
+
+    def _get_busy_message(self) -> str:
+        """
+        Get the reply to searches that are rejected because the bot is busy
+        :return: message telling whether the load or the search quota is the cause
+        """
+        min_quota = self._get_int_config("shed_quota", 20, 0)
+        if min_quota and self.quota.quota and min_quota / max(self.quota.quota_remaining, 1) >= 2:
+            return (
+                "The search quota is almost used up. Until it's renewed, "
+                "only media that was traced before can be searched."
+            )
+        return "The bot is busy, try again later."
+
+    def _get_room_weights(self) -> dict[str, float]:
+        """
+        Get the weights of rooms in the search queue from configuration
+        :return: room ID -> weight
+        """
+        weights = {}
+        for room_id, weight in (self.config.get("room_weights", {}) or {}).items():
+            try:
+                weights[room_id] = max(0.01, float(weight))
+            except (ValueError, TypeError):
+                self.log.error(f"Incorrect weight of room {room_id}. Setting default value of 1.")
+        return weights
+
+    def _get_history_output(self) -> str:
+        """
+        Get where the results of room history traces are sent from configuration
+        :return: "thread" or "summary"
+        """
+        output = self.config.get("history_output", "thread")
+        if output in ("thread", "summary"):
+            return output
+        return "thread"
+
+    def _get_batch_reply(self) -> str:
+        """
+        Get the way of replying to traces of several media from configuration
+        :return: "combined" or "separate"
+        """
+        reply = self.config.get("batch_reply", "combined")
+        if reply in ("combined", "separate"):
+            return reply
+        return "combined"
+
     def _get_max_results(self) -> int:
         """
         Get the maximum number of results from configuration
@@ -714,9 +2209,94 @@ class AnimeTraceBot(Plugin):
             max_results = 5
         return max_results
 
+    def _create_anilist_index(self) -> AnilistIndex | None:
+        """
+        Open the AniList index from configuration
+        :return: AniList index, None if it's disabled, can't be opened or is empty
+        """
+        path = self.config.get("anilist_index", "")
+        if not path:
+            return None
+        try:
+            index = AnilistIndex(path)
+            entries = len(index)
+        except sqlite3.Error as e:
+            self.log.error(f"Opening AniList index {path} failed, requesting titles from API: {e}")
+            return None
+        if not entries:
+            self.log.error(f"AniList index {path} is empty, requesting titles from API")
+            index.close()
+            return None
+        return index
+
+    def _create_search_backend(self) -> SearchBackend:
+        """
+        Create the search backend from configuration
+        :return: search backend
+        """
+        endpoints = []
+        for endpoint in self.config.get("endpoints", []) or []:
+            if isinstance(endpoint, str):
+                endpoint = {"url": endpoint}
+            try:
+                url = str(endpoint["url"]).rstrip("/")
+                api_key = str(endpoint.get("api_key") or "")
+                concurrency = max(0, int(endpoint.get("concurrency") or 0))
+            except (KeyError, TypeError, AttributeError, ValueError):
+                self.log.error(f"Incorrect search endpoint {endpoint}, skipping it.")
+                continue
+            endpoints.append(Endpoint(url=url, api_key=api_key, concurrency=concurrency))
+        if not endpoints:
+            endpoints.append(Endpoint(url=self.api_url, api_key=self.config.get("api_key", "")))
+        if self.config.get("search_routing", "latency") == "priority":
+            return PriorityBackend(endpoints)
+        return LatencyBackend(endpoints)
+
+    def _create_shared_backend(self) -> SharedBackend:
+        """
+        Create the backend for the state shared with other bot instances from configuration
+        :return: shared backend
+        """
+        path = self.config.get("shared_backend", "")
+        if path:
+            try:
+                return SQLiteBackend(path)
+            except sqlite3.Error as e:
+                self.log.error(f"Opening shared backend {path} failed, using local state: {e}")
+        return LocalBackend()
+
+    def _create_media_cache(self) -> MediaDiskCache | None:
+        """
+        Create the disk cache of Matrix media from configuration
+        :return: disk cache, None if disabled
+        """
+        directory = self.config.get("media_cache_dir", "")
+        if not directory:
+            return None
+        max_bytes = self._get_int_config("media_cache_size", 500, 0) * 1000000
+        try:
+            return MediaDiskCache(directory, max_bytes)
+        except OSError as e:
+            self.log.error(f"Opening media cache directory {directory} failed: {e}")
+            return None
+
+    def _get_int_config(self, key: str, default: int, minimum: int) -> int:
+        """
+        Get an integer value from configuration
+        :param key: configuration key
+        :param default: value used if the configured one is missing or incorrect
+        :param minimum: smallest allowed value
+        :return: configuration value
+        """
+        try:
+            return max(minimum, int(self.config.get(key, default)))
+        except (ValueError, TypeError):
+            self.log.error(f"Incorrect '{key}' config value. Setting default value of {default}.")
+            return default
+
     def _get_image_dimensions(self, image: bytes) -> Tuple[int, int]:
         """
-        Examine image dimensions
+        Examine image dimensions with Pillow, for images whose headers can't be read in place
         :param image: image data as bytes
         :return: Tuple with image width and height
         """
@@ -731,3 +2311,7 @@ class AnimeTraceBot(Plugin):
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
+
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable | None:
+        return upgrade_table
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from .datastructures import AnilistInfo
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class AnilistIndex:
+    """
+    On-disk index of AniList metadata keyed by AniList ID. With it the bot requests
+    bare searches, without ?anilistInfo, and fills in titles and MAL IDs locally.
+    """
+
+    def __init__(self, path: str, read_only: bool = True) -> None:
+        """
+        :param path: path to the database file
+        :param read_only: open an existing index read-only, otherwise the index
+         is created if it doesn't exist
+        :raises sqlite3.Error: if a read-only index doesn't exist
+        """
+        if read_only:
+            # A wrong path fails instead of silently creating an empty index
+            uri = f"{Path(path).absolute().as_uri()}?mode=ro"
+            self._conn = sqlite3.connect(uri, timeout=10, check_same_thread=False, uri=True)
+        else:
+            self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS anilist ("
+                "id INTEGER PRIMARY KEY, id_mal INTEGER, romaji TEXT NOT NULL, "
+                "english TEXT, synonyms TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        self._mutex = threading.Lock()
+
+    async def get_many(self, ids: Iterable[int]) -> dict[int, AnilistInfo]:
+        """
+        Get the metadata of several anime
+        :param ids: AniList IDs
+        :return: AniList ID -> metadata, for the IDs that are in the index
+        """
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        return await asyncio.to_thread(self._get_many, ids)
+
+    def _get_many(self, ids: list[int]) -> dict[int, AnilistInfo]:
+        placeholders = ", ".join("?" * len(ids))
+        with self._mutex:
+            rows = self._conn.execute(
+                "SELECT id, id_mal, romaji, english, synonyms FROM anilist "
+                f"WHERE id IN ({placeholders})",
+                ids
+            ).fetchall()
+        return {
+            row[0]: AnilistInfo(
+                id=row[0],
+                id_mal=row[1],
+                title_romaji=row[2],
+                title_english=row[3],
+                synonyms=tuple(json.loads(row[4]))
+            )
+            for row in rows
+        }
+
+    async def find(self, title: str) -> int | None:
+        """
+        Find an anime by its title, case-insensitively: an exact romaji or English title
+        first, then a synonym, then the beginning of a title
+        :param title: title
+        :return: AniList ID, None if no anime matches
+        """
+        return await asyncio.to_thread(self._find, title.strip())
+
+    def _find(self, title: str) -> int | None:
+        escaped = _escape_like(title)
+        # Synonyms are stored as a JSON list, match a whole quoted item
+        synonym = _escape_like(json.dumps(title, ensure_ascii=False))
+        queries = (
+            ("romaji = ?1 COLLATE NOCASE OR english = ?1 COLLATE NOCASE", title),
+            ("synonyms LIKE '%' || ?1 || '%' ESCAPE '\\'", synonym),
+            ("romaji LIKE ?1 || '%' ESCAPE '\\' OR english LIKE ?1 || '%' ESCAPE '\\'", escaped)
+        )
+        with self._mutex:
+            for condition, value in queries:
+                row = self._conn.execute(
+                    f"SELECT id FROM anilist WHERE {condition} ORDER BY length(romaji), id LIMIT 1",
+                    (value,)
+                ).fetchone()
+                if row:
+                    return row[0]
+        return None
+
+    def import_entries(self, entries: Iterable[Any]) -> int:
+        """
+        Add or replace metadata in bulk, skipping entries that aren't valid AniList media objects
+        :param entries: AniList media objects with id, idMal, title and synonyms
+        :return: number of imported entries
+        """
+        rows = []
+        for entry in entries:
+            try:
+                info = AnilistInfo.from_json(entry)
+            except ValueError:
+                continue
+            if not info.title_romaji:
+                continue
+            rows.append((
+                info.id,
+                info.id_mal,
+                info.title_romaji,
+                info.title_english,
+                json.dumps(info.synonyms, ensure_ascii=False)
+            ))
+        with self._mutex, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO anilist (id, id_mal, romaji, english, synonyms) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        return len(rows)
+
+    def __len__(self) -> int:
+        with self._mutex:
+            return self._conn.execute("SELECT COUNT(*) FROM anilist").fetchone()[0]
+
+    def close(self) -> None:
+        with self._mutex:
+            self._conn.close()
+
+
+def read_entries(path: str) -> Iterator[Any]:
+    """
+    Read AniList media objects from a JSON array, JSON lines,
+    or pages of AniList GraphQL responses ({"data": {"Page": {"media": [...]}}})
+    :param path: path to the file
+    :return: AniList media objects
+    """
+    with open(path, encoding="utf-8") as file:
+        text = file.read()
+    try:
+        documents = [json.loads(text)]
+    except ValueError:
+        documents = [json.loads(line) for line in text.splitlines() if line.strip()]
+    for document in documents:
+        if isinstance(document, dict) and "data" in document:
+            document = (document.get("data") or {}).get("Page", {}).get("media", [])
+        if isinstance(document, list):
+            yield from document
+        else:
+            yield document
+
+
+def main(args: list[str]) -> int:
+    """
+    Bulk import tool: python -m anime_trace.resources.anilist <index file> <JSON file>...
+    """
+    if len(args) < 2:
+        print("Usage: python -m anime_trace.resources.anilist <index file> <JSON file>...")
+        return 2
+    index = AnilistIndex(args[0], read_only=False)
+    try:
+        for path in args[1:]:
+            imported = index.import_entries(read_entries(path))
+            print(f"{path}: imported {imported} entries")
+        print(f"{args[0]}: {len(index)} entries")
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
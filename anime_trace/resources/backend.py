@@ -0,0 +1,117 @@
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class Endpoint:
+    """
+    trace.moe API instance, the public one or a self-hosted replica
+    """
+    url: str
+    api_key: str = ""
+    # Searches sent at the same time, 0 means unlimited. The primary endpoint
+    # follows the concurrency limit of its API key instead.
+    concurrency: int = 0
+    active: int = 0
+    # Moving average of the request duration in seconds
+    latency: float = 0.0
+    samples: int = 0
+    # Failures in a row, and when the endpoint is tried again after them
+    failures: int = 0
+    retry_at: float = 0.0
+
+    @property
+    def search_url(self) -> str:
+        return f"{self.url}/search"
+
+    @property
+    def me_url(self) -> str:
+        return f"{self.url}/me"
+
+    @property
+    def healthy(self) -> bool:
+        return not self.failures or time.monotonic() >= self.retry_at
+
+
+class SearchBackend(ABC):
+    """
+    Chooses the trace.moe API endpoints searches are sent to. An endpoint that fails
+    is avoided for a while, growing with its failures in a row, and the next one is tried.
+    """
+
+    alpha = 0.3
+    retry_delay = 5.0
+    max_retry_delay = 300.0
+
+    def __init__(self, endpoints: list[Endpoint]) -> None:
+        """
+        :param endpoints: endpoints, the first one is the primary endpoint
+         whose quota and limits the bot follows
+        """
+        if not endpoints:
+            raise ValueError("No search endpoints")
+        self.endpoints = endpoints
+
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+
+    def route(self) -> list[Endpoint]:
+        """
+        Get the endpoints to try for a request, healthy ones first
+        :return: endpoints in order
+        """
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        # Unhealthy endpoints are the last resort, the one that comes back first is tried first
+        unhealthy = sorted(
+            (endpoint for endpoint in self.endpoints if not endpoint.healthy),
+            key=lambda endpoint: endpoint.retry_at
+        )
+        return self._order(healthy) + unhealthy
+
+    @abstractmethod
+    def _order(self, endpoints: list[Endpoint]) -> list[Endpoint]:
+        """
+        Order the healthy endpoints
+        :param endpoints: healthy endpoints in configured order
+        :return: endpoints in the order they are tried
+        """
+
+    def record(self, endpoint: Endpoint, latency: float, failed: bool) -> None:
+        """
+        Record the outcome of a request
+        :param endpoint: endpoint
+        :param latency: duration of the request in seconds
+        :param failed: whether the endpoint failed, rejections of the media don't count
+        """
+        if failed:
+            endpoint.failures += 1
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** (endpoint.failures - 1))
+            endpoint.retry_at = time.monotonic() + delay
+            return
+        endpoint.failures = 0
+        if not endpoint.samples:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += self.alpha * (latency - endpoint.latency)
+        endpoint.samples += 1
+
+
+class PriorityBackend(SearchBackend):
+    """
+    Backend that sends requests to the first healthy endpoint in configured order
+    """
+
+    def _order(self, endpoints: list[Endpoint]) -> list[Endpoint]:
+        return endpoints
+
+
+class LatencyBackend(SearchBackend):
+    """
+    Backend that sends requests to the healthy endpoint with the lowest latency.
+    Endpoints without measurements are tried first, so that every one gets measured.
+    """
+
+    def _order(self, endpoints: list[Endpoint]) -> list[Endpoint]:
+        return sorted(endpoints, key=lambda endpoint: (endpoint.samples > 0, endpoint.latency))
@@ -0,0 +1,80 @@
+import math
+
+from PIL import Image
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Key of the blurhash in the info objects of Matrix media events (MSC2448)
+BLURHASH_KEY = "xyz.amorgan.blurhash"
+
+_BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+# The hash describes only a blurred image, computing it from more pixels changes nothing
+_MAX_SIDE = 64
+
+
+def blurhash_available() -> bool:
+    """
+    Check whether blurhashes can be computed, NumPy is an optional dependency
+    """
+    return np is not None
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(_BASE83[value // 83 ** (length - i - 1) % 83] for i in range(length))
+
+
+def _srgb_to_linear(values: "np.ndarray") -> "np.ndarray":
+    values = values / 255
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+def _linear_to_srgb(value: float) -> int:
+    value = min(1.0, max(0.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def encode_blurhash(image: Image.Image, x_components: int = 4, y_components: int = 3) -> str:
+    """
+    Compute the blurhash of an image
+    :param image: image
+    :param x_components: number of horizontal components, 1 to 9
+    :param y_components: number of vertical components, 1 to 9
+    :return: blurhash
+    :raises RuntimeError: if NumPy isn't installed
+    """
+    if np is None:
+        raise RuntimeError("NumPy is required to compute blurhashes")
+    image = image.convert("RGB")
+    image.thumbnail((_MAX_SIDE, _MAX_SIDE))
+    pixels = _srgb_to_linear(np.asarray(image, dtype=np.float64))
+    height, width = pixels.shape[:2]
+    # Cosine bases of all components at once, factors[y, x] is the average color
+    # of the image weighted by the basis of component (x, y)
+    basis_x = np.cos(np.pi * np.outer(np.arange(x_components), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(y_components), np.arange(height)) / height)
+    factors = np.einsum("jh,iw,hwc->jic", basis_y, basis_x, pixels) / (width * height)
+    factors[1:, :] *= 2
+    factors[0, 1:] *= 2
+
+    dc = factors[0, 0]
+    ac = factors.reshape(-1, 3)[1:]
+    result = _base83(x_components - 1 + (y_components - 1) * 9, 1)
+    if len(ac):
+        quantised_max = max(0, min(82, math.floor(float(np.abs(ac).max()) * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+    else:
+        quantised_max = 0
+        max_value = 1
+    result += _base83(quantised_max, 1)
+    r, g, b = (_linear_to_srgb(float(value)) for value in dc)
+    result += _base83((r << 16) + (g << 8) + b, 4)
+    # Square root keeps more precision for the small components
+    scaled = np.sign(ac) * np.abs(ac / max_value) ** 0.5
+    quantised = np.clip(np.floor(scaled * 9 + 9.5), 0, 18).astype(int)
+    for qr, qg, qb in quantised:
+        result += _base83(int(qr) * 19 * 19 + int(qg) * 19 + int(qb), 2)
+    return result
@@ -0,0 +1,294 @@
+import json
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Any, Hashable
+
+from .datastructures import SearchResponse
+from .db import ResultStore
+from .shared import SharedBackend
+
+
+class TTLCache:
+    """
+    Bounded least recently used cache with per-entry expiry
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        """
+        :param max_size: maximum number of entries
+        :param ttl: default time to live of an entry in seconds
+        """
+        self.max_size = max(0, max_size)
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get a value and mark it as recently used
+        :param key: key
+        :param default: value returned if the key is missing or expired
+        :return: cached value
+        """
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        """
+        Store a value, evicting the least recently used entries if the cache is full
+        :param key: key
+        :param value: value
+        :param ttl: time to live in seconds, defaults to the cache TTL
+        """
+        if self.max_size == 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove a value from the cache
+        :param key: key
+        :param default: value returned if the key is missing
+        :return: removed value
+        """
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class FrequencySketch:
+    """
+    Count-min sketch with periodic aging, used as a TinyLFU admission filter
+    """
+
+    depth = 4
+    max_count = 15
+
+    def __init__(self, width: int) -> None:
+        """
+        :param width: number of counters per row, rounded up to a power of two
+        """
+        self.width = 1 << max(4, (width - 1).bit_length())
+        self.sample_size = 10 * self.width
+        self._rows = [bytearray(self.width) for _ in range(self.depth)]
+        self._additions = 0
+
+    def _indexes(self, key: str) -> list[int]:
+        digest = blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        mask = self.width - 1
+        return [
+            int.from_bytes(digest[i * 4:(i + 1) * 4], "little") & mask
+            for i in range(self.depth)
+        ]
+
+    def increment(self, key: str) -> None:
+        """
+        Record an access to the key
+        :param key: key
+        """
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self.max_count:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._age()
+
+    def estimate(self, key: str) -> int:
+        """
+        Estimate how often the key was accessed recently
+        :param key: key
+        :return: estimated frequency
+        """
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def _age(self) -> None:
+        # Halve all counters so that the sketch follows recent popularity
+        for row in self._rows:
+            for i in range(self.width):
+                row[i] >>= 1
+        self._additions //= 2
+
+
+class ResultCache:
+    """
+    Tiered cache of search results. The first tier is an in-memory LRU,
+    the optional second one is shared with other bot instances, and the last one
+    is the plugin database, which survives plugin reloads.
+    New entries are admitted to the database only if they are accessed more often
+    than the entry they would replace.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: int,
+        store: ResultStore | None = None,
+        store_size: int = 0,
+        shared: SharedBackend | None = None,
+        log: logging.Logger | None = None
+    ) -> None:
+        """
+        :param max_size: maximum number of results kept in memory
+        :param ttl: time to live of a result in seconds
+        :param store: database tier
+        :param store_size: maximum number of results kept in the database
+        :param shared: tier shared with other bot instances
+        :param log: logger
+        """
+        self.ttl = ttl
+        self.memory = TTLCache(max_size, ttl)
+        self.shared = shared
+        self.store = store if store_size > 0 else None
+        self.store_size = store_size
+        self.sketch = FrequencySketch(max(max_size, store_size))
+        self.log = log or logging.getLogger(__name__)
+
+    async def get(self, key: str) -> SearchResponse | None:
+        """
+        Look up a result in memory, then in the shared tier and in the database
+        :param key: cache key
+        :return: cached search response
+        """
+        self.sketch.increment(key)
+        response = self.memory.get(key)
+        if response is not None:
+            return response
+        data = None
+        ttl = None
+        if self.shared:
+            try:
+                data = await self.shared.get_result(key)
+            except Exception as e:
+                self.log.error(f"Reading shared result cache failed: {e}")
+        if data is None and self.store:
+            try:
+                row = await self.store.get(key, int(time.time()))
+            except Exception as e:
+                self.log.error(f"Reading result cache from database failed: {e}")
+            else:
+                if row is not None:
+                    # The result stays in memory only for what's left of its lifetime
+                    data, expires = row
+                    ttl = max(0.0, expires - time.time())
+        if data is None:
+            return None
+        try:
+            response = self.decode(data)
+        except ValueError as e:
+            self.log.error(f"Invalid result cache entry: {e}")
+            return None
+        self.memory.set(key, response, ttl)
+        return response
+
+    async def put(self, key: str, response: SearchResponse) -> None:
+        """
+        Store a successful search result in all tiers
+        :param key: cache key
+        :param response: search response
+        """
+        if response.error or not response.results:
+            return
+        self.memory.set(key, response)
+        if not self.store and not self.shared:
+            return
+        data = self.encode(response)
+        if self.shared:
+            try:
+                await self.shared.set_result(key, data, self.ttl)
+            except Exception as e:
+                self.log.error(f"Writing shared result cache failed: {e}")
+        if not self.store:
+            return
+        try:
+            if not await self._admit(key):
+                return
+            await self.store.put(key, data, int(time.time()) + self.ttl)
+        except Exception as e:
+            self.log.error(f"Writing result cache to database failed: {e}")
+
+    async def _admit(self, key: str) -> bool:
+        """
+        TinyLFU admission: when the database tier is full, the new entry has to be
+        more popular than the least used entry, which is then evicted.
+        :param key: cache key of the candidate
+        :return: True if the candidate should be stored
+        """
+        if await self.store.count() < self.store_size:
+            return True
+        victim = await self.store.victim()
+        if victim is None:
+            return True
+        if self.sketch.estimate(key) <= self.sketch.estimate(victim):
+            return False
+        await self.store.delete(victim)
+        return True
+
+    async def warm_up(self, limit: int) -> int:
+        """
+        Load the most popular results from the database into memory
+        :param limit: maximum number of results to load
+        :return: number of loaded results
+        """
+        if not self.store or limit <= 0:
+            return 0
+        now = int(time.time())
+        try:
+            await self.store.delete_expired(now)
+            rows = await self.store.hottest(min(limit, self.memory.max_size), now)
+        except Exception as e:
+            self.log.error(f"Loading result cache from database failed: {e}")
+            return 0
+        loaded = 0
+        # Insert the least popular first so that the most popular end up most recently used
+        for key, data, hits, expires in reversed(rows):
+            try:
+                self.memory.set(key, self.decode(data), max(0.0, expires - time.time()))
+            except ValueError:
+                continue
+            for _ in range(min(hits, FrequencySketch.max_count)):
+                self.sketch.increment(key)
+            loaded += 1
+        return loaded
+
+    @staticmethod
+    def encode(response: SearchResponse) -> bytes:
+        """
+        Serialize and compress a search response
+        :param response: search response
+        :return: compressed data
+        """
+        return zlib.compress(json.dumps(response.to_json(), separators=(",", ":")).encode())
+
+    @staticmethod
+    def decode(data: bytes) -> SearchResponse:
+        """
+        Decompress and deserialize a search response
+        :param data: compressed data
+        :return: search response
+        :raises ValueError: if the data is corrupted
+        """
+        try:
+            return SearchResponse.from_json(json.loads(zlib.decompress(data)))
+        except zlib.error as e:
+            raise ValueError(f"Corrupted result cache entry: {e}") from e
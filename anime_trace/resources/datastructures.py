@@ -1,4 +1,6 @@
+import time
 from dataclasses import dataclass
+from typing import Any, Mapping
 
 
 @dataclass
@@ -7,3 +9,218 @@ class MessageData:
     body: str
     video_url: str
     image_url: str
+
+
+@dataclass(slots=True, frozen=True)
+class AnilistInfo:
+    id: int
+    id_mal: int | None
+    title_romaji: str
+    title_english: str | None
+    synonyms: tuple[str, ...]
+
+    @classmethod
+    def from_json(cls, data: Any) -> "AnilistInfo":
+        """
+        Decode the anilist object of a search result. Searches without ?anilistInfo
+        return only the ID, the rest is filled in from the AniList index.
+        :param data: anilist object from JSON API response, or AniList ID
+        :return: decoded AniList metadata
+        :raises ValueError: if the object is malformed
+        """
+        if isinstance(data, int) and not isinstance(data, bool):
+            return cls(id=data, id_mal=None, title_romaji="", title_english=None, synonyms=())
+        try:
+            title = data["title"]
+            return cls(
+                id=int(data["id"]),
+                id_mal=int(data["idMal"]) if data.get("idMal") else None,
+                title_romaji=str(title.get("romaji") or title.get("native") or ""),
+                title_english=str(title["english"]) if title.get("english") else None,
+                synonyms=tuple(str(synonym) for synonym in data.get("synonyms") or ())
+            )
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Malformed anilist object: {e!r}") from e
+
+    def to_json(self) -> dict[str, Any]:
+        """
+        Encode to the shape of the API response
+        :return: anilist object
+        """
+        return {
+            "id": self.id,
+            "idMal": self.id_mal,
+            "title": {"romaji": self.title_romaji, "english": self.title_english},
+            "synonyms": list(self.synonyms)
+        }
+
+
+@dataclass(slots=True, frozen=True)
+class TraceResult:
+    anilist: AnilistInfo
+    filename: str
+    episode: str
+    start: float
+    end: float
+    similarity: float
+    video: str
+    image: str
+
+    @classmethod
+    def from_json(cls, data: Any) -> "TraceResult":
+        """
+        Decode a single search result
+        :param data: result object from JSON API response
+        :return: decoded search result
+        :raises ValueError: if the object is malformed
+        """
+        try:
+            episode = data.get("episode")
+            if isinstance(episode, list):
+                episode = "-".join(str(ep) for ep in episode)
+            return cls(
+                anilist=AnilistInfo.from_json(data["anilist"]),
+                filename=str(data["filename"]),
+                episode=str(episode) if episode else "",
+                start=float(data["from"]),
+                end=float(data["to"]),
+                similarity=float(data["similarity"]),
+                video=str(data["video"]),
+                image=str(data["image"])
+            )
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Malformed search result: {e!r}") from e
+
+    def to_json(self) -> dict[str, Any]:
+        """
+        Encode to the shape of the API response
+        :return: result object
+        """
+        return {
+            "anilist": self.anilist.to_json(),
+            "filename": self.filename,
+            "episode": self.episode,
+            "from": self.start,
+            "to": self.end,
+            "similarity": self.similarity,
+            "video": self.video,
+            "image": self.image
+        }
+
+
+@dataclass(slots=True, frozen=True)
+class SearchResponse:
+    error: str
+    results: tuple[TraceResult, ...]
+
+    @classmethod
+    def from_json(cls, data: Any) -> "SearchResponse":
+        """
+        Decode /search response, dropping the fields the bot doesn't use
+        :param data: JSON API response
+        :return: decoded search response
+        :raises ValueError: if the response is malformed
+        """
+        if not isinstance(data, dict) or not isinstance(data.get("result", []), list):
+            raise ValueError("Malformed search response")
+        return cls(
+            error=str(data.get("error") or ""),
+            results=tuple(TraceResult.from_json(result) for result in data.get("result", []))
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        """
+        Encode to the shape of the API response
+        :return: search response
+        """
+        return {
+            "error": self.error,
+            "result": [result.to_json() for result in self.results]
+        }
+
+
+@dataclass(slots=True, frozen=True)
+class QuotaInfo:
+    priority: int
+    concurrency: int
+    quota: int
+    quota_used: int
+
+    @classmethod
+    def from_json(cls, data: Any) -> "QuotaInfo":
+        """
+        Decode /me response
+        :param data: JSON API response
+        :return: decoded quota information
+        :raises ValueError: if the response is malformed
+        """
+        try:
+            return cls(
+                priority=int(data["priority"]),
+                concurrency=int(data["concurrency"]),
+                quota=int(data["quota"]),
+                quota_used=int(data["quotaUsed"])
+            )
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Malformed quota response: {e!r}") from e
+
+
+@dataclass(slots=True)
+class QuotaState:
+    priority: int = 0
+    concurrency: int = 0
+    quota: int = 0
+    quota_used: int = 0
+    rate_limit: int | None = None
+    rate_remaining: int | None = None
+    rate_reset: int | None = None
+    updated: float = 0.0
+
+    def is_stale(self, ttl: float) -> bool:
+        """
+        Check whether the state should be refreshed from the API
+        :param ttl: maximum age of the state in seconds
+        :return: True if the state was never loaded or is too old
+        """
+        return not self.updated or time.monotonic() - self.updated > ttl
+
+    def update(self, info: QuotaInfo) -> None:
+        """
+        Replace the state with the values reported by /me
+        :param info: decoded /me response
+        """
+        self.priority = info.priority
+        self.concurrency = info.concurrency
+        self.quota = info.quota
+        self.quota_used = info.quota_used
+        self.updated = time.monotonic()
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """
+        Count a search and update the rate limit from /search response headers
+        :param headers: response headers
+        """
+        self.quota_used += 1
+        for attribute, header in (
+            ("rate_limit", "x-ratelimit-limit"),
+            ("rate_remaining", "x-ratelimit-remaining"),
+            ("rate_reset", "x-ratelimit-reset")
+        ):
+            try:
+                setattr(self, attribute, int(headers[header]))
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    @property
+    def quota_remaining(self) -> int:
+        return max(0, self.quota - self.quota_used)
+
+
+@dataclass(slots=True)
+class BackfillCheckpoint:
+    room_id: str
+    since: int
+    token: str = ""
+    thread_id: str = ""
+    traced: int = 0
+    failed: int = 0
@@ -0,0 +1,205 @@
+from mautrix.util.async_db import Connection, Database, UpgradeTable
+
+from .datastructures import BackfillCheckpoint
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Result cache")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE result_cache (
+            key     TEXT PRIMARY KEY,
+            data    BYTEA NOT NULL,
+            hits    INTEGER NOT NULL DEFAULT 0,
+            expires BIGINT NOT NULL
+        )"""
+    )
+    await conn.execute("CREATE INDEX result_cache_hits_idx ON result_cache (hits)")
+
+
+@upgrade_table.register(description="Answered source events")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE answered (
+            room_id  TEXT NOT NULL,
+            source   TEXT NOT NULL,
+            reply_id TEXT NOT NULL,
+            expires  BIGINT NOT NULL,
+            PRIMARY KEY (room_id, source)
+        )"""
+    )
+
+
+@upgrade_table.register(description="Room history trace checkpoints")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE backfill (
+            room_id   TEXT PRIMARY KEY,
+            since     BIGINT NOT NULL,
+            token     TEXT NOT NULL,
+            thread_id TEXT NOT NULL,
+            traced    INTEGER NOT NULL,
+            failed    INTEGER NOT NULL
+        )"""
+    )
+
+
+class ResultStore:
+    """
+    Compressed search results kept in the plugin database
+    """
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+
+    async def get(self, key: str, now: int) -> tuple[bytes, int] | None:
+        """
+        Get a result that hasn't expired yet and count the hit
+        :param key: cache key
+        :param now: current UNIX timestamp
+        :return: compressed result and UNIX timestamp of its expiry
+        """
+        row = await self.db.fetchrow(
+            "SELECT data, expires FROM result_cache WHERE key=$1 AND expires>$2", key, now
+        )
+        if row is None:
+            return None
+        await self.db.execute("UPDATE result_cache SET hits=hits+1 WHERE key=$1", key)
+        return row["data"], row["expires"]
+
+    async def put(self, key: str, data: bytes, expires: int) -> None:
+        """
+        Insert or replace a result
+        :param key: cache key
+        :param data: compressed result
+        :param expires: UNIX timestamp of expiry
+        """
+        await self.db.execute(
+            "INSERT INTO result_cache (key, data, hits, expires) VALUES ($1, $2, 0, $3) "
+            "ON CONFLICT (key) DO UPDATE SET data=excluded.data, expires=excluded.expires",
+            key,
+            data,
+            expires
+        )
+
+    async def delete(self, key: str) -> None:
+        await self.db.execute("DELETE FROM result_cache WHERE key=$1", key)
+
+    async def delete_expired(self, now: int) -> None:
+        await self.db.execute("DELETE FROM result_cache WHERE expires<=$1", now)
+
+    async def count(self) -> int:
+        return await self.db.fetchval("SELECT COUNT(*) FROM result_cache")
+
+    async def victim(self) -> str | None:
+        """
+        Get the eviction candidate - the least used result, oldest first
+        :return: cache key
+        """
+        return await self.db.fetchval(
+            "SELECT key FROM result_cache ORDER BY hits ASC, expires ASC LIMIT 1"
+        )
+
+    async def hottest(self, limit: int, now: int) -> list[tuple[str, bytes, int, int]]:
+        """
+        Get the most used results that haven't expired yet
+        :param limit: maximum number of results
+        :param now: current UNIX timestamp
+        :return: cache keys, compressed results, hit counts and UNIX timestamps of expiry
+        """
+        rows = await self.db.fetch(
+            "SELECT key, data, hits, expires FROM result_cache WHERE expires>$1 "
+            "ORDER BY hits DESC LIMIT $2",
+            now,
+            limit
+        )
+        return [(row["key"], row["data"], row["hits"], row["expires"]) for row in rows]
+
+
+class AnsweredStore:
+    """
+    Replies of the bot to already traced source events
+    """
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+
+    async def get(self, room_id: str, source: str, now: int) -> str | None:
+        """
+        Get the reply to a source event
+        :param room_id: room ID
+        :param source: event ID or URL of traced media
+        :param now: current UNIX timestamp
+        :return: event ID of the reply
+        """
+        return await self.db.fetchval(
+            "SELECT reply_id FROM answered WHERE room_id=$1 AND source=$2 AND expires>$3",
+            room_id,
+            source,
+            now
+        )
+
+    async def put(self, room_id: str, source: str, reply_id: str, expires: int) -> None:
+        """
+        Record the reply to a source event
+        :param room_id: room ID
+        :param source: event ID or URL of traced media
+        :param reply_id: event ID of the reply
+        :param expires: UNIX timestamp of expiry
+        """
+        await self.db.execute(
+            "INSERT INTO answered (room_id, source, reply_id, expires) VALUES ($1, $2, $3, $4) "
+            "ON CONFLICT (room_id, source) DO UPDATE "
+            "SET reply_id=excluded.reply_id, expires=excluded.expires",
+            room_id,
+            source,
+            reply_id,
+            expires
+        )
+
+    async def delete_expired(self, now: int) -> None:
+        await self.db.execute("DELETE FROM answered WHERE expires<=$1", now)
+
+
+class BackfillStore:
+    """
+    Progress of room history traces, so that an interrupted trace can be resumed
+    """
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+
+    async def get(self, room_id: str) -> BackfillCheckpoint | None:
+        row = await self.db.fetchrow(
+            "SELECT room_id, since, token, thread_id, traced, failed "
+            "FROM backfill WHERE room_id=$1",
+            room_id
+        )
+        if row is None:
+            return None
+        return BackfillCheckpoint(
+            room_id=row["room_id"],
+            since=row["since"],
+            token=row["token"],
+            thread_id=row["thread_id"],
+            traced=row["traced"],
+            failed=row["failed"]
+        )
+
+    async def put(self, checkpoint: BackfillCheckpoint) -> None:
+        await self.db.execute(
+            "INSERT INTO backfill (room_id, since, token, thread_id, traced, failed) "
+            "VALUES ($1, $2, $3, $4, $5, $6) "
+            "ON CONFLICT (room_id) DO UPDATE SET since=excluded.since, token=excluded.token, "
+            "thread_id=excluded.thread_id, traced=excluded.traced, failed=excluded.failed",
+            checkpoint.room_id,
+            checkpoint.since,
+            checkpoint.token,
+            checkpoint.thread_id,
+            checkpoint.traced,
+            checkpoint.failed
+        )
+
+    async def delete(self, room_id: str) -> None:
+        await self.db.execute("DELETE FROM backfill WHERE room_id=$1", room_id)
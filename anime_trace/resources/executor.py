@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class PoolFullError(RuntimeError):
+    pass
+
+
+class CPUPool:
+    """
+    Bounded thread pool for image processing. It keeps decoding and re-encoding
+    of images off the default executor shared with the rest of maubot, and rejects
+    new jobs instead of queueing them without limit when the bot is overloaded.
+    """
+
+    def __init__(self, workers: int, max_queue: int) -> None:
+        """
+        :param workers: number of worker threads
+        :param max_queue: maximum number of jobs waiting for a free worker
+        """
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="anime_trace_cpu"
+        )
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of jobs waiting for a free worker
+        """
+        return self.pending - self.running
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run a function in the pool. A job that hasn't started yet is dropped
+        when the awaiting task is cancelled.
+        :param func: function
+        :param args: arguments of the function
+        :return: result of the function
+        :raises PoolFullError: if too many jobs are waiting
+        """
+        with self._lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise PoolFullError(f"CPU pool is full ({self.pending} jobs)")
+            self.pending += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.pending - self.running)
+
+        def job() -> T:
+            with self._lock:
+                self.running += 1
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.pending -= 1
+                    self.completed += 1
+
+        future = self._executor.submit(job)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            with self._lock:
+                self.cancelled += 1
+                # A job that was removed from the queue will never run
+                if future.cancel():
+                    self.pending -= 1
+            raise
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "queued": self.pending - self.running,
+                "max_queued": self.max_queue_depth,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
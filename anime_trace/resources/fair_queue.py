@@ -0,0 +1,179 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class FairQueue:
+    """
+    Weighted fair queue of searches. Rooms take turns in proportion to their weights
+    (deficit round robin), and the senders of a room take turns within its share,
+    so that one busy room or user can't take all searches.
+    """
+
+    def __init__(self, concurrency: int, weights: dict[str, float] | None = None) -> None:
+        """
+        :param concurrency: number of searches running at the same time
+        :param weights: room ID -> weight, rooms that aren't listed have weight 1
+        """
+        self.concurrency = max(1, concurrency)
+        self.weights = weights or {}
+        self.active = 0
+        # Room -> sender -> waiting searches
+        self._rooms: OrderedDict[str, OrderedDict[str, deque[asyncio.Future]]] = OrderedDict()
+        self._credits: dict[str, float] = {}
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for senders in self._rooms.values() for queue in senders.values())
+
+    @asynccontextmanager
+    async def slot(self, room_id: str, sender: str) -> AsyncIterator[None]:
+        """
+        Wait for the turn of the sender in the room
+        :param room_id: room ID
+        :param sender: user ID
+        """
+        await self._acquire(room_id, sender)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, room_id: str, sender: str) -> None:
+        if self.active < self.concurrency and not self._rooms:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        senders = self._rooms.setdefault(room_id, OrderedDict())
+        senders.setdefault(sender, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The turn came together with the cancellation, pass it on
+                self._release()
+            else:
+                self._remove(room_id, sender, waiter)
+            raise
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.active < self.concurrency and self._rooms:
+            waiter = self._next()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.active += 1
+
+    def _next(self) -> asyncio.Future:
+        while True:
+            room_id, senders = next(iter(self._rooms.items()))
+            credit = self._credits.get(room_id, 0.0)
+            if credit < 1:
+                credit += max(0.01, self.weights.get(room_id, 1.0))
+                self._credits[room_id] = credit
+            if credit >= 1:
+                break
+            self._rooms.move_to_end(room_id)
+        self._credits[room_id] -= 1
+        sender, queue = next(iter(senders.items()))
+        waiter = queue.popleft()
+        if queue:
+            senders.move_to_end(sender)
+        else:
+            del senders[sender]
+        if not senders:
+            del self._rooms[room_id]
+            self._credits.pop(room_id, None)
+        elif self._credits[room_id] < 1:
+            self._rooms.move_to_end(room_id)
+        return waiter
+
+    def _remove(self, room_id: str, sender: str, waiter: asyncio.Future) -> None:
+        senders = self._rooms.get(room_id)
+        if not senders or sender not in senders:
+            return
+        queue = senders[sender]
+        if waiter in queue:
+            queue.remove(waiter)
+        if not queue:
+            del senders[sender]
+        if not senders:
+            del self._rooms[room_id]
+            self._credits.pop(room_id, None)
+
+
+class RoomBudgets:
+    """
+    Number of searches and bytes of uploaded media each room may use in a time window
+    """
+
+    def __init__(self, max_requests: int, max_bytes: int, window: float) -> None:
+        """
+        :param max_requests: searches per window, 0 for no limit
+        :param max_bytes: bytes of uploaded media per window, 0 for no limit
+        :param window: length of the window in seconds
+        """
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.window = window
+        # Room -> start of the window, searches and bytes used in it
+        self._usage: dict[str, tuple[float, int, int]] = {}
+
+    def _get_usage(self, room_id: str) -> tuple[float, int, int]:
+        now = time.monotonic()
+        usage = self._usage.get(room_id)
+        if usage is None or now - usage[0] >= self.window:
+            # Forget the rooms whose windows are over, so that the usage doesn't grow forever
+            self._usage = {
+                room: usage for room, usage in self._usage.items() if now - usage[0] < self.window
+            }
+            usage = (now, 0, 0)
+        return usage
+
+    def check(self, room_id: str, size: int = 0) -> float:
+        """
+        Check whether a search fits in the budget of the room
+        :param room_id: room ID
+        :param size: bytes of media to upload
+        :return: 0 if it fits, otherwise seconds until the budget is renewed
+        """
+        start, requests, used_bytes = self._get_usage(room_id)
+        # The first media of a window is allowed even if it's bigger than the whole budget
+        if (self.max_requests and requests >= self.max_requests) or \
+                (self.max_bytes and used_bytes and used_bytes + size > self.max_bytes):
+            return max(0.0, start + self.window - time.monotonic())
+        return 0
+
+    def reserve(self, room_id: str, size: int = 0) -> float:
+        """
+        Count a search against the budget of the room if it fits, before it waits for its turn,
+        so that searches queued at the same time can't overdraw the budget together
+        :param room_id: room ID
+        :param size: bytes of media to upload
+        :return: 0 if the search was counted, otherwise seconds until the budget is renewed
+        """
+        wait = self.check(room_id, size)
+        if not wait:
+            start, requests, used_bytes = self._get_usage(room_id)
+            self._usage[room_id] = (start, requests + 1, used_bytes + size)
+        return wait
+
+    def release(self, room_id: str, size: int, reserved: float) -> None:
+        """
+        Give back a reservation of a search that never ran
+        :param room_id: room ID
+        :param size: reserved bytes
+        :param reserved: time.monotonic() taken right after the reservation
+        """
+        usage = self._usage.get(room_id)
+        # A reservation from an earlier window ended with it
+        if usage is None or usage[0] > reserved:
+            return
+        start, requests, used_bytes = usage
+        self._usage[room_id] = (start, max(0, requests - 1), max(0, used_bytes - size))
@@ -0,0 +1,99 @@
+from dataclasses import dataclass, field
+
+from .cache import TTLCache
+
+REMOTE = "remote"
+LOCAL = "local"
+
+
+@dataclass(slots=True)
+class FetchStats:
+    latency: float = 0.0
+    failure_rate: float = 0.0
+    samples: int = 0
+
+    def record(self, latency: float, failed: bool, alpha: float) -> None:
+        """
+        Add a measurement to the moving averages
+        :param latency: duration of the search in seconds
+        :param failed: whether the search failed
+        :param alpha: weight of the new measurement
+        """
+        if not self.samples:
+            self.latency = latency
+            self.failure_rate = float(failed)
+        else:
+            self.latency += alpha * (latency - self.latency)
+            self.failure_rate += alpha * (float(failed) - self.failure_rate)
+        self.samples += 1
+
+    def cost(self, failure_penalty: float) -> float:
+        return self.latency + self.failure_rate * failure_penalty
+
+
+@dataclass(slots=True)
+class HostStats:
+    strategies: dict[str, FetchStats] = field(
+        default_factory=lambda: {REMOTE: FetchStats(), LOCAL: FetchStats()}
+    )
+    searches: int = 0
+
+
+class FetchStrategySelector:
+    """
+    Chooses per host whether trace.moe fetches an external link itself (remote),
+    or the bot downloads it and uploads the file (local), based on the recorded
+    latency and failure rate of both ways
+    """
+
+    alpha = 0.3
+    min_samples = 2
+    explore_every = 20
+
+    def __init__(self, max_hosts: int, ttl: float, failure_penalty: float = 10.0) -> None:
+        """
+        :param max_hosts: maximum number of hosts with recorded statistics
+        :param ttl: time after which statistics of a host are forgotten
+        :param failure_penalty: seconds added to the cost of a strategy that always fails
+        """
+        self.failure_penalty = failure_penalty
+        self._hosts = TTLCache(max_hosts, ttl)
+
+    def choose(self, host: str) -> str:
+        """
+        Get the strategy for a host. Both strategies are tried a few times first,
+        and the worse one is retried now and then in case the host changed.
+        :param host: host name
+        :return: REMOTE or LOCAL
+        """
+        stats = self._hosts.get(host)
+        if stats is None:
+            return REMOTE
+        for strategy in (REMOTE, LOCAL):
+            if stats.strategies[strategy].samples < self.min_samples:
+                return strategy
+        ranked = sorted(
+            (REMOTE, LOCAL),
+            key=lambda strategy: stats.strategies[strategy].cost(self.failure_penalty)
+        )
+        if stats.searches % self.explore_every == 0:
+            return ranked[1]
+        return ranked[0]
+
+    def record(self, host: str, strategy: str, latency: float, failed: bool) -> None:
+        """
+        Record the outcome of a search
+        :param host: host name
+        :param strategy: REMOTE or LOCAL
+        :param latency: duration of the search in seconds
+        :param failed: whether the search failed
+        """
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = HostStats()
+            self._hosts.set(host, stats)
+        stats.strategies[strategy].record(latency, failed, self.alpha)
+        stats.searches += 1
+
+    def stats(self, host: str) -> HostStats | None:
+        return self._hosts.get(host)
@@ -0,0 +1,56 @@
+import math
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    Decides when a slow preview download gets a second, speculative request:
+    after the 90th percentile of recent response times, and only while the extra
+    requests stay within a share of all requests
+    """
+
+    min_samples = 20
+    percentile = 0.9
+    max_tokens = 10.0
+
+    def __init__(self, ratio: float, window: int = 200) -> None:
+        """
+        :param ratio: allowed number of extra requests per request
+        :param window: number of recent response times the percentile is computed from
+        """
+        self.ratio = ratio
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._tokens = 0.0
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, latency: float) -> None:
+        """
+        Record how long a request took to return the response headers
+        :param latency: time in seconds
+        """
+        self._latencies.append(latency)
+
+    def delay(self) -> float | None:
+        """
+        Count a request and get the delay after which it's hedged
+        :return: delay in seconds, None if there are too few measurements to hedge
+        """
+        self.requests += 1
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+        if len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, math.ceil(self.percentile * len(latencies)) - 1)]
+
+    def take(self) -> bool:
+        """
+        Take the budget for an extra request
+        :return: True if the extra request may be sent
+        """
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        self.hedged += 1
+        return True
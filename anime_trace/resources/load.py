@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+from typing import Iterator
+
+# Degradation levels, each one includes the ones before it
+FULL = 0
+NO_PREVIEW = 1
+FEWER_RESULTS = 2
+BUSY = 3
+
+
+class LoadMonitor:
+    """
+    Counts the commands in progress and the bytes of media held in memory,
+    and decides how much the replies should be degraded to keep up with the load
+    """
+
+    def __init__(self) -> None:
+        self.commands = 0
+        self.bytes = 0
+        # Level -> number of commands handled at that level
+        self.shed = {FULL: 0, NO_PREVIEW: 0, FEWER_RESULTS: 0, BUSY: 0}
+
+    @contextmanager
+    def command(self, weight: int = 1) -> Iterator[None]:
+        """
+        Count a command as in progress
+        :param weight: number of media traced by the command
+        """
+        self.commands += weight
+        try:
+            yield
+        finally:
+            self.commands -= weight
+
+    @contextmanager
+    def hold(self, size: int) -> Iterator[None]:
+        """
+        Count media as held in memory
+        :param size: size of the media in bytes
+        """
+        self.bytes += size
+        try:
+            yield
+        finally:
+            self.bytes -= size
+
+    def level(
+        self,
+        max_commands: int,
+        max_bytes: int,
+        min_quota: int,
+        quota_remaining: int | None
+    ) -> int:
+        """
+        Get the degradation level. Each limit is where degradation starts: at the limit
+        video previews are dropped, at 1.5 times the limit fewer results are shown,
+        and at twice the limit new commands are rejected. Limits set to 0 are disabled.
+        :param max_commands: limit of commands in progress
+        :param max_bytes: limit of bytes of media held in memory
+        :param min_quota: remaining search quota below which degradation starts,
+         it grows as the quota drops
+        :param quota_remaining: remaining search quota, None if unknown
+        :return: FULL, NO_PREVIEW, FEWER_RESULTS or BUSY
+        """
+        pressure = 0.0
+        if max_commands:
+            pressure = max(pressure, self.commands / max_commands)
+        if max_bytes:
+            pressure = max(pressure, self.bytes / max_bytes)
+        if min_quota and quota_remaining is not None:
+            pressure = max(pressure, min_quota / max(quota_remaining, 1))
+        if pressure >= 2:
+            level = BUSY
+        elif pressure >= 1.5:
+            level = FEWER_RESULTS
+        elif pressure >= 1:
+            level = NO_PREVIEW
+        else:
+            level = FULL
+        self.shed[level] += 1
+        return level
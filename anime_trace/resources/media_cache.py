@@ -0,0 +1,117 @@
+import asyncio
+import os
+import re
+import tempfile
+import threading
+import time
+from hashlib import sha256
+
+# Cached files are named by the SHA-256 of their content URI, other files are never touched
+_CACHE_NAME = re.compile(r"[0-9a-f]{64}")
+
+
+class MediaDiskCache:
+    """
+    Size-bounded directory of downloaded Matrix media, evicting the least recently used files
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """
+        :param directory: cache directory, created if it doesn't exist.
+         Only files named like cache entries are indexed and evicted.
+        :param max_bytes: maximum total size of cached files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # File name -> (size, last access time)
+        self._index: dict[str, tuple[int, float]] = {}
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and _CACHE_NAME.fullmatch(entry.name):
+                    stat = entry.stat()
+                    self._index[entry.name] = (stat.st_size, stat.st_mtime)
+                    self._total += stat.st_size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _name(mxc: str) -> str:
+        return sha256(mxc.encode()).hexdigest()
+
+    async def get(self, mxc: str) -> bytes | None:
+        """
+        Read a cached file
+        :param mxc: matrix content URI
+        :return: file content
+        """
+        name = self._name(mxc)
+        if name not in self._index:
+            return None
+        return await asyncio.to_thread(self._read, name)
+
+    async def put(self, mxc: str, data: bytes) -> None:
+        """
+        Store a file, evicting the least recently used ones if the cache is full
+        :param mxc: matrix content URI
+        :param data: file content
+        """
+        if len(data) > self.max_bytes:
+            return
+        await asyncio.to_thread(self._write, self._name(mxc), data)
+
+    def _read(self, name: str) -> bytes | None:
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            now = time.time()
+            os.utime(path, (now, now))
+        except OSError:
+            with self._lock:
+                self._forget(name)
+            return None
+        with self._lock:
+            if name in self._index:
+                self._index[name] = (self._index[name][0], now)
+        return data
+
+    def _write(self, name: str, data: bytes) -> None:
+        # Write to a temporary file first, so that readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self._forget(name)
+            self._index[name] = (len(data), time.time())
+            self._total += len(data)
+            self._evict()
+
+    def _forget(self, name: str) -> None:
+        item = self._index.pop(name, None)
+        if item:
+            self._total -= item[0]
+
+    def _evict(self) -> None:
+        if self._total <= self.max_bytes:
+            return
+        for name, _ in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self._total <= self.max_bytes:
+                break
+            self._forget(name)
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    @property
+    def size(self) -> int:
+        return self._total
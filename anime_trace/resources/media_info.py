@@ -0,0 +1,142 @@
+from typing import Iterator
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Start of frame markers, the others of the 0xC0-0xCF range are DHT, JPG and DAC
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_JPEG_STANDALONE = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+
+def _uint(data: bytes, start: int, length: int, byteorder: str = "big") -> int:
+    return int.from_bytes(data[start:start + length], byteorder)
+
+
+def image_dimensions(data: bytes) -> tuple[int, int] | None:
+    """
+    Read the dimensions of a PNG, GIF, WebP or JPEG image from its header,
+    without decoding the image
+    :param data: image data
+    :return: width and height, or None if the header couldn't be read
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        return None
+    dimensions = None
+    if data.startswith(_PNG_SIGNATURE) and data[12:16] == b"IHDR" and len(data) >= 24:
+        dimensions = _uint(data, 16, 4), _uint(data, 20, 4)
+    elif data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        dimensions = _uint(data, 6, 2, "little"), _uint(data, 8, 2, "little")
+    elif data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        dimensions = _webp_dimensions(data)
+    elif data[:2] == b"\xff\xd8":
+        dimensions = _jpeg_dimensions(data)
+    if not dimensions or not all(dimensions):
+        return None
+    return dimensions
+
+
+def _webp_dimensions(data: bytes) -> tuple[int, int] | None:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+        return _uint(data, 26, 2, "little") & 0x3FFF, _uint(data, 28, 2, "little") & 0x3FFF
+    if chunk == b"VP8L" and data[20] == 0x2F:
+        bits = _uint(data, 21, 4, "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        return _uint(data, 24, 3, "little") + 1, _uint(data, 27, 3, "little") + 1
+    return None
+
+
+def _jpeg_dimensions(data: bytes) -> tuple[int, int] | None:
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker in _JPEG_STANDALONE:
+            i += 2
+            continue
+        if marker in _JPEG_SOF:
+            if i + 9 > len(data):
+                return None
+            return _uint(data, i + 7, 2), _uint(data, i + 5, 2)
+        if marker == 0xDA:
+            # Start of scan, the frame header should have come before
+            return None
+        i += 2 + _uint(data, i + 2, 2)
+    return None
+
+
+def _mp4_boxes(data: bytes, start: int, end: int) -> Iterator[tuple[bytes, int, int]]:
+    """
+    Iterate over ISO BMFF boxes
+    :param data: file data
+    :param start: offset of the first box
+    :param end: end offset of the boxes
+    :return: box types, start and end offsets of box contents
+    """
+    while start + 8 <= end:
+        size = _uint(data, start, 4)
+        kind = data[start + 4:start + 8]
+        header = 8
+        if size == 1:
+            size = _uint(data, start + 8, 8)
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header or start + size > end:
+            return
+        yield kind, start + header, start + size
+        start += size
+
+
+def video_info(data: bytes) -> tuple[int, int, int | None] | None:
+    """
+    Read the dimensions and duration of an MP4 video from its moov box
+    :param data: video data
+    :return: width, height and duration in milliseconds, or None if the moov box couldn't be read.
+     The duration is None if the moov box doesn't have it, e.g. in fragmented videos.
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        return None
+    try:
+        for kind, start, end in _mp4_boxes(data, 0, len(data)):
+            if kind == b"moov":
+                return _moov_info(data, start, end)
+    except IndexError:
+        return None
+    return None
+
+
+def _moov_info(data: bytes, start: int, end: int) -> tuple[int, int, int | None] | None:
+    duration = None
+    width = height = 0
+    for kind, box_start, box_end in _mp4_boxes(data, start, end):
+        if kind == b"mvhd":
+            # Version 1 has 64-bit creation time, modification time and duration
+            if box_start + 32 > box_end:
+                return None
+            if data[box_start] == 1:
+                timescale = _uint(data, box_start + 20, 4)
+                length = _uint(data, box_start + 24, 8)
+            else:
+                timescale = _uint(data, box_start + 12, 4)
+                length = _uint(data, box_start + 16, 4)
+            # Fragmented videos written to a pipe have an empty moov box with zero duration,
+            # some writers use all ones for an unknown duration instead
+            if timescale and length and length != (1 << (64 if data[box_start] == 1 else 32)) - 1:
+                duration = length * 1000 // timescale
+        elif kind == b"trak" and not width:
+            for track_kind, track_start, track_end in _mp4_boxes(data, box_start, box_end):
+                if track_kind == b"tkhd":
+                    offset = track_start + (88 if data[track_start] == 1 else 76)
+                    if offset + 8 > track_end:
+                        return None
+                    # 16.16 fixed point numbers, audio tracks have zero size
+                    width = _uint(data, offset, 4) >> 16
+                    height = _uint(data, offset + 4, 4) >> 16
+    if not width or not height:
+        return None
+    return width, height, duration
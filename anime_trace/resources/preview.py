@@ -0,0 +1,105 @@
+from typing import Any, AsyncIterator
+
+
+PREVIEW_SIZES = ("s", "m", "l")
+
+
+class PreviewSizer:
+    """
+    Picks the size of video previews from the measured throughput of recent preview
+    downloads and uploads, so that sending a preview fits in the latency budget
+    """
+
+    alpha = 0.3
+    # Typical size of a video preview with its thumbnail, until the real sizes are measured
+    default_bytes = {"s": 150_000, "m": 400_000, "l": 1_200_000}
+
+    def __init__(self) -> None:
+        # Bytes per second
+        self.throughput = 0.0
+        self.samples = 0
+        self.preview_bytes = dict(self.default_bytes)
+
+    def record_transfer(self, size: int, seconds: float) -> None:
+        """
+        Add a preview download or upload to the moving average of throughput
+        :param size: transferred bytes
+        :param seconds: duration of the transfer
+        """
+        if size <= 0 or seconds <= 0:
+            return
+        throughput = size / seconds
+        if not self.samples:
+            self.throughput = throughput
+        else:
+            self.throughput += self.alpha * (throughput - self.throughput)
+        self.samples += 1
+
+    def record_preview(self, preview_size: str, size: int) -> None:
+        """
+        Add the size of a downloaded preview to the moving average of its preview size
+        :param preview_size: "s", "m" or "l"
+        :param size: bytes of the video preview and its thumbnail
+        """
+        if size > 0:
+            average = self.preview_bytes[preview_size]
+            self.preview_bytes[preview_size] = average + self.alpha * (size - average)
+
+    def choose(self, max_size: str, budget: float, commands: int) -> str:
+        """
+        Get the largest preview size, up to the configured one, that can be downloaded
+        and uploaded within the latency budget. The throughput is shared by all commands
+        in progress.
+        :param max_size: configured preview size
+        :param budget: latency budget in seconds
+        :param commands: number of commands in progress
+        :return: "s", "m" or "l"
+        """
+        if not self.samples or budget <= 0:
+            return max_size
+        throughput = self.throughput / max(1, commands)
+        sizes = PREVIEW_SIZES[:PREVIEW_SIZES.index(max_size) + 1]
+        for size in reversed(sizes):
+            # Every preview is downloaded from the API and uploaded to the Matrix server
+            if 2 * self.preview_bytes[size] / throughput <= budget:
+                return size
+        return PREVIEW_SIZES[0]
+
+
+class PreviewStream:
+    """
+    Body of a preview response that is passed on to the Matrix upload chunk by chunk,
+    instead of being read into memory first. The beginning of the body is kept,
+    it's enough to read the dimensions of a video whose moov box comes first.
+    """
+
+    chunk_size = 64 * 1024
+    head_size = 64 * 1024
+
+    def __init__(self, response: Any, size: int) -> None:
+        """
+        :param response: response whose body hasn't been read yet
+        :param size: length of the body from the Content-Length header
+        """
+        self.response = response
+        self.size = size
+        self.head = bytearray()
+
+    def __len__(self) -> int:
+        return self.size
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """
+        Read the body
+        :return: chunks of the body
+        """
+        async for chunk in self.response.content.iter_chunked(self.chunk_size):
+            if len(self.head) < self.head_size:
+                self.head += chunk[:self.head_size - len(self.head)]
+            yield chunk
+
+    def close(self) -> None:
+        """
+        Release the connection, it's closed if the body wasn't read to the end
+        """
+        self.response.release()
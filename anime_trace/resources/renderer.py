@@ -0,0 +1,263 @@
+from html import escape
+from typing import Tuple
+
+from .datastructures import TraceResult
+
+# Every section is rendered to HTML and Markdown in the same call, so the result list
+# is walked only once per reply. The templates are f-strings, compiled together with
+# the module, and values shared by both formats are computed only once.
+_OTHER_HEADER_HTML = "<p><details><summary><b>Other results:</b></summary>"
+_OTHER_HEADER_MD = "> **Other results:**  \n"
+_OTHER_FOOTER_HTML = "</details></p>"
+
+_HEADER_HTML = "<blockquote>"
+_FOOTER_HTML = "<p><b><sub>Results from trace.moe</sub></b></p></blockquote>"
+_FOOTER_MD = "> **Results from trace.moe**"
+
+_MD_SPECIAL = ("\\", "*", "_", "`", "[", "]")
+
+
+def escape_md(text: str) -> str:
+    """
+    Escape characters that have a special meaning in Markdown
+    :param text: raw text
+    :return: escaped text
+    """
+    for char in _MD_SPECIAL:
+        if char in text:
+            text = text.replace(char, "\\" + char)
+    return text
+
+
+def format_time(seconds: float) -> str:
+    """
+    Format a timestamp in seconds as HH:MM:SS
+    :param seconds: timestamp in seconds
+    :return: formatted timestamp
+    """
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02}:{minutes:02}:{secs:02}"
+
+
+def render_link(url: str, text: str) -> Tuple[str, str]:
+    """
+    Render a link
+    :param url: address
+    :param text: displayed text
+    :return: HTML and Markdown link
+    """
+    return f"<a href=\"{escape(url)}\">{escape(text)}</a>", f"[{escape_md(text)}]({url})"
+
+
+def render_titles(title_ro: str, title_en: str, al_id: int) -> Tuple[str, str]:
+    """
+    Render title section of formatted message
+    :param title_ro: Romaji title
+    :param title_en: English title
+    :param al_id: AniList ID
+    :return: HTML and Markdown title section
+    """
+    url = f"https://anilist.co/anime/{al_id}"
+    html = f"<a href=\"{url}\"><h3>{escape(title_ro)}</h3></a>"
+    body = f"> ### [{escape_md(title_ro)}]({url})  \n>  \n"
+    if title_en:
+        html += f"<blockquote><b>English title:</b> {escape(title_en)}</blockquote>"
+        body += f"> > **English title:** {escape_md(title_en)}  \n>  \n"
+    return html, body
+
+
+def render_al_mal_links(al_id: int, mal_id: int) -> Tuple[str, str]:
+    """
+    Render links section of formatted message
+    :param al_id: AniList ID
+    :param mal_id: MyAnimeList ID
+    :return: HTML and Markdown links section
+    """
+    if not mal_id:
+        return "", ""
+    al_url = f"https://anilist.co/anime/{al_id}"
+    mal_url = f"https://myanimelist.net/anime/{mal_id}"
+    return (
+        "<blockquote>"
+        f"<a href=\"{al_url}\">AniList</a>, "
+        f"<a href=\"{mal_url}\">MyAnimeList</a>"
+        "</blockquote>",
+        f"> > [AniList]({al_url}), [MyAnimeList]({mal_url})  \n>  \n"
+    )
+
+
+def render_alternative_titles(synonyms: tuple[str, ...]) -> Tuple[str, str]:
+    """
+    Render alternative titles
+    :param synonyms: list of synonyms
+    :return: HTML and Markdown alternative titles
+    """
+    if not synonyms:
+        return "", ""
+    joined = ", ".join(synonyms)
+    return (
+        f"<blockquote><b>Alternative titles:</b> {escape(joined)}</blockquote>",
+        f"> > **Alternative titles:** {escape_md(joined)}  \n>  \n"
+    )
+
+
+def render_match_data(result: TraceResult) -> Tuple[str, str]:
+    """
+    Render metadata of the main result
+    :param result: search result
+    :return: HTML and Markdown metadata for the main result
+    """
+    episode = result.episode or "-"
+    similarity = f"{(result.similarity * 100):.2f}"
+    time = f"{format_time(result.start)} - {format_time(result.end)}"
+    return (
+        f"<blockquote><b>Similarity:</b> {similarity}%</blockquote>"
+        f"<blockquote><b>Filename:</b> {escape(result.filename)}</blockquote>"
+        f"<blockquote><b>Episode:</b> {escape(episode)}</blockquote>"
+        f"<blockquote><b>Time:</b> {time}</blockquote>",
+        f"> > **Similarity:** {similarity}%  \n>  \n"
+        f"> > **Filename:** {escape_md(result.filename)}  \n>  \n"
+        f"> > **Episode:** {escape_md(episode)}  \n>  \n"
+        f"> > **Time:** {time}  \n>  \n"
+    )
+
+
+def render_other_result(result: TraceResult, number: int) -> Tuple[str, str]:
+    """
+    Render data of one of the other results
+    :param result: search result
+    :param number: number of the result
+    :return: HTML and Markdown data for the given result
+    """
+    anilist = result.anilist
+    title = anilist.title_english or anilist.title_romaji
+    al_url = f"https://anilist.co/anime/{anilist.id}"
+    mal_html = ""
+    mal_md = ""
+    if anilist.id_mal:
+        mal_url = f"https://myanimelist.net/anime/{anilist.id_mal}"
+        mal_html = f" (<a href=\"{mal_url}\">MAL</a>)"
+        mal_md = f" ([MAL]({mal_url}))"
+    episode_html = ""
+    episode_md = ""
+    if result.episode:
+        episode_html = f" <b>Ep:</b> {escape(result.episode)},"
+        episode_md = f" **Ep:** {escape_md(result.episode)},"
+    similarity = f"{(result.similarity * 100):.2f}"
+    time = f"{format_time(result.start)} - {format_time(result.end)}"
+    return (
+        "<blockquote>"
+        f"{number}. <a href=\"{al_url}\">{escape(title)}</a>{mal_html}"
+        f" <b>S:</b> {similarity}%,{episode_html}"
+        f" <b>T:</b> {time}"
+        "</blockquote>",
+        f"> > {number}. [{escape_md(title)}]({al_url}){mal_md}"
+        f" **S:** {similarity}%,{episode_md}"
+        f" **T:** {time}  \n>  \n"
+    )
+
+
+def render_results(results: tuple[TraceResult, ...], max_results: int) -> Tuple[str, str]:
+    """
+    Render the whole reply for a list of search results in a single pass
+    :param results: search results, best match first
+    :param max_results: maximum number of displayed results
+    :return: HTML and Markdown message body
+    """
+    if not results:
+        return "", ""
+    result = results[0]
+    anilist = result.anilist
+    html = [_HEADER_HTML]
+    body = []
+    for section_html, section_body in (
+        render_titles(anilist.title_romaji, anilist.title_english, anilist.id),
+        render_al_mal_links(anilist.id, anilist.id_mal),
+        render_alternative_titles(anilist.synonyms),
+        render_match_data(result)
+    ):
+        html.append(section_html)
+        body.append(section_body)
+
+    end = min(max_results, len(results))
+    if end > 1:
+        html.append(_OTHER_HEADER_HTML)
+        body.append(_OTHER_HEADER_MD)
+        for i in range(1, end):
+            section_html, section_body = render_other_result(results[i], i)
+            html.append(section_html)
+            body.append(section_body)
+        html.append(_OTHER_FOOTER_HTML)
+
+    html.append(_FOOTER_HTML)
+    body.append(_FOOTER_MD)
+    return "".join(html), "".join(body)
+
+
+def render_batch(entries: list[TraceResult | str], skipped: int) -> Tuple[str, str]:
+    """
+    Render one reply for several traced media, with the best match of each
+    :param entries: best match, or the reason why there is none, of every media in order
+    :param skipped: number of media left out because of the batch size limit
+    :return: HTML and Markdown message body
+    """
+    html = [_HEADER_HTML]
+    body = []
+    for number, entry in enumerate(entries, 1):
+        if isinstance(entry, TraceResult):
+            section_html, section_body = render_other_result(entry, number)
+        else:
+            section_html = f"<blockquote>{number}. {escape(entry)}</blockquote>"
+            section_body = f"> > {number}. {escape_md(entry)}  \n>  \n"
+        html.append(section_html)
+        body.append(section_body)
+    if skipped:
+        html.append(f"<p>{skipped} more not traced, the limit is {len(entries)} per command.</p>")
+        body.append(f"> {skipped} more not traced, the limit is {len(entries)} per command.  \n")
+    html.append(_FOOTER_HTML)
+    body.append(_FOOTER_MD)
+    return "".join(html), "".join(body)
+
+
+def render_history_entry(link: str, entry: TraceResult | str) -> Tuple[str, str]:
+    """
+    Render the best match of one media of a room history trace
+    :param link: link to the traced message
+    :param entry: best match, or the reason why there is none
+    :return: HTML and Markdown message body
+    """
+    link_html, link_body = render_link(link, link)
+    if isinstance(entry, TraceResult):
+        html, body = render_results((entry,), 1)
+        return f"<p>{link_html}</p>{html}", f"{link_body}  \n{body}"
+    return (
+        f"<p>{link_html}</p><blockquote>{escape(entry)}</blockquote>",
+        f"{link_body}  \n> {escape_md(entry)}"
+    )
+
+
+def render_history_summary(entries: list[tuple[str, TraceResult | str]]) -> Tuple[str, str]:
+    """
+    Render the summary of a room history trace, one line per traced media
+    :param entries: links to the traced messages, with the best match
+     or the reason why there is none
+    :return: HTML and Markdown message body
+    """
+    html = [_HEADER_HTML]
+    body = []
+    for number, (link, entry) in enumerate(entries, 1):
+        if isinstance(entry, TraceResult):
+            anilist = entry.anilist
+            title = anilist.title_english or anilist.title_romaji
+            episode = f" ep. {entry.episode}," if entry.episode else ""
+            text = f"{title},{episode} {format_time(entry.start)}, {entry.similarity * 100:.2f}%"
+        else:
+            text = entry
+        html.append(
+            f"<blockquote><a href=\"{escape(link)}\">{number}.</a> {escape(text)}</blockquote>"
+        )
+        body.append(f"> > [{number}.]({link}) {escape_md(text)}  \n>  \n")
+    html.append(_FOOTER_HTML)
+    body.append(_FOOTER_MD)
+    return "".join(html), "".join(body)
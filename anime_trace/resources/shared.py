@@ -0,0 +1,298 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+
+class SharedBackend(ABC):
+    """
+    State shared by all bot instances that use the same trace.moe API key:
+    cached results, single-flight locks, concurrency slots and the quota counter.
+    """
+
+    poll_interval = 0.2
+
+    @abstractmethod
+    async def get_result(self, key: str) -> bytes | None:
+        """
+        Get a cached result
+        :param key: cache key
+        :return: compressed result
+        """
+
+    @abstractmethod
+    async def set_result(self, key: str, data: bytes, ttl: int) -> None:
+        """
+        Store a result
+        :param key: cache key
+        :param data: compressed result
+        :param ttl: time to live in seconds
+        """
+
+    @abstractmethod
+    async def try_lock(self, key: str, owner: str, ttl: int) -> bool:
+        """
+        Try to acquire a lock
+        :param key: lock name
+        :param owner: unique ID of the holder
+        :param ttl: time after which the lock is released even if the holder died
+        :return: True if the lock was acquired
+        """
+
+    @abstractmethod
+    async def unlock(self, key: str, owner: str) -> None:
+        """
+        Release a lock if it's still held by the owner
+        :param key: lock name
+        :param owner: unique ID of the holder
+        """
+
+    @abstractmethod
+    async def try_acquire_slot(self, owner: str, concurrency: int, ttl: int) -> bool:
+        """
+        Try to take one of the concurrent search slots
+        :param owner: unique ID of the holder
+        :param concurrency: number of slots, 0 means unlimited
+        :param ttl: time after which the slot is released even if the holder died
+        :return: True if a slot was taken
+        """
+
+    @abstractmethod
+    async def release_slot(self, owner: str) -> None:
+        """
+        Give back a search slot
+        :param owner: unique ID of the holder
+        """
+
+    @abstractmethod
+    async def take_quota(self) -> bool:
+        """
+        Take one search from the quota bucket
+        :return: True if the quota wasn't exhausted
+        """
+
+    @abstractmethod
+    async def sync_quota(self, quota: int, quota_used: int) -> None:
+        """
+        Update the quota bucket with the values reported by the API.
+        The API is the source of truth, it also resets the quota at the start of a period.
+        :param quota: search quota
+        :param quota_used: searches used so far
+        """
+
+    async def lock(self, key: str, owner: str, ttl: int, timeout: float) -> bool:
+        """
+        Wait for a lock
+        :param key: lock name
+        :param owner: unique ID of the holder
+        :param ttl: time after which the lock is released even if the holder died
+        :param timeout: maximum waiting time in seconds
+        :return: True if the lock was acquired
+        """
+        deadline = time.monotonic() + timeout
+        while not await self.try_lock(key, owner, ttl):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_interval)
+        return True
+
+    async def acquire_slot(self, owner: str, concurrency: int, ttl: int, timeout: float) -> bool:
+        """
+        Wait for a search slot
+        :param owner: unique ID of the holder
+        :param concurrency: number of slots, 0 means unlimited
+        :param ttl: time after which the slot is released even if the holder died
+        :param timeout: maximum waiting time in seconds
+        :return: True if a slot was taken
+        """
+        deadline = time.monotonic() + timeout
+        while not await self.try_acquire_slot(owner, concurrency, ttl):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_interval)
+        return True
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalBackend(SharedBackend):
+    """
+    Backend that keeps the state in memory of a single bot instance
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self) -> None:
+        self._results: dict[str, tuple[float, bytes]] = {}
+        self._locks: dict[str, tuple[float, str]] = {}
+        self._slots: dict[str, float] = {}
+        self._quota = 0
+        self._quota_used = 0
+
+    async def get_result(self, key: str) -> bytes | None:
+        item = self._results.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.time():
+            del self._results[key]
+            return None
+        return item[1]
+
+    async def set_result(self, key: str, data: bytes, ttl: int) -> None:
+        self._results[key] = (time.time() + ttl, data)
+
+    async def try_lock(self, key: str, owner: str, ttl: int) -> bool:
+        now = time.time()
+        holder = self._locks.get(key)
+        if holder and holder[0] > now and holder[1] != owner:
+            return False
+        self._locks[key] = (now + ttl, owner)
+        return True
+
+    async def unlock(self, key: str, owner: str) -> None:
+        holder = self._locks.get(key)
+        if holder and holder[1] == owner:
+            del self._locks[key]
+
+    async def try_acquire_slot(self, owner: str, concurrency: int, ttl: int) -> bool:
+        now = time.time()
+        self._slots = {slot: expires for slot, expires in self._slots.items() if expires > now}
+        if concurrency and len(self._slots) >= concurrency:
+            return False
+        self._slots[owner] = now + ttl
+        return True
+
+    async def release_slot(self, owner: str) -> None:
+        self._slots.pop(owner, None)
+
+    async def take_quota(self) -> bool:
+        if self._quota and self._quota_used >= self._quota:
+            return False
+        self._quota_used += 1
+        return True
+
+    async def sync_quota(self, quota: int, quota_used: int) -> None:
+        self._quota = quota
+        self._quota_used = quota_used
+
+
+class SQLiteBackend(SharedBackend):
+    """
+    Backend that keeps the state in an SQLite file shared by bot instances on one host
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: path to the database file
+        """
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._mutex = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS shared_result (
+                key TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shared_lock (
+                key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shared_slot (
+                owner TEXT PRIMARY KEY, expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shared_quota (
+                id INTEGER PRIMARY KEY CHECK (id = 0), quota INTEGER NOT NULL, used INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO shared_quota (id, quota, used) VALUES (0, 0, 0);
+            """
+        )
+
+    async def _run(self, func, *args):
+        return await asyncio.to_thread(self._transaction, func, *args)
+
+    def _transaction(self, func, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write
+        # sequences are atomic across processes
+        with self._mutex:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    async def get_result(self, key: str) -> bytes | None:
+        def get() -> bytes | None:
+            row = self._conn.execute(
+                "SELECT data FROM shared_result WHERE key=? AND expires>?", (key, time.time())
+            ).fetchone()
+            return row[0] if row else None
+        return await self._run(get)
+
+    async def set_result(self, key: str, data: bytes, ttl: int) -> None:
+        def put() -> None:
+            now = time.time()
+            self._conn.execute("DELETE FROM shared_result WHERE expires<=?", (now,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO shared_result (key, data, expires) VALUES (?, ?, ?)",
+                (key, data, now + ttl)
+            )
+        await self._run(put)
+
+    async def try_lock(self, key: str, owner: str, ttl: int) -> bool:
+        def lock() -> bool:
+            now = time.time()
+            self._conn.execute(
+                "DELETE FROM shared_lock WHERE key=? AND (expires<=? OR owner=?)", (key, now, owner)
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO shared_lock (key, owner, expires) VALUES (?, ?, ?)",
+                (key, owner, now + ttl)
+            )
+            return cursor.rowcount == 1
+        return await self._run(lock)
+
+    async def unlock(self, key: str, owner: str) -> None:
+        def unlock() -> None:
+            self._conn.execute("DELETE FROM shared_lock WHERE key=? AND owner=?", (key, owner))
+        await self._run(unlock)
+
+    async def try_acquire_slot(self, owner: str, concurrency: int, ttl: int) -> bool:
+        def acquire() -> bool:
+            now = time.time()
+            self._conn.execute("DELETE FROM shared_slot WHERE expires<=?", (now,))
+            taken = self._conn.execute("SELECT COUNT(*) FROM shared_slot").fetchone()[0]
+            if concurrency and taken >= concurrency:
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO shared_slot (owner, expires) VALUES (?, ?)", (owner, now + ttl)
+            )
+            return True
+        return await self._run(acquire)
+
+    async def release_slot(self, owner: str) -> None:
+        def release() -> None:
+            self._conn.execute("DELETE FROM shared_slot WHERE owner=?", (owner,))
+        await self._run(release)
+
+    async def take_quota(self) -> bool:
+        def take() -> bool:
+            cursor = self._conn.execute(
+                "UPDATE shared_quota SET used=used+1 WHERE id=0 AND (quota=0 OR used<quota)"
+            )
+            return cursor.rowcount == 1
+        return await self._run(take)
+
+    async def sync_quota(self, quota: int, quota_used: int) -> None:
+        def sync() -> None:
+            self._conn.execute(
+                "UPDATE shared_quota SET quota=?, used=? WHERE id=0", (quota, quota_used)
+            )
+        await self._run(sync)
+
+    async def close(self) -> None:
+        with self._mutex:
+            self._conn.close()
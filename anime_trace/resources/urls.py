@@ -0,0 +1,142 @@
+import re
+from typing import Callable
+from urllib.parse import SplitResult, urlsplit, urlunsplit
+
+TRACKING_PARAMS = frozenset({
+    "fbclid",
+    "gclid",
+    "dclid",
+    "msclkid",
+    "yclid",
+    "igshid",
+    "mc_cid",
+    "mc_eid",
+    "_hsenc",
+    "_hsmi"
+})
+DISCORD_RESIZE_PARAMS = frozenset({"width", "height", "format", "quality"})
+# Largest side of resized images, big enough for a search and much smaller than most originals
+MAX_IMAGE_SIZE = 1280
+# Public proxies of i.pximg.net, which refuses requests without a pixiv Referer
+PIXIV_PROXIES = ("i.pixiv.re", "i.pixiv.cat", "i.pixiv.nl")
+
+_TWITTER_MEDIA = re.compile(r"^/media/([\w-]+)(?:\.(\w+))?(?::\w+)?$")
+# Image IDs have at least one digit or capital letter, unlike pages such as /about or /upload
+_IMGUR_PAGE = re.compile(r"^/(?=[a-z]*[A-Z0-9])([A-Za-z0-9]{5}|[A-Za-z0-9]{7})$")
+# Thumbnails add one letter of size to the 5 or 7 characters long image ID
+_IMGUR_IMAGE = re.compile(r"^/(\w{5}|\w{7})[sbtmlh]?\.(\w+)$")
+_PIXIV_THUMBNAIL = re.compile(r"^/c/[^/]+/")
+
+
+def _filter_query(query: str, drop: Callable[[str], bool]) -> str:
+    # Work on the raw query, so that the encoding of the kept parameters doesn't change
+    return "&".join(
+        param for param in query.split("&") if param and not drop(param.partition("=")[0])
+    )
+
+
+def _is_tracking(name: str) -> bool:
+    return name in TRACKING_PARAMS or name.startswith("utm_")
+
+
+def _get_params(query: str) -> dict[str, str]:
+    return dict(param.partition("=")[::2] for param in query.split("&") if param)
+
+
+def _discord(url: SplitResult) -> SplitResult:
+    # Attachments are resized by media.discordapp.net, the CDN serves only the original files.
+    # The ex, is and hm parameters sign the link and have to be kept.
+    query = _filter_query(url.query, DISCORD_RESIZE_PARAMS.__contains__)
+    params = _get_params(url.query)
+    try:
+        width, height = int(params["width"]), int(params["height"])
+    except (KeyError, ValueError):
+        # Without the dimensions of the image the size of a resized variant is unknown
+        return url._replace(query=query)
+    if not url.path.startswith("/attachments/") or width <= 0 or height <= 0:
+        return url._replace(query=query)
+    scale = min(1.0, MAX_IMAGE_SIZE / max(width, height))
+    size = f"width={max(1, round(width * scale))}&height={max(1, round(height * scale))}"
+    return url._replace(
+        netloc="media.discordapp.net",
+        query=f"{query}&{size}" if query else size
+    )
+
+
+def _twitter(url: SplitResult) -> SplitResult:
+    match = _TWITTER_MEDIA.match(url.path)
+    if not match:
+        return url
+    image_format = match.group(2) or _get_params(url.query).get("format") or "jpg"
+    # The medium variant is at most 1200 pixels wide, orig and 4096x4096 can be several MB
+    return url._replace(path=f"/media/{match.group(1)}", query=f"format={image_format}&name=medium")
+
+
+def _imgur(url: SplitResult) -> SplitResult:
+    if url.hostname != "i.imgur.com":
+        match = _IMGUR_PAGE.match(url.path)
+        if not match:
+            return url
+        return url._replace(netloc="i.imgur.com", path=f"/{match.group(1)}h.jpg", query="")
+    match = _IMGUR_IMAGE.match(url.path)
+    if not match:
+        return url
+    if match.group(2) in ("gifv", "mp4"):
+        # Videos don't have size variants
+        return url._replace(path=f"/{match.group(1)}.mp4", query="")
+    # The h suffix is the huge thumbnail, at most 1024 pixels
+    return url._replace(path=f"/{match.group(1)}h.{match.group(2)}", query="")
+
+
+def _pixiv(url: SplitResult, proxy: str) -> SplitResult:
+    path = _PIXIV_THUMBNAIL.sub("/", url.path).replace("_square1200.", "_master1200.")
+    if url.hostname == "i.pximg.net" and not proxy:
+        return url._replace(path=path)
+    # The same image behind any of the proxies gets one link
+    return url._replace(netloc=proxy or PIXIV_PROXIES[0], path=path)
+
+
+# Host -> rewrite of its links to a variant of the image of moderate size
+REWRITE_RULES: dict[str, Callable[[SplitResult], SplitResult]] = {
+    "cdn.discordapp.com": _discord,
+    "media.discordapp.net": _discord,
+    "pbs.twimg.com": _twitter,
+    "imgur.com": _imgur,
+    "www.imgur.com": _imgur,
+    "m.imgur.com": _imgur,
+    "i.imgur.com": _imgur
+}
+
+
+def canonicalize_url(url: str, pixiv_proxy: str = "") -> str:
+    """
+    Normalize an external media URL, so that links to the same file share cache entries:
+    lowercase the scheme and host, drop the fragment and tracking parameters,
+    and rewrite links of known image hosts to a variant of at most about 1280 pixels,
+    so that trace.moe doesn't have to fetch originals of several MB
+    :param url: external media URL
+    :param pixiv_proxy: host of the proxy pixiv images are fetched through, empty to fetch
+     them from pixiv
+    :return: canonical URL
+    """
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return url
+    if parts.scheme.lower() not in ("http", "https") or not host:
+        return url
+    netloc = parts.netloc if "@" in parts.netloc else host if port is None else f"{host}:{port}"
+    parts = parts._replace(
+        scheme=parts.scheme.lower(),
+        netloc=netloc,
+        query=_filter_query(parts.query, _is_tracking),
+        fragment=""
+    )
+    rule = REWRITE_RULES.get(host)
+    if rule:
+        parts = rule(parts)
+    elif host == "i.pximg.net" or host in PIXIV_PROXIES:
+        parts = _pixiv(parts, pixiv_proxy)
+    return urlunsplit(parts)
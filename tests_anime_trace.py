@@ -1,13 +1,24 @@
 import asyncio
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import AsyncMock, MagicMock, PropertyMock, patch
 
-from aiohttp import ClientError, ClientSession
+from aiohttp import ClientError, ClientResponseError, ClientSession
+from PIL import Image
 from mautrix.api import HTTPAPI
-from mautrix.errors import MatrixResponseError
+from mautrix.errors import DecryptionError, MatrixResponseError
 from mautrix.types import (
+    EncryptedEvent,
+    EventType,
     MessageType,
     EventID,
+    RoomID,
     ContentURI,
     TextMessageEventContent,
     MediaMessageEventContent,
@@ -15,12 +26,47 @@ from mautrix.types import (
     ImageInfo
 )
 from mautrix.types.event import MessageEvent as MautrixMessageEvent
+from mautrix.util.async_db import Database
 from mautrix.util.logging import TraceLogger
 from maubot import MessageEvent
 from maubot.matrix import MaubotMatrixClient
 
-from anime_trace.anime_trace import AnimeTraceBot
-from .anime_trace.resources.datastructures import MessageData
+from anime_trace.anime_trace import AnimeTraceBot, requester, search_filter
+from anime_trace.resources.anilist import AnilistIndex, read_entries
+from anime_trace.resources.backend import Endpoint, LatencyBackend, PriorityBackend
+from anime_trace.resources.blurhash import BLURHASH_KEY, blurhash_available, encode_blurhash
+from anime_trace.resources.cache import TTLCache, FrequencySketch, ResultCache
+from anime_trace.resources.datastructures import (
+    BackfillCheckpoint,
+    MessageData,
+    AnilistInfo,
+    TraceResult,
+    SearchResponse,
+    QuotaInfo,
+    QuotaState
+)
+from anime_trace.resources.executor import CPUPool, PoolFullError
+from anime_trace.resources.fair_queue import FairQueue, RoomBudgets
+from anime_trace.resources.db import AnsweredStore, BackfillStore, ResultStore, upgrade_table
+from anime_trace.resources.fetch import FetchStrategySelector, LOCAL, REMOTE
+from anime_trace.resources.hedge import HedgePolicy
+from anime_trace.resources.load import BUSY, FEWER_RESULTS, FULL, NO_PREVIEW, LoadMonitor
+from anime_trace.resources.media_cache import MediaDiskCache
+from anime_trace.resources.media_info import image_dimensions, video_info
+from anime_trace.resources.preview import PreviewSizer, PreviewStream
+from anime_trace.resources.renderer import (
+    render_link,
+    render_titles,
+    render_al_mal_links,
+    render_alternative_titles,
+    render_match_data,
+    render_other_result,
+    render_results,
+    render_batch,
+    render_history_summary
+)
+from anime_trace.resources.shared import LocalBackend, SQLiteBackend
+from anime_trace.resources.urls import canonicalize_url
 
 
 class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
@@ -34,12 +80,38 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
             http=self.session,
             instance_id="matrix.example.com",
             log=TraceLogger("testlogger"),
-            config=None,
+            config={},
             database=None,
             webapp=None,
             webapp_url=None,
             loader=None
         )
+        self.bot.result_cache = ResultCache(max_size=16, ttl=60)
+        self.bot.shared = LocalBackend()
+        self.bot.local_state = self.bot.shared
+        self.bot.quota = QuotaState(updated=time.monotonic())
+        self.bot.event_cache = TTLCache(max_size=16, ttl=60)
+        self.bot.answered = TTLCache(max_size=16, ttl=60)
+        self.bot.answered_store = None
+        self.bot.media_cache = None
+        self.bot.backfill_store = None
+        self.bot.backfill_checkpoints = {}
+        self.bot.backfill_jobs = {}
+        self.bot.validation_cache = TTLCache(max_size=16, ttl=60)
+        self.bot.speculative_search = False
+        self.bot.trusted_hosts = TTLCache(max_size=16, ttl=60)
+        self.bot.fetch_strategy = "remote"
+        self.bot.downscale = True
+        self.bot.fetch_selector = FetchStrategySelector(max_hosts=16, ttl=60)
+        self.bot.cpu_pool = CPUPool(workers=1, max_queue=4)
+        self.bot.load = LoadMonitor()
+        self.bot.preview_sizer = PreviewSizer()
+        self.bot.hedge_policies = {kind: HedgePolicy(ratio=0.1) for kind in ("image", "video")}
+        self.bot.fair_queue = FairQueue(concurrency=1)
+        self.bot.anilist_index = None
+        self.bot.search_backend = LatencyBackend([Endpoint(url="https://api.trace.moe")])
+        self.bot.anime_lookup = TTLCache(max_size=16, ttl=60)
+        self.bot.room_budgets = RoomBudgets(max_requests=0, max_bytes=0, window=60)
         self.api_response_data = {
             "frameCount": 745506,
             "error": "",
@@ -72,6 +144,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         }
 
     async def asyncTearDown(self):
+        self.bot.cpu_pool.shutdown()
         await self.session.close()
 
     async def create_resp(
@@ -95,7 +168,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         resp.read.return_value = resp_bytes
         return resp
 
-    async def test_extract_media_url_when_message_with_link_then_return_external_url(self):
+    async def test_extract_media_items_when_message_with_link_then_return_external_url(self):
         # Arrange
         url = "https://example.com/image.png"
         msg_event = MessageEvent(
@@ -105,7 +178,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         msg_event.content.msgtype = MessageType.TEXT
 
         # Act
-        media_ext_url, media_url, content_type = await self.bot._extract_media_url(
+        [(media_ext_url, media_url, content_type)] = await self.bot._extract_media_items(
             msg_event,
             None,
             (url, "")
@@ -116,7 +189,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(media_url, "")
         self.assertEqual(content_type, "")
 
-    async def test_extract_media_url_when_message_with_attachment_then_return_internal_url_and_mimetype(self):
+    async def test_extract_media_items_when_message_with_attachment_then_return_internal_url_and_mimetype(self):
         # Arrange
         url = "https://example.com/image.png"
         mimetype = "image/png"
@@ -130,7 +203,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         msg_event.content.url = ContentURI(url)
 
         # Act
-        media_ext_url, media_url, content_type = await self.bot._extract_media_url(
+        [(media_ext_url, media_url, content_type)] = await self.bot._extract_media_items(
             msg_event,
             None,
             ("", "")
@@ -141,7 +214,26 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(media_url, url)
         self.assertEqual(content_type, mimetype)
 
-    async def test_extract_media_url_when_reply_to_message_with_link_then_return_external_url(self):
+    async def test_extract_media_items_when_attachment_with_link_caption_then_return_both(self):
+        # Arrange
+        url = "mxc://example.com/image.png"
+        link = "https://example.com/other.png"
+        msg_content = MediaMessageEventContent()
+        msg_content.info = ImageInfo(mimetype="image/png")
+        msg_event = MessageEvent(
+            MautrixMessageEvent(None, None, None, None, None, msg_content),
+            self.bot.client
+        )
+        msg_event.content.msgtype = MessageType.IMAGE
+        msg_event.content.url = ContentURI(url)
+
+        # Act
+        result = await self.bot._extract_media_items(msg_event, None, (link, ""))
+
+        # Assert
+        self.assertEqual(result, [("", url, "image/png"), (link, "", "")])
+
+    async def test_extract_media_items_when_reply_to_message_with_link_then_return_external_url(self):
         # Arrange
         url = "https://example.com/image.png"
         reply_event = MessageEvent(
@@ -164,7 +256,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.bot.client.get_event = AsyncMock(return_value=msg_event)
 
         # Act
-        media_ext_url, media_url, content_type = await self.bot._extract_media_url(
+        [(media_ext_url, media_url, content_type)] = await self.bot._extract_media_items(
             reply_event,
             msg_event.event_id,
             (url, "")
@@ -175,7 +267,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(media_url, "")
         self.assertEqual(content_type, "")
 
-    async def test_extract_media_url_when_reply_to_message_with_attachment_then_return_internal_url_and_mimetype(self):
+    async def test_extract_media_items_when_reply_to_message_with_attachment_then_return_internal_url_and_mimetype(self):
         # Arrange
         url = "https://example.com/image.png"
         mimetype = "image/png"
@@ -194,150 +286,2024 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         )
 
         # Act
-        media_external_url, media_url, content_type = await self.bot._extract_media_url(
-            reply_event,
-            msg_event.event_id,
-            ("", "")
+        [(media_external_url, media_url, content_type)] = await self.bot._extract_media_items(
+            reply_event,
+            msg_event.event_id,
+            ("", "")
+        )
+
+        # Assert
+        self.assertEqual(media_external_url, "")
+        self.assertEqual(media_url, url)
+        self.assertEqual(content_type, mimetype)
+
+    async def create_db(self):
+        db = Database.create(
+            "sqlite::memory:",
+            upgrade_table=upgrade_table,
+            log=TraceLogger("testdb")
+        )
+        await db.start()
+        self.addAsyncCleanup(db.stop)
+        return db
+
+    async def test_ttl_cache_when_full_then_evict_least_recently_used(self):
+        # Arrange
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+
+        # Act
+        cache.set("c", 3)
+
+        # Assert
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+    async def test_ttl_cache_when_expired_then_return_default(self):
+        # Arrange
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1, ttl=0)
+
+        # Act
+        result = cache.get("a", "default")
+
+        # Assert
+        self.assertEqual(result, "default")
+        self.assertNotIn("a", cache)
+
+    async def test_frequency_sketch_estimate(self):
+        # Arrange
+        sketch = FrequencySketch(64)
+
+        # Act
+        for _ in range(3):
+            sketch.increment("popular")
+        sketch.increment("rare")
+
+        # Assert
+        self.assertGreaterEqual(sketch.estimate("popular"), 3)
+        self.assertGreaterEqual(sketch.estimate("rare"), 1)
+        self.assertGreater(sketch.estimate("popular"), sketch.estimate("rare"))
+
+    async def test_result_cache_when_database_is_full_then_admit_only_more_popular_results(self):
+        # Arrange
+        response = SearchResponse.from_json(self.api_response_data)
+        cache = ResultCache(max_size=0, ttl=60, store=ResultStore(await self.create_db()), store_size=1)
+        await cache.get("old")
+        await cache.put("old", response)
+        await cache.get("rare")
+        for _ in range(3):
+            await cache.get("popular")
+
+        # Act
+        await cache.put("rare", response)
+        rare = await cache.get("rare")
+        await cache.put("popular", response)
+        popular = await cache.get("popular")
+        old = await cache.get("old")
+
+        # Assert
+        self.assertEqual(rare, None)
+        self.assertEqual(popular, response)
+        self.assertEqual(old, None)
+
+    async def test_result_cache_warm_up_when_results_in_database_then_load_them_into_memory(self):
+        # Arrange
+        response = SearchResponse.from_json(self.api_response_data)
+        store = ResultStore(await self.create_db())
+        await ResultCache(max_size=0, ttl=60, store=store, store_size=10).put("key", response)
+        await store.put("expired", ResultCache.encode(response), 0)
+        cache = ResultCache(max_size=10, ttl=60, store=store, store_size=10)
+
+        # Act
+        loaded = await cache.warm_up(10)
+
+        # Assert
+        self.assertEqual(loaded, 1)
+        self.assertEqual(cache.memory.get("key"), response)
+        self.assertEqual(await store.count(), 1)
+
+    async def test_result_cache_when_loaded_from_database_then_keep_remaining_lifetime(self):
+        # Arrange
+        data = ResultCache.encode(SearchResponse.from_json(self.api_response_data))
+        store = ResultStore(await self.create_db())
+        await store.put("key", data, int(time.time()) + 5)
+        read = ResultCache(max_size=10, ttl=3600, store=store, store_size=10)
+        warm = ResultCache(max_size=10, ttl=3600, store=store, store_size=10)
+
+        # Act
+        await read.get("key")
+        await warm.warm_up(10)
+
+        # Assert
+        for cache in (read, warm):
+            with self.subTest(cache=cache):
+                self.assertLessEqual(cache.memory._data["key"][0] - time.monotonic(), 5)
+
+    async def test_remember_media_when_message_has_media_then_reply_uses_cached_source(self):
+        # Arrange
+        url = "mxc://matrix.example.com/image.png"
+        mimetype = "image/png"
+        msg_content = MediaMessageEventContent()
+        msg_content.info = ImageInfo(mimetype=mimetype)
+        msg_event = MessageEvent(
+            MautrixMessageEvent(None, RoomID("!room"), EventID("test_id"), None, None, msg_content),
+            self.bot.client
+        )
+        msg_event.content.msgtype = MessageType.IMAGE
+        msg_event.content.url = ContentURI(url)
+        reply_event = MessageEvent(
+            MautrixMessageEvent(None, RoomID("!room"), None, None, None, TextMessageEventContent()),
+            self.bot.client
+        )
+        self.bot.client.get_event = AsyncMock()
+
+        # Act
+        await self.bot.remember_media(msg_event)
+        result = await self.bot._extract_media_items(reply_event, EventID("test_id"), ("", ""))
+
+        # Assert
+        self.assertEqual(result, [("", url, mimetype)])
+        self.bot.client.get_event.assert_not_called()
+
+    async def test_remember_media_when_text_without_link_then_skip(self):
+        # Arrange
+        msg_event = MessageEvent(
+            MautrixMessageEvent(
+                None,
+                RoomID("!room"),
+                EventID("test_id"),
+                None,
+                None,
+                TextMessageEventContent(msgtype=MessageType.TEXT, body="hello")
+            ),
+            self.bot.client
+        )
+
+        # Act
+        await self.bot.remember_media(msg_event)
+
+        # Assert
+        self.assertEqual(len(self.bot.event_cache), 0)
+
+    async def test_extract_media_items_when_reply_fetched_then_cache_source(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        msg_event = MessageEvent(
+            MautrixMessageEvent(
+                None,
+                RoomID("!room"),
+                EventID("test_id"),
+                None,
+                None,
+                TextMessageEventContent(msgtype=MessageType.TEXT, body=f"look {url}")
+            ),
+            self.bot.client
+        )
+        reply_event = MessageEvent(
+            MautrixMessageEvent(None, RoomID("!room"), None, None, None, TextMessageEventContent()),
+            self.bot.client
+        )
+        self.bot.client.get_event = AsyncMock(return_value=msg_event)
+
+        # Act
+        await self.bot._extract_media_items(reply_event, EventID("test_id"), ("", ""))
+        result = await self.bot._extract_media_items(reply_event, EventID("test_id"), ("", ""))
+
+        # Assert
+        self.assertEqual(result, [(url, "", "")])
+        self.bot.client.get_event.assert_called_once()
+
+    async def test_extract_media_items_when_several_links_then_return_all(self):
+        # Arrange
+        msg_event = MagicMock()
+        msg_event.content.msgtype = MessageType.TEXT
+        query = (
+            "https://example.com/1.png https://example.com/2.png?utm_source=x "
+            "https://example.com/2.png",
+        )
+
+        # Act
+        result = await self.bot._extract_media_items(msg_event, None, query)
+
+        # Assert
+        self.assertEqual(
+            result,
+            [("https://example.com/1.png", "", ""), ("https://example.com/2.png", "", "")]
+        )
+
+    async def test_extract_media_items_when_event_ids_listed_then_return_their_media(self):
+        # Arrange
+        msg_event = MagicMock(room_id=RoomID("!room"))
+        msg_event.content.msgtype = MessageType.TEXT
+        self.bot.event_cache.set(
+            (RoomID("!room"), EventID("$first")),
+            [("", "mxc://matrix.example.com/1", "image/png")]
+        )
+        self.bot.event_cache.set(
+            (RoomID("!room"), EventID("$second")),
+            [("https://example.com/2.png", "", "")]
+        )
+
+        # Act
+        result = await self.bot._extract_media_items(msg_event, None, ("$first $second",))
+
+        # Assert
+        self.assertEqual(
+            result,
+            [("", "mxc://matrix.example.com/1", "image/png"), ("https://example.com/2.png", "", "")]
+        )
+
+    async def test_extract_media_items_when_reply_to_gallery_then_return_all_items(self):
+        # Arrange
+        gallery = MessageEvent(
+            MautrixMessageEvent(
+                None,
+                RoomID("!room"),
+                EventID("$gallery"),
+                None,
+                None,
+                TextMessageEventContent(msgtype=MessageType.FILE, body="screenshots")
+            ),
+            self.bot.client
+        )
+        gallery.content["itemtypes"] = [
+            {"itemtype": "m.image", "url": "mxc://matrix.example.com/1", "info": {"mimetype": "image/png"}},
+            {"itemtype": "m.file", "url": "mxc://matrix.example.com/2"},
+            {"itemtype": "m.video", "url": "mxc://matrix.example.com/3", "info": {"mimetype": "video/mp4"}}
+        ]
+        reply_event = MessageEvent(
+            MautrixMessageEvent(None, RoomID("!room"), None, None, None, TextMessageEventContent()),
+            self.bot.client
+        )
+        self.bot.client.get_event = AsyncMock(return_value=gallery)
+
+        # Act
+        result = await self.bot._extract_media_items(reply_event, EventID("$gallery"), None)
+
+        # Assert
+        self.assertEqual(
+            result,
+            [
+                ("", "mxc://matrix.example.com/1", "image/png"),
+                ("", "mxc://matrix.example.com/3", "video/mp4")
+            ]
+        )
+
+    async def test_trace_batch_when_combined_then_reply_once_within_parallelism_cap(self):
+        # Arrange
+        self.bot.config = {"batch_parallelism": 2}
+        response = SearchResponse.from_json(self.api_response_data)
+        running = 0
+        max_running = 0
+
+        async def search(media_ext_url, media_url, content_type, cached_only=False):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if media_ext_url.endswith("bad.html"):
+                raise ValueError("External file type not supported: text/html")
+            if media_ext_url.endswith("none.png"):
+                return SearchResponse(error="", results=())
+            return response
+
+        self.bot._search = AsyncMock(side_effect=search)
+        evt = MagicMock(reply=AsyncMock())
+        items = [
+            ("https://example.com/1.png", "", ""),
+            ("https://example.com/bad.html", "", ""),
+            ("https://example.com/none.png", "", ""),
+            ("https://example.com/4.png", "", "")
+        ]
+
+        # Act
+        await self.bot._trace_batch(evt, items)
+
+        # Assert
+        self.assertEqual(max_running, 2)
+        evt.reply.assert_called_once()
+        content = evt.reply.call_args.args[0]
+        self.assertIsInstance(content, TextMessageEventContent)
+        self.assertIn("> > 2. File validation failed - External file type not supported", content.body)
+        self.assertIn("> > 3. Couldn't find an anime", content.body)
+        self.assertIn("> > 4. [", content.body)
+
+    async def test_trace_batch_when_separate_then_trace_each_media_up_to_batch_size(self):
+        # Arrange
+        self.bot.config = {"batch_reply": "separate", "batch_size": 2}
+        self.bot._trace_media = AsyncMock()
+        evt = MagicMock(reply=AsyncMock())
+        items = [
+            ("https://example.com/1.png", "", ""),
+            ("", "mxc://matrix.example.com/2", "image/png"),
+            ("https://example.com/3.png", "", "")
+        ]
+
+        # Act
+        await self.bot._trace_batch(evt, items)
+
+        # Assert
+        self.assertEqual(self.bot._trace_media.call_count, 2)
+        self.bot._trace_media.assert_any_call(
+            evt, "mxc://matrix.example.com/2", "", "mxc://matrix.example.com/2", "image/png", FULL
+        )
+        evt.reply.assert_called_once_with("> Tracing the first 2 media, 1 more left out.")
+
+    def create_history_page(self, end, *timestamps):
+        events = [
+            MagicMock(
+                event_id=EventID(f"${timestamp}"),
+                room_id=RoomID("!room"),
+                sender="@user:example.com",
+                timestamp=timestamp,
+                type=EventType.ROOM_MESSAGE,
+                content=MagicMock(msgtype=MessageType.IMAGE)
+            )
+            for timestamp in timestamps
+        ]
+        return MagicMock(events=events, end=end)
+
+    async def test_trace_history_when_not_admin_then_refuse(self):
+        # Arrange
+        self.bot.config = {"admins": ["@admin:example.com"]}
+        evt = MagicMock(sender="@user:example.com", room_id=RoomID("!room"))
+        evt.mark_read = AsyncMock()
+        evt.reply = AsyncMock()
+
+        # Act
+        await self.bot.trace_history.__mb_func__(self.bot, evt, "7")
+
+        # Assert
+        evt.reply.assert_called_once_with("> Only bot admins can trace the room history.")
+        self.assertEqual(self.bot.backfill_jobs, {})
+
+    async def test_trace_history_when_summary_then_trace_until_start_and_forget_checkpoint(self):
+        # Arrange
+        self.bot.config = {"history_output": "summary", "history_interval": 0}
+        self.bot.client.get_messages = AsyncMock(side_effect=[
+            self.create_history_page("t1", 5000, 4000),
+            self.create_history_page("t2", 3000, 1000)
+        ])
+        self.bot.client.send_message = AsyncMock()
+        self.bot._get_media_sources = MagicMock(return_value=[("", "mxc://example.com/a", "image/png")])
+        self.bot._search = AsyncMock(return_value=SearchResponse.from_json(self.api_response_data))
+        evt = MagicMock(room_id=RoomID("!room"))
+        checkpoint = BackfillCheckpoint(room_id="!room", since=2000)
+        await self.bot._save_backfill_checkpoint(checkpoint)
+
+        # Act
+        await self.bot._trace_history(evt, checkpoint)
+
+        # Assert
+        self.assertEqual(self.bot._search.call_count, 3)
+        self.assertEqual(self.bot.client.get_messages.call_args.kwargs["from_token"], "t1")
+        self.assertEqual(self.bot.backfill_checkpoints, {})
+        summary, status = [call.args[1] for call in self.bot.client.send_message.call_args_list]
+        self.assertIn("> > [3.](https://matrix.to/#/!room/$3000) Nekopara OVA", summary.body)
+        self.assertEqual(status.body, "> Room history trace finished. Traced: 3, failed: 0.")
+
+    async def test_trace_history_when_summary_resumed_then_skip_summarized_media(self):
+        # Arrange
+        self.bot.config = {"history_output": "summary", "history_interval": 0}
+        self.bot.client.get_messages = AsyncMock(side_effect=[
+            self.create_history_page("t1", 5000, 4000),
+            self.create_history_page("t1", 5000, 4000),
+            self.create_history_page("")
+        ])
+        self.bot.client.send_message = AsyncMock(return_value=EventID("$summary"))
+        self.bot._get_media_sources = MagicMock(return_value=[("", "mxc://example.com/a", "image/png")])
+        self.bot._search = AsyncMock(return_value=SearchResponse.from_json(self.api_response_data))
+        self.bot._wait_for_history_quota = AsyncMock(side_effect=[True, False, True])
+        evt = MagicMock(room_id=RoomID("!room"))
+        checkpoint = BackfillCheckpoint(room_id="!room", since=0)
+        await self.bot._trace_history(evt, checkpoint)
+
+        # Act
+        await self.bot._trace_history(evt, checkpoint)
+
+        # Assert
+        self.assertEqual(self.bot._search.call_count, 2)
+        self.assertEqual(checkpoint.traced, 2)
+        self.assertEqual(await self.bot._get_answer(RoomID("!room"), "$5000"), "$summary")
+
+    async def test_stop_backfill_jobs_when_running_then_wait_for_status_message(self):
+        # Arrange
+        self.bot.config = {"history_output": "summary"}
+        started = asyncio.Event()
+
+        async def get_messages(*args, **kwargs):
+            started.set()
+            await asyncio.sleep(10)
+
+        self.bot.client.get_messages = AsyncMock(side_effect=get_messages)
+        self.bot.client.send_message = AsyncMock()
+        evt = MagicMock(room_id=RoomID("!room"))
+        checkpoint = BackfillCheckpoint(room_id="!room", since=0)
+        self.bot.backfill_jobs[evt.room_id] = asyncio.create_task(
+            self.bot._trace_history(evt, checkpoint)
+        )
+        await started.wait()
+
+        # Act
+        await self.bot._stop_backfill_jobs()
+
+        # Assert
+        self.assertEqual(self.bot.backfill_jobs, {})
+        self.assertEqual(self.bot.backfill_checkpoints, {RoomID("!room"): checkpoint})
+        status = self.bot.client.send_message.call_args.args[1]
+        self.assertIn("Room history trace stopped", status.body)
+
+    async def test_trace_history_when_encrypted_room_without_crypto_then_refuse(self):
+        # Arrange
+        self.bot.config = {"admins": ["@admin:example.com"]}
+        self.bot.client.get_state_event = AsyncMock(return_value=MagicMock())
+        evt = MagicMock(sender="@admin:example.com", room_id=RoomID("!room"))
+        evt.mark_read = AsyncMock()
+        evt.reply = AsyncMock()
+
+        # Act
+        await self.bot.trace_history.__mb_func__(self.bot, evt, "7")
+
+        # Assert
+        evt.reply.assert_called_once_with(
+            "> The room is encrypted and the bot can't decrypt messages, "
+            "so its history can't be traced."
+        )
+        self.assertEqual(self.bot.backfill_jobs, {})
+
+    async def test_trace_history_when_message_is_reply_then_skip_quoted_links(self):
+        # Arrange
+        self.bot.config = {"history_output": "summary", "history_interval": 0}
+        content = TextMessageEventContent(
+            msgtype=MessageType.TEXT,
+            body=(
+                "> <@other:example.com> https://example.com/quoted.png\n\n"
+                "https://example.com/own.png"
+            )
+        )
+        content.set_reply(EventID("$parent"))
+        page = MagicMock(
+            events=[
+                MautrixMessageEvent(
+                    EventType.ROOM_MESSAGE,
+                    RoomID("!room"),
+                    EventID("$reply"),
+                    "@user:example.com",
+                    5000,
+                    content
+                )
+            ],
+            end=""
+        )
+        self.bot.client.get_messages = AsyncMock(return_value=page)
+        self.bot.client.send_message = AsyncMock()
+        self.bot._search = AsyncMock(return_value=SearchResponse.from_json(self.api_response_data))
+        evt = MagicMock(room_id=RoomID("!room"))
+
+        # Act
+        await self.bot._trace_history(evt, BackfillCheckpoint(room_id="!room", since=0))
+
+        # Assert
+        self.bot._search.assert_called_once_with("https://example.com/own.png", "", "")
+
+    async def test_prepare_history_event_when_encrypted_then_decrypt_it(self):
+        # Arrange
+        decrypted = self.create_history_page("", 5000).events[0]
+        crypto = MagicMock(decrypt_megolm_event=AsyncMock())
+        undecryptable = MagicMock(spec=EncryptedEvent, event_id=EventID("$secret"))
+        crypto.decrypt_megolm_event.side_effect = [decrypted, DecryptionError("no session")]
+
+        # Act
+        with patch.object(MaubotMatrixClient, "crypto", new_callable=PropertyMock) as crypto_property:
+            crypto_property.return_value = crypto
+            result = await self.bot._prepare_history_event(MagicMock(spec=EncryptedEvent))
+            with self.assertLogs(self.bot.log, level="WARNING"):
+                failed = await self.bot._prepare_history_event(undecryptable)
+
+        # Assert
+        self.assertIs(result, decrypted)
+        decrypted.content.trim_reply_fallback.assert_called_once()
+        self.assertEqual(failed, None)
+
+    async def test_trace_history_when_quota_reserve_reached_then_pause_and_save_checkpoint(self):
+        # Arrange
+        self.bot.config = {"history_output": "thread", "history_quota_reserve": 10}
+        self.bot.quota = QuotaState(quota=1000, quota_used=990, updated=time.monotonic())
+        self.bot.client.get_messages = AsyncMock(
+            return_value=self.create_history_page("t1", 5000)
+        )
+        self.bot.client.send_message = AsyncMock()
+        self.bot._get_media_sources = MagicMock(return_value=[("", "mxc://example.com/a", "image/png")])
+        self.bot._search = AsyncMock()
+        evt = MagicMock(room_id=RoomID("!room"), reply=AsyncMock(return_value=EventID("$thread")))
+        store = BackfillStore(await self.create_db())
+        self.bot.backfill_store = store
+
+        # Act
+        await self.bot._trace_history(evt, BackfillCheckpoint(room_id="!room", since=0))
+
+        # Assert
+        self.bot._search.assert_not_called()
+        checkpoint = await store.get("!room")
+        self.assertEqual(checkpoint.thread_id, "$thread")
+        self.assertEqual(checkpoint.token, "")
+        status = self.bot.client.send_message.call_args.args[1]
+        self.assertIn("Room history trace paused", status.body)
+        self.assertEqual(status.relates_to.event_id, "$thread")
+
+    async def test_backfill_store_when_checkpoint_saved_then_return_it_until_deleted(self):
+        # Arrange
+        store = BackfillStore(await self.create_db())
+        checkpoint = BackfillCheckpoint(room_id="!room", since=1000, token="t1", traced=2)
+
+        # Act
+        await store.put(checkpoint)
+        checkpoint.failed = 1
+        await store.put(checkpoint)
+        result = await store.get("!room")
+        await store.delete("!room")
+
+        # Assert
+        self.assertEqual(result, checkpoint)
+        self.assertEqual(await store.get("!room"), None)
+
+    async def test_load_monitor_level_when_limits_are_passed_then_degrade_in_order(self):
+        # Arrange
+        monitor = LoadMonitor()
+        cases = [
+            (4, 0, None, FULL),
+            (10, 0, None, NO_PREVIEW),
+            (15, 0, None, FEWER_RESULTS),
+            (20, 0, None, BUSY),
+            (0, 150, None, FEWER_RESULTS),
+            (0, 0, 30, FULL),
+            (0, 0, 10, BUSY),
+            (0, 0, 0, BUSY)
+        ]
+
+        for commands, size, quota_remaining, expected in cases:
+            with self.subTest(commands=commands, size=size, quota_remaining=quota_remaining):
+                # Act
+                with monitor.command(commands), monitor.hold(size):
+                    level = monitor.level(10, 100, 20, quota_remaining)
+
+                # Assert
+                self.assertEqual(level, expected)
+        self.assertEqual((monitor.commands, monitor.bytes), (0, 0))
+        self.assertEqual(monitor.shed[BUSY], 3)
+
+    async def test_prepare_message_content_when_degraded_then_drop_preview_and_results(self):
+        # Arrange
+        self.bot.config = {"max_results": 5, "shed_max_results": 1}
+        self.api_response_data["result"].append(dict(self.api_response_data["result"][0]))
+        response = SearchResponse.from_json(self.api_response_data)
+
+        # Act
+        full = self.bot._prepare_message_content(response, FULL)
+        no_preview = self.bot._prepare_message_content(response, NO_PREVIEW)
+        fewer_results = self.bot._prepare_message_content(response, FEWER_RESULTS)
+
+        # Assert
+        self.assertTrue(full.video_url)
+        self.assertEqual((no_preview.video_url, no_preview.image_url), ("", ""))
+        self.assertEqual(no_preview.html, full.html)
+        self.assertIn("Other results", full.html)
+        self.assertNotIn("Other results", fewer_results.html)
+
+    async def test_trace_when_bot_is_busy_then_trace_only_from_cache(self):
+        # Arrange
+        self.bot.config = {"shed_commands": 2}
+        self.bot._extract_media_items = AsyncMock(
+            return_value=[("https://example.com/image.png", "", "")]
+        )
+        self.bot._trace_media = AsyncMock()
+        evt = MagicMock(mark_read=AsyncMock(), reply=AsyncMock())
+        evt.content.get_reply_to.return_value = None
+
+        # Act
+        with self.bot.load.command(4):
+            await self.bot.trace.__mb_func__(self.bot, evt, ("https://example.com/image.png",))
+
+        # Assert
+        evt.reply.assert_not_called()
+        self.bot._trace_media.assert_called_once_with(
+            evt,
+            "https://example.com/image.png",
+            "https://example.com/image.png",
+            "",
+            "",
+            BUSY
+        )
+
+    async def test_trace_media_when_busy_and_result_is_cached_then_reply_with_it(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        await self.bot.result_cache.put(
+            self.bot._get_cache_key(url),
+            SearchResponse.from_json(self.api_response_data)
+        )
+        self.bot._trace_by_external_url = AsyncMock()
+        self.bot._prepare_message = AsyncMock(return_value=MagicMock())
+        evt = MagicMock(room_id=RoomID("!room"), reply=AsyncMock(return_value=EventID("$reply")))
+
+        # Act
+        await self.bot._trace_media(evt, url, url, "", "", BUSY)
+
+        # Assert
+        self.bot._trace_by_external_url.assert_not_called()
+        evt.reply.assert_called_once_with(self.bot._prepare_message.return_value)
+
+    async def test_trace_media_when_busy_and_already_traced_then_link_answer(self):
+        # Arrange
+        room_id = RoomID("!room")
+        await self.bot._remember_answer(room_id, "$source", EventID("$reply"))
+        self.bot._search = AsyncMock()
+        evt = MagicMock(room_id=room_id, reply=AsyncMock())
+
+        # Act
+        await self.bot._trace_media(evt, "$source", "", "mxc://example.com/image", "", BUSY)
+
+        # Assert
+        self.bot._search.assert_not_called()
+        evt.reply.assert_called_once_with(
+            "> Already traced: https://matrix.to/#/!room/$reply"
+        )
+
+    async def test_trace_media_when_busy_and_not_cached_then_reject_search(self):
+        # Arrange
+        self.bot.config = {"shed_commands": 2}
+        self.bot._trace_by_external_url = AsyncMock()
+        evt = MagicMock(room_id=RoomID("!room"), reply=AsyncMock())
+        url = "https://example.com/image.png"
+
+        # Act
+        await self.bot._trace_media(evt, url, url, "", "", BUSY)
+
+        # Assert
+        self.bot._trace_by_external_url.assert_not_called()
+        evt.reply.assert_called_once_with("> The bot is busy, try again later.")
+
+    async def test_trace_media_when_quota_is_almost_used_up_then_say_so(self):
+        # Arrange
+        self.bot.config = {"shed_quota": 20}
+        self.bot.quota = QuotaState(quota=1000, quota_used=995, updated=time.monotonic())
+        evt = MagicMock(room_id=RoomID("!room"), reply=AsyncMock())
+        url = "https://example.com/image.png"
+
+        # Act
+        await self.bot._trace_media(evt, url, url, "", "", BUSY)
+
+        # Assert
+        evt.reply.assert_called_once_with(
+            "> The search quota is almost used up. Until it's renewed, "
+            "only media that was traced before can be searched."
+        )
+
+    async def test_trace_when_stale_quota_is_exhausted_then_refresh_it_before_shedding(self):
+        # Arrange
+        self.bot.config = {"shed_quota": 20, "quota_ttl": 0}
+        self.bot.quota = QuotaState(quota=1000, quota_used=1000, updated=time.monotonic() - 1)
+        self.bot._get_quota = AsyncMock(
+            return_value=QuotaInfo(priority=0, concurrency=1, quota=1000, quota_used=0)
+        )
+        self.bot._extract_media_items = AsyncMock(
+            return_value=[("https://example.com/image.png", "", "")]
+        )
+        self.bot._trace_media = AsyncMock()
+        evt = MagicMock(mark_read=AsyncMock(), reply=AsyncMock())
+        evt.content.get_reply_to.return_value = None
+
+        # Act
+        await self.bot.trace.__mb_func__(self.bot, evt, ("https://example.com/image.png",))
+
+        # Assert
+        self.bot._get_quota.assert_called_once()
+        self.assertEqual(self.bot.quota.quota_remaining, 1000)
+        evt.reply.assert_not_called()
+        self.assertEqual(self.bot._trace_media.call_args.args[-1], FULL)
+
+    async def test_fair_queue_when_one_room_is_busy_then_rooms_and_senders_take_turns(self):
+        # Arrange
+        queue = FairQueue(concurrency=1, weights={"!heavy": 2})
+        order = []
+        release = asyncio.Event()
+
+        async def search(room_id, sender, name):
+            async with queue.slot(room_id, sender):
+                order.append(name)
+                if name == "first":
+                    await release.wait()
+
+        first = asyncio.create_task(search("!spam", "@a", "first"))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.create_task(search(room_id, sender, name))
+            for room_id, sender, name in [
+                ("!spam", "@a", "spam a1"),
+                ("!spam", "@a", "spam a2"),
+                ("!spam", "@a", "spam a3"),
+                ("!spam", "@b", "spam b1"),
+                ("!quiet", "@c", "quiet c1"),
+                ("!heavy", "@d", "heavy d1"),
+                ("!heavy", "@d", "heavy d2"),
+                ("!heavy", "@d", "heavy d3")
+            ]
+        ]
+        await asyncio.sleep(0)
+
+        # Act
+        release.set()
+        await asyncio.gather(first, *tasks)
+
+        # Assert
+        self.assertEqual(order, [
+            "first",
+            "spam a1",
+            "quiet c1",
+            "heavy d1",
+            "heavy d2",
+            "spam b1",
+            "heavy d3",
+            "spam a2",
+            "spam a3"
+        ])
+        self.assertEqual((queue.active, queue.waiting), (0, 0))
+
+    async def test_fair_queue_when_waiting_search_cancelled_then_remove_it(self):
+        # Arrange
+        queue = FairQueue(concurrency=1)
+        release = asyncio.Event()
+
+        async def search(sender):
+            async with queue.slot("!room", sender):
+                await release.wait()
+
+        first = asyncio.create_task(search("@a"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(search("@b"))
+        await asyncio.sleep(0)
+
+        # Act
+        second.cancel()
+        await asyncio.sleep(0)
+        waiting = queue.waiting
+        release.set()
+        await first
+
+        # Assert
+        self.assertTrue(second.cancelled())
+        self.assertEqual(waiting, 0)
+        self.assertEqual(queue.active, 0)
+
+    async def test_room_budgets_when_used_up_then_wait_for_next_window(self):
+        # Arrange
+        budgets = RoomBudgets(max_requests=2, max_bytes=1000, window=60)
+
+        # Act
+        first = budgets.reserve("!room", 100)
+        within = budgets.check("!room", 100)
+        too_big = budgets.reserve("!room", 950)
+        second = budgets.reserve("!room", 100)
+        too_many = budgets.reserve("!room")
+        other_room = budgets.check("!other", 5000)
+
+        # Assert
+        self.assertEqual((first, within, second, other_room), (0, 0, 0, 0))
+        self.assertGreater(too_big, 59)
+        self.assertGreater(too_many, 59)
+
+    async def test_room_budgets_when_reservation_released_then_budget_is_free_again(self):
+        # Arrange
+        budgets = RoomBudgets(max_requests=1, max_bytes=0, window=60)
+        budgets.reserve("!room")
+        reserved = time.monotonic()
+
+        # Act
+        used_up = budgets.check("!room")
+        budgets.release("!room", 0, reserved)
+        released = budgets.check("!room")
+
+        # Assert
+        self.assertGreater(used_up, 59)
+        self.assertEqual(released, 0)
+
+    async def test_api_slot_when_searches_queued_at_once_then_room_budget_holds(self):
+        # Arrange
+        self.bot.room_budgets = RoomBudgets(max_requests=2, max_bytes=0, window=3600)
+        token = requester.set(("!room", "@user"))
+        self.addCleanup(requester.reset, token)
+
+        async def search():
+            async with self.bot._api_slot():
+                await asyncio.sleep(0.01)
+
+        # Act
+        results = await asyncio.gather(*(search() for _ in range(10)), return_exceptions=True)
+
+        # Assert
+        self.assertEqual(results.count(None), 2)
+        self.assertEqual(sum(isinstance(result, ClientError) for result in results), 8)
+
+    async def test_api_slot_when_cancelled_in_queue_then_release_room_budget(self):
+        # Arrange
+        self.bot.room_budgets = RoomBudgets(max_requests=1, max_bytes=0, window=3600)
+        token = requester.set(("!room", "@user"))
+        self.addCleanup(requester.reset, token)
+
+        async def search():
+            async with self.bot._api_slot():
+                pass
+
+        # Act
+        async with self.bot.fair_queue.slot("!other", "@other"):
+            task = asyncio.create_task(search())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        # Assert
+        self.assertEqual(self.bot.room_budgets.check("!room"), 0)
+
+    async def test_api_slot_when_room_budget_used_up_then_raise_ClientError(self):
+        # Arrange
+        self.bot.room_budgets = RoomBudgets(max_requests=1, max_bytes=0, window=60)
+        token = requester.set(("!room", "@user"))
+        self.addCleanup(requester.reset, token)
+        async with self.bot._api_slot(100):
+            pass
+
+        # Act
+        with self.assertRaises(ClientError) as context:
+            async with self.bot._api_slot(100):
+                pass
+
+        # Assert
+        self.assertIn("This room used up its search budget", str(context.exception))
+        self.assertEqual(self.bot.fair_queue.active, 0)
+
+    async def test_split_anime_option(self):
+        # Arrange
+        cases = [
+            ("https://example.com/a.png", ("https://example.com/a.png", None)),
+            ("--anime 99939 https://example.com/a.png", (" https://example.com/a.png", "99939")),
+            ("$event --anime \"Nekopara OVA\"", ("$event ", "Nekopara OVA")),
+            ("--anime Nekopara", ("", "Nekopara"))
+        ]
+
+        for text, expected in cases:
+            with self.subTest(text=text):
+                # Act
+                result = self.bot._split_anime_option(text)
+
+                # Assert
+                self.assertEqual(result, expected)
+
+    async def test_resolve_anime_when_title_then_look_up_index_once(self):
+        # Arrange
+        self.bot.anilist_index = MagicMock()
+        self.bot.anilist_index.find = AsyncMock(side_effect=[99939, None])
+
+        # Act
+        by_id = await self.bot._resolve_anime("123")
+        by_title = await self.bot._resolve_anime("Nekopara OVA")
+        cached = await self.bot._resolve_anime("nekopara ova")
+        unknown = await self.bot._resolve_anime("Unknown")
+        unknown_cached = await self.bot._resolve_anime("unknown")
+
+        # Assert
+        self.assertEqual((by_id, by_title, cached), (123, 99939, 99939))
+        self.assertEqual((unknown, unknown_cached), (None, None))
+        self.assertEqual(self.bot.anilist_index.find.call_count, 2)
+
+    async def test_resolve_anime_when_title_unknown_then_remember_it_shortly(self):
+        # Arrange
+        self.bot.anime_lookup = TTLCache(max_size=16, ttl=86400)
+        self.bot.anilist_index = MagicMock()
+        self.bot.anilist_index.find = AsyncMock(side_effect=[None, 99939])
+
+        # Act
+        await self.bot._resolve_anime("Nekopara OVA")
+        await self.bot._resolve_anime("Nekopara")
+
+        # Assert
+        unknown_expires = self.bot.anime_lookup._data["nekopara ova"][0] - time.monotonic()
+        known_expires = self.bot.anime_lookup._data["nekopara"][0] - time.monotonic()
+        self.assertLessEqual(unknown_expires, self.bot.unknown_anime_ttl)
+        self.assertGreater(known_expires, 3600)
+
+    async def test_resolve_anime_when_title_and_no_index_then_return_None(self):
+        # Act
+        result = await self.bot._resolve_anime("Nekopara OVA")
+
+        # Assert
+        self.assertEqual(result, None)
+
+    async def test_get_search_url_when_scoped_then_add_anilist_filter_to_url_and_cache_key(self):
+        # Arrange
+        full_key = self.bot._get_cache_key("https://example.com/a.png")
+        token = search_filter.set(99939)
+        self.addCleanup(search_filter.reset, token)
+
+        # Act
+        url = self.bot._get_search_url()
+        scoped_key = self.bot._get_cache_key("https://example.com/a.png")
+        self.bot.search_params = ""
+        bare_url = self.bot._get_search_url()
+
+        # Assert
+        self.assertEqual(url, "https://api.trace.moe/search?anilistInfo&anilistID=99939")
+        self.assertEqual(bare_url, "https://api.trace.moe/search?anilistID=99939")
+        self.assertNotEqual(full_key, scoped_key)
+
+    async def test_trace_when_anime_unknown_then_reply_and_skip_search(self):
+        # Arrange
+        self.bot._extract_media_items = AsyncMock()
+        evt = MagicMock(mark_read=AsyncMock(), reply=AsyncMock())
+        evt.content.get_reply_to.return_value = None
+
+        # Act
+        await self.bot.trace.__mb_func__(
+            self.bot,
+            evt,
+            ("--anime \"Nekopara OVA\" https://example.com/image.png",)
+        )
+
+        # Assert
+        evt.reply.assert_called_once_with(
+            "> Couldn't find anime \"Nekopara OVA\" in the AniList index."
+        )
+        self.bot._extract_media_items.assert_not_called()
+
+    async def test_get_answer_when_media_was_traced_then_return_reply_id(self):
+        # Arrange
+        room_id = RoomID("!room")
+        await self.bot._remember_answer(room_id, "$source", EventID("$reply"))
+
+        # Act
+        result = await self.bot._get_answer(room_id, "$source")
+        other_room = await self.bot._get_answer(RoomID("!other"), "$source")
+
+        # Assert
+        self.assertEqual(result, "$reply")
+        self.assertEqual(other_room, None)
+
+    async def test_get_answer_when_not_in_memory_then_read_from_database(self):
+        # Arrange
+        room_id = RoomID("!room")
+        self.bot.answered_store = AnsweredStore(await self.create_db())
+        await self.bot._remember_answer(room_id, "mxc://example.com/image", EventID("$reply"))
+        self.bot.answered.clear()
+
+        # Act
+        result = await self.bot._get_answer(room_id, "mxc://example.com/image")
+
+        # Assert
+        self.assertEqual(result, "$reply")
+        self.assertEqual(self.bot.answered.get((room_id, "mxc://example.com/image")), "$reply")
+
+    async def test_search_when_result_is_cached_then_skip_api(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        response = SearchResponse.from_json(self.api_response_data)
+        await self.bot.result_cache.put(self.bot._get_cache_key(url), response)
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock()
+
+        # Act
+        result = await self.bot._search(url, "", "")
+
+        # Assert
+        self.assertEqual(result, response)
+        self.bot._validate_external_url.assert_not_called()
+        self.bot._trace_by_external_url.assert_not_called()
+
+    async def test_search_when_same_file_under_different_url_then_use_cached_result(self):
+        # Arrange
+        response = SearchResponse.from_json(self.api_response_data)
+        self.bot._get_matrix_media = AsyncMock(return_value=b"image_data")
+        self.bot._trace_by_media = AsyncMock(return_value=response)
+        await self.bot._search("", "mxc://matrix.example.com/first", "image/png")
+
+        # Act
+        result = await self.bot._search("", "mxc://matrix.example.com/second", "image/png")
+
+        # Assert
+        self.assertEqual(result, response)
+        self.assertEqual(self.bot._get_matrix_media.call_count, 2)
+        self.bot._trace_by_media.assert_called_once()
+
+    async def test_get_media_digest_when_hashed_then_use_cpu_pool(self):
+        # Arrange
+        data = b"image_data"
+
+        # Act
+        digest = await self.bot._get_media_digest(data)
+
+        # Assert
+        self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+        self.assertEqual(self.bot.cpu_pool.stats()["completed"], 1)
+
+    async def test_get_media_digest_when_cpu_pool_is_full_then_hash_inline(self):
+        # Arrange
+        data = b"image_data"
+        self.bot.cpu_pool.run = AsyncMock(side_effect=PoolFullError("CPU pool is full (5 jobs)"))
+
+        # Act
+        digest = await self.bot._get_media_digest(data)
+
+        # Assert
+        self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+
+    async def test_sqlite_backend_when_used_by_two_instances_then_share_locks_slots_and_quota(self):
+        # Arrange
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "shared.db")
+        first = SQLiteBackend(path)
+        second = SQLiteBackend(path)
+        self.addAsyncCleanup(first.close)
+        self.addAsyncCleanup(second.close)
+        await first.sync_quota(2, 1)
+
+        # Act
+        first_lock = await first.try_lock("key", "first", 60)
+        second_lock = await second.try_lock("key", "second", 60)
+        first_slot = await first.try_acquire_slot("first", 1, 60)
+        second_slot = await second.try_acquire_slot("second", 1, 60)
+        await first.release_slot("first")
+        second_slot_after_release = await second.try_acquire_slot("second", 1, 60)
+        first_quota = await first.take_quota()
+        second_quota = await second.take_quota()
+        await second.set_result("key", b"data", 60)
+        result = await first.get_result("key")
+
+        # Assert
+        self.assertTrue(first_lock)
+        self.assertFalse(second_lock)
+        self.assertTrue(first_slot)
+        self.assertFalse(second_slot)
+        self.assertTrue(second_slot_after_release)
+        self.assertTrue(first_quota)
+        self.assertFalse(second_quota)
+        self.assertEqual(result, b"data")
+
+    async def test_search_when_same_media_requested_concurrently_then_search_once(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        response = SearchResponse.from_json(self.api_response_data)
+
+        async def trace(_):
+            await asyncio.sleep(0.1)
+            return response
+
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock(side_effect=trace)
+
+        # Act
+        results = await asyncio.gather(self.bot._search(url, "", ""), self.bot._search(url, "", ""))
+
+        # Assert
+        self.assertEqual(results, [response, response])
+        self.bot._trace_by_external_url.assert_called_once()
+
+    async def test_search_when_quota_exhausted_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        await self.bot.shared.sync_quota(100, 100)
+        self.bot._validate_external_url = AsyncMock()
+        self.bot.http.get = AsyncMock()
+
+        with self.assertLogs(self.bot.log, level='ERROR') as logger:
+            # Assert
+            with self.assertRaisesRegex(ClientError, "trace.moe search quota exhausted"):
+                # Act
+                await self.bot._search(url, "", "")
+
+            # Assert
+            self.assertEqual(['ERROR:testlogger:trace.moe search quota exhausted'], logger.output)
+            self.bot.http.get.assert_not_called()
+
+    async def test_search_when_nothing_found_recently_then_skip_api(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock(
+            return_value=SearchResponse(error="", results=())
+        )
+
+        # Act
+        await self.bot._search(url, "", "")
+        response = await self.bot._search(url, "", "")
+
+        # Assert
+        self.assertEqual(response, SearchResponse(error="", results=()))
+        self.bot._trace_by_external_url.assert_called_once()
+
+    async def test_search_when_api_rejected_media_recently_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        error = ClientError("Connection to trace.moe API failed.")
+        error.__cause__ = ClientResponseError(None, (), status=400)
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock(side_effect=error)
+
+        with self.assertRaisesRegex(ClientError, "Connection to trace.moe API failed."):
+            await self.bot._search(url, "", "")
+
+        # Assert
+        with self.assertRaisesRegex(ClientError, "Connection to trace.moe API failed."):
+            # Act
+            await self.bot._search(url, "", "")
+        self.bot._trace_by_external_url.assert_called_once()
+
+    async def test_search_when_api_unavailable_then_retry(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        error = ClientError("Connection to trace.moe API failed.")
+        error.__cause__ = ClientResponseError(None, (), status=503)
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock(side_effect=error)
+
+        # Act
+        for _ in range(2):
+            with self.assertRaises(ClientError):
+                await self.bot._search(url, "", "")
+
+        # Assert
+        self.assertEqual(self.bot._trace_by_external_url.call_count, 2)
+
+    async def test_search_when_speculative_then_validate_and_search_at_once(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        response = SearchResponse.from_json(self.api_response_data)
+        self.bot.speculative_search = True
+        validated = asyncio.Event()
+
+        async def trace(media_url):
+            # The search starts before the validation has finished
+            self.assertFalse(validated.is_set())
+            return response
+
+        async def validate(media_url):
+            await asyncio.sleep(0)
+            validated.set()
+
+        self.bot._validate_external_url = AsyncMock(side_effect=validate)
+        self.bot._trace_by_external_url = AsyncMock(side_effect=trace)
+
+        # Act
+        result = await self.bot._search(url, "", "")
+
+        # Assert
+        self.assertEqual(result, response)
+        self.bot._validate_external_url.assert_called_once_with(url)
+
+    async def test_search_when_speculative_and_validation_fails_then_cancel_search(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.speculative_search = True
+        trace_started = asyncio.Event()
+
+        async def trace(media_url):
+            trace_started.set()
+            await asyncio.sleep(10)
+
+        async def validate(media_url):
+            await trace_started.wait()
+            raise ValueError("External file type not supported: text/html")
+
+        self.bot._validate_external_url = AsyncMock(side_effect=validate)
+        self.bot._trace_by_external_url = AsyncMock(side_effect=trace)
+
+        # Assert
+        with self.assertRaisesRegex(ValueError, "External file type not supported"):
+            # Act
+            await asyncio.wait_for(self.bot._search(url, "", ""), 1)
+
+    async def test_search_when_speculative_and_host_trusted_then_skip_validation(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        response = SearchResponse.from_json(self.api_response_data)
+        self.bot.speculative_search = True
+        self.bot.trusted_hosts.set("example.com", self.bot.trusted_host_checks)
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock(return_value=response)
+
+        # Act
+        result = await self.bot._search(url, "", "")
+
+        # Assert
+        self.assertEqual(result, response)
+        self.bot._validate_external_url.assert_not_called()
+
+    async def test_search_when_trusted_host_link_rejected_by_api_then_distrust_host(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.speculative_search = True
+        self.bot.trusted_hosts.set("example.com", self.bot.trusted_host_checks)
+        self.bot._trace_by_external_url = AsyncMock(
+            return_value=SearchResponse(error="Failed to fetch image", results=())
+        )
+
+        # Act
+        await self.bot._search(url, "", "")
+
+        # Assert
+        self.assertNotIn("example.com", self.bot.trusted_hosts)
+
+    async def test_trace_by_external_url_when_url_is_correct_then_return_search_response(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.get = AsyncMock(
+            return_value=await self.create_resp(200, json=self.api_response_data)
+        )
+
+        # Act
+        response = await self.bot._trace_by_external_url(url)
+
+        # Assert
+        self.assertEqual(response, SearchResponse.from_json(self.api_response_data))
+
+    async def test_trace_by_external_url_when_response_is_malformed_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.get = AsyncMock(return_value=await self.create_resp(200, json={"result": 1}))
+
+        with self.assertLogs(self.bot.log, level='ERROR') as logger:
+            # Assert
+            with self.assertRaisesRegex(ClientError, "Invalid response from trace.moe API"):
+                # Act
+                await self.bot._trace_by_external_url(url)
+
+            # Assert
+            self.assertEqual(
+                ['ERROR:testlogger:Invalid response from trace.moe API: Malformed search response'],
+                logger.output
+            )
+
+    async def test_trace_by_external_url_when_aiohttp_error_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.get = AsyncMock(side_effect=ClientError)
+
+        with self.assertLogs(self.bot.log, level='ERROR') as logger:
+            # Assert
+            with self.assertRaisesRegex(ClientError, "Connection to trace.moe API failed"):
+                # Act
+                await self.bot._trace_by_external_url(url)
+
+            # Assert
+            self.assertEqual(
+                ['ERROR:testlogger:Connection to trace.moe API failed: '],
+                logger.output
+            )
+
+    async def test_trace_by_external_url_when_endpoint_fails_then_fail_over_to_next_one(self):
+        # Arrange
+        primary = Endpoint(url="https://api.trace.moe", api_key="public")
+        replica = Endpoint(url="https://trace.example.com", api_key="own")
+        self.bot.search_backend = PriorityBackend([primary, replica])
+        response = await self.create_resp(200, json=self.api_response_data)
+        self.bot.http.get = AsyncMock(side_effect=[
+            ClientResponseError(MagicMock(), (), status=503),
+            response,
+            response
+        ])
+
+        # Act
+        with self.assertLogs(self.bot.log, level="ERROR"):
+            first = await self.bot._trace_by_external_url("https://example.com/image.png")
+        second = await self.bot._trace_by_external_url("https://example.com/image.png")
+
+        # Assert
+        self.assertEqual(first, SearchResponse.from_json(self.api_response_data))
+        self.assertEqual(second, first)
+        urls = [call.args[0] for call in self.bot.http.get.call_args_list]
+        self.assertEqual(urls, [
+            "https://api.trace.moe/search?anilistInfo",
+            "https://trace.example.com/search?anilistInfo",
+            "https://trace.example.com/search?anilistInfo"
+        ])
+        keys = [call.kwargs["headers"]["x-trace-key"] for call in self.bot.http.get.call_args_list]
+        self.assertEqual(keys, ["public", "own", "own"])
+        self.assertEqual(primary.failures, 1)
+        self.assertEqual(replica.samples, 2)
+
+    async def test_trace_by_external_url_when_primary_quota_exhausted_then_use_replica(self):
+        # Arrange
+        primary = Endpoint(url="https://api.trace.moe")
+        replica = Endpoint(url="https://trace.example.com", concurrency=1)
+        self.bot.search_backend = PriorityBackend([primary, replica])
+        await self.bot.shared.sync_quota(100, 100)
+        self.bot.http.get = AsyncMock(
+            return_value=await self.create_resp(200, json=self.api_response_data)
+        )
+
+        # Act
+        with self.assertLogs(self.bot.log, level="ERROR"):
+            result = await self.bot._trace_by_external_url("https://example.com/image.png")
+
+        # Assert
+        self.assertEqual(result, SearchResponse.from_json(self.api_response_data))
+        self.bot.http.get.assert_called_once()
+        self.assertEqual(
+            self.bot.http.get.call_args.args[0],
+            "https://trace.example.com/search?anilistInfo"
+        )
+        self.assertTrue(primary.healthy)
+        self.assertEqual(replica.active, 0)
+
+    async def test_trace_by_external_url_when_replica_used_then_primary_quota_not_charged(self):
+        # Arrange
+        replica = Endpoint(url="https://trace.example.com")
+        self.bot.search_backend = PriorityBackend([Endpoint(url="https://api.trace.moe"), replica])
+        self.bot.search_backend.record(self.bot.search_backend.primary, 1.0, True)
+        await self.bot.shared.sync_quota(100, 99)
+        self.bot.http.get = AsyncMock(
+            return_value=await self.create_resp(200, json=self.api_response_data)
+        )
+
+        # Act
+        await self.bot._trace_by_external_url("https://example.com/image.png")
+        await self.bot._trace_by_external_url("https://example.com/image.png")
+
+        # Assert
+        self.assertEqual(self.bot.http.get.call_count, 2)
+        self.assertTrue(await self.bot.shared.take_quota())
+
+    async def test_api_key_slot_when_limit_not_loaded_then_use_default_concurrency(self):
+        # Arrange
+        self.bot.config = {"default_concurrency": 2}
+        self.bot.search_backend = PriorityBackend([
+            Endpoint(url="https://api.trace.moe"),
+            Endpoint(url="https://trace.example.com")
+        ])
+        self.bot._get_quota = AsyncMock(return_value=None)
+
+        # Act
+        concurrency = self.bot._get_search_concurrency()
+        async with self.bot._api_key_slot(), self.bot._api_key_slot():
+            with self.assertRaises(ClientError):
+                async with self.bot._api_key_slot(wait=False):
+                    pass
+
+        # Assert
+        self.assertEqual(concurrency, 4)
+
+    async def test_search_when_shared_backend_fails_then_use_local_state(self):
+        # Arrange
+        error = sqlite3.OperationalError("database is locked")
+        self.bot.shared = MagicMock()
+        for name in ("lock", "unlock", "acquire_slot", "release_slot", "take_quota", "sync_quota"):
+            setattr(self.bot.shared, name, AsyncMock(side_effect=error))
+        self.bot.local_state = LocalBackend()
+        self.bot.quota = QuotaState()
+        self.bot._get_quota = AsyncMock(
+            return_value=QuotaInfo(priority=0, concurrency=1, quota=1000, quota_used=10)
+        )
+        self.bot._validate_external_url = AsyncMock()
+        self.bot.http.get = AsyncMock(
+            return_value=await self.create_resp(200, json=self.api_response_data)
+        )
+
+        # Act
+        with self.assertLogs(self.bot.log, level="WARNING") as logs:
+            result = await self.bot._search("https://example.com/image.png", "", "")
+
+        # Assert
+        self.assertEqual(result, SearchResponse.from_json(self.api_response_data))
+        self.assertEqual(len(logs.records), 4)
+        self.assertEqual(self.bot.local_state._quota_used, 11)
+        self.assertEqual((self.bot.local_state._locks, self.bot.local_state._slots), ({}, {}))
+
+    async def test_trace_by_media_when_media_rejected_then_skip_other_endpoints(self):
+        # Arrange
+        self.bot.search_backend = PriorityBackend([
+            Endpoint(url="https://api.trace.moe"),
+            Endpoint(url="https://trace.example.com")
+        ])
+        self.bot.http.post = AsyncMock(side_effect=ClientResponseError(MagicMock(), (), status=400))
+
+        # Act
+        with self.assertLogs(self.bot.log, level="ERROR"):
+            with self.assertRaises(ClientError) as context:
+                await self.bot._trace_by_media(b"image_data", "image/png")
+
+        # Assert
+        self.bot.http.post.assert_called_once()
+        self.assertIsInstance(context.exception.__cause__, ClientResponseError)
+        self.assertTrue(self.bot.search_backend.primary.healthy)
+
+    async def test_latency_backend_route(self):
+        # Arrange
+        fast = Endpoint(url="https://fast.example.com")
+        slow = Endpoint(url="https://slow.example.com")
+        new = Endpoint(url="https://new.example.com")
+        down = Endpoint(url="https://down.example.com")
+        backend = LatencyBackend([slow, down, fast, new])
+        backend.record(slow, 2.0, False)
+        backend.record(fast, 0.5, False)
+        backend.record(down, 0.1, False)
+        backend.record(down, 0.1, True)
+
+        # Act
+        route = backend.route()
+        down.retry_at = 0
+        recovered = backend.route()
+
+        # Assert
+        self.assertEqual(route, [new, fast, slow, down])
+        self.assertEqual(recovered, [new, down, fast, slow])
+        self.assertIs(backend.primary, slow)
+
+    async def test_validate_external_url_when_content_type_is_correct_then_return_None(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        content_types = ["image/png", "video/mp4"]
+        for content_type in content_types:
+            with self.subTest(content_type=content_type):
+                self.bot.validation_cache.clear()
+                self.bot.http.head = AsyncMock(
+                    return_value=await self.create_resp(
+                        200,
+                        content_type=content_type,
+                        content_length=self.bot.size_limit
+                    )
+                )
+
+                # Act
+                result = await self.bot._validate_external_url(url)
+
+                # Assert
+                self.assertEqual(result, None)
+
+    async def test_validate_external_url_when_content_length_is_correct_then_return_None(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        content_lengths = [self.bot.size_limit, None]
+        for content_length in content_lengths:
+            with self.subTest(content_length=content_length):
+                self.bot.validation_cache.clear()
+                self.bot.http.head = AsyncMock(
+                    return_value=await self.create_resp(
+                        200,
+                        content_type="image/png",
+                        content_length=content_length
+                    )
+                )
+
+                # Act
+                result = await self.bot._validate_external_url(url)
+
+                # Assert
+                self.assertEqual(result, None)
+
+    async def test_validate_external_url_when_aiohttp_error_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.head = AsyncMock(side_effect=ClientError)
+
+        with self.assertLogs(self.bot.log, level='ERROR') as logger:
+            # Assert
+            with self.assertRaisesRegex(ClientError, f"Connection to {url} failed."):
+                # Act
+                await self.bot._validate_external_url(url)
+
+            # Assert
+            self.assertEqual(
+                ['ERROR:testlogger:Connection failed during checks of image from external URL: '],
+                logger.output
+            )
+
+    async def test_validate_external_url_when_wrong_content_type_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        content_types = [("text/html", "text/html"), (None, "unknown")]
+        for content_type in content_types:
+            with self.subTest(content_type=content_type):
+                self.bot.validation_cache.clear()
+                self.bot.http.head = AsyncMock(
+                    return_value=await self.create_resp(
+                        200,
+                        content_type=content_type[0],
+                        content_length=self.bot.size_limit
+                    )
+                )
+                with self.assertLogs(self.bot.log, level='ERROR') as logger:
+                    # Assert
+                    with self.assertRaisesRegex(ValueError, ""):
+                        # Act
+                        await self.bot._validate_external_url(url)
+
+                    # Assert
+                    self.assertEqual(
+                        [f'ERROR:testlogger:External file type not supported: {content_type[1]}'],
+                        logger.output
+                    )
+
+    async def test_validate_external_url_when_wrong_size_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.head = AsyncMock(
+            return_value=await self.create_resp(
+                200,
+                content_type="image/png",
+                content_length=self.bot.size_limit + 1
+            )
+        )
+
+        with self.assertLogs(self.bot.log, level='ERROR') as logger:
+            # Assert
+            with self.assertRaisesRegex(ValueError, "External image size too big"):
+                # Act
+                await self.bot._validate_external_url(url)
+
+            # Assert
+            self.assertEqual(
+                ['ERROR:testlogger:External image size too big: 25 000 001'],
+                logger.output
+            )
+
+    async def test_validate_external_url_when_rejected_recently_then_skip_request(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.head = AsyncMock(
+            return_value=await self.create_resp(200, content_type="text/html")
+        )
+        with self.assertLogs(self.bot.log, level='ERROR'):
+            with self.assertRaises(ValueError):
+                await self.bot._validate_external_url(url)
+
+        # Assert
+        with self.assertRaisesRegex(ValueError, "External file type not supported: text/html"):
+            # Act
+            await self.bot._validate_external_url(url)
+        self.bot.http.head.assert_called_once()
+
+    async def test_validate_external_url_when_checked_recently_then_skip_request(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.head = AsyncMock(
+            return_value=await self.create_resp(200, content_type="image/png")
+        )
+
+        # Act
+        await self.bot._validate_external_url(url)
+        result = await self.bot._validate_external_url(url)
+
+        # Assert
+        self.assertEqual(result, None)
+        self.bot.http.head.assert_called_once()
+
+    async def test_validate_external_url_when_host_failed_recently_then_skip_request(self):
+        # Arrange
+        self.bot.http.head = AsyncMock(side_effect=ClientError)
+        with self.assertLogs(self.bot.log, level='ERROR'):
+            with self.assertRaises(ClientError):
+                await self.bot._validate_external_url("https://example.com/image.png")
+
+        # Assert
+        with self.assertRaisesRegex(ClientError, "Connection to https://example.com/other.png failed."):
+            # Act
+            await self.bot._validate_external_url("https://example.com/other.png")
+        self.bot.http.head.assert_called_once()
+
+    async def test_validate_external_url_when_link_not_found_then_keep_host(self):
+        # Arrange
+        self.bot.http.head = AsyncMock(side_effect=ClientResponseError(MagicMock(), (), status=404))
+        with self.assertLogs(self.bot.log, level='ERROR'):
+            with self.assertRaises(ClientError):
+                await self.bot._validate_external_url("https://example.com/image.png")
+        self.bot.http.head = AsyncMock(
+            return_value=await self.create_resp(200, content_type="image/png")
+        )
+
+        # Act
+        result = await self.bot._validate_external_url("https://example.com/other.png")
+
+        # Assert
+        self.assertEqual(result, None)
+        self.bot.http.head.assert_called_once()
+
+    async def test_validate_external_url_when_valid_then_count_trusted_host(self):
+        # Arrange
+        self.bot.http.head = AsyncMock(
+            return_value=await self.create_resp(200, content_type="image/png")
+        )
+
+        # Act
+        for i in range(3):
+            await self.bot._validate_external_url(f"https://example.com/{i}.png")
+
+        # Assert
+        self.assertEqual(self.bot.trusted_hosts.get("example.com"), 3)
+
+    async def test_validate_external_url_when_invalid_then_distrust_host(self):
+        # Arrange
+        self.bot.trusted_hosts.set("example.com", 3)
+        self.bot.http.head = AsyncMock(
+            return_value=await self.create_resp(200, content_type="text/html")
+        )
+
+        with self.assertLogs(self.bot.log, level='ERROR'):
+            with self.assertRaises(ValueError):
+                # Act
+                await self.bot._validate_external_url("https://example.com/page.html")
+
+        # Assert
+        self.assertNotIn("example.com", self.bot.trusted_hosts)
+
+    @staticmethod
+    def create_mp4(width, height, duration, timescale=1000, version=0):
+        def box(kind, payload):
+            return (8 + len(payload)).to_bytes(4, "big") + kind + payload
+
+        if version == 1:
+            mvhd = b"\x01\x00\x00\x00" + bytes(16) + timescale.to_bytes(4, "big") \
+                + duration.to_bytes(8, "big") + bytes(80)
+            tkhd = b"\x01\x00\x00\x03" + bytes(84)
+        else:
+            mvhd = bytes(12) + timescale.to_bytes(4, "big") + duration.to_bytes(4, "big") + bytes(80)
+            tkhd = b"\x00\x00\x00\x03" + bytes(72)
+        tkhd += (width << 16).to_bytes(4, "big") + (height << 16).to_bytes(4, "big")
+        audio_tkhd = b"\x00\x00\x00\x03" + bytes(80)
+        moov = box(b"mvhd", mvhd) + box(b"trak", box(b"tkhd", audio_tkhd)) \
+            + box(b"trak", box(b"tkhd", tkhd))
+        return box(b"ftyp", b"isom\x00\x00\x02\x00") + box(b"mdat", bytes(32)) + box(b"moov", moov)
+
+    async def test_image_dimensions_when_header_readable_then_return_dimensions(self):
+        # Arrange
+        formats = (
+            ("PNG", {}),
+            ("GIF", {}),
+            ("JPEG", {}),
+            ("JPEG", {"progressive": True}),
+            ("WEBP", {}),
+            ("WEBP", {"lossless": True}),
+            ("WEBP", {"exif": b"Exif\x00\x00"})
+        )
+        for image_format, options in formats:
+            with self.subTest(image_format=image_format, options=options):
+                output = io.BytesIO()
+                Image.new("RGB", (321, 123)).save(output, format=image_format, **options)
+
+                # Act
+                result = image_dimensions(output.getvalue())
+
+                # Assert
+                self.assertEqual(result, (321, 123))
+
+    async def test_image_dimensions_when_header_unreadable_then_return_None(self):
+        # Arrange
+        images = (b"", b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff\xe0\x00\x10JFIF", b"BM", "string")
+        for image in images:
+            with self.subTest(image=image):
+                # Act
+                result = image_dimensions(image)
+
+                # Assert
+                self.assertIsNone(result)
+
+    async def test_video_info_when_moov_readable_then_return_dimensions_and_duration(self):
+        # Arrange
+        videos = (
+            (self.create_mp4(640, 360, 3000), (640, 360, 3000)),
+            (self.create_mp4(1280, 720, 27000, timescale=12800, version=1), (1280, 720, 2109)),
+            (self.create_mp4(640, 360, 0), (640, 360, None))
+        )
+        for video, expected_result in videos:
+            with self.subTest(expected_result=expected_result):
+                # Act
+                result = video_info(video)
+
+                # Assert
+                self.assertEqual(result, expected_result)
+
+    async def test_video_info_when_moov_unreadable_then_return_None(self):
+        # Arrange
+        videos = (b"video_data", self.create_mp4(640, 360, 3000)[:-20], b"")
+        for video in videos:
+            with self.subTest(video=video[:8]):
+                # Act
+                result = video_info(video)
+
+                # Assert
+                self.assertIsNone(result)
+
+    async def create_download(self, chunks, content_type="image/png", content_length=None):
+        async def iter_chunked(size):
+            for chunk in chunks:
+                yield chunk
+
+        resp = MagicMock(content_type=content_type, content_length=content_length)
+        resp.content.iter_chunked = iter_chunked
+        download = MagicMock()
+        download.__aenter__.return_value = resp
+        return download
+
+    async def test_canonicalize_url(self):
+        # Arrange
+        urls = (
+            (
+                "HTTPS://Example.COM/image.png?utm_source=x&id=1&fbclid=abc#top",
+                "https://example.com/image.png?id=1"
+            ),
+            (
+                "https://media.discordapp.net/attachments/1/2/a.png?ex=1&is=2&hm=3&width=400&height=300",
+                "https://media.discordapp.net/attachments/1/2/a.png?ex=1&is=2&hm=3&width=400&height=300"
+            ),
+            (
+                "https://cdn.discordapp.com/attachments/1/2/a.png?ex=1&is=2&hm=3&width=3840&height=2160&format=webp",
+                "https://media.discordapp.net/attachments/1/2/a.png?ex=1&is=2&hm=3&width=1280&height=720"
+            ),
+            (
+                "https://cdn.discordapp.com/attachments/1/2/a.png?ex=1&is=2&hm=3",
+                "https://cdn.discordapp.com/attachments/1/2/a.png?ex=1&is=2&hm=3"
+            ),
+            (
+                "https://pbs.twimg.com/media/FxAbC-1?format=png&name=orig",
+                "https://pbs.twimg.com/media/FxAbC-1?format=png&name=medium"
+            ),
+            (
+                "https://pbs.twimg.com/media/FxAbC-1.jpg:thumb",
+                "https://pbs.twimg.com/media/FxAbC-1?format=jpg&name=medium"
+            ),
+            ("https://i.imgur.com/AbCdEfG.jpg", "https://i.imgur.com/AbCdEfGh.jpg"),
+            ("https://i.imgur.com/AbCdEfGs.png", "https://i.imgur.com/AbCdEfGh.png"),
+            ("https://i.imgur.com/AbCdE.gifv", "https://i.imgur.com/AbCdE.mp4"),
+            ("https://imgur.com/AbCdEfG", "https://i.imgur.com/AbCdEfGh.jpg"),
+            ("https://imgur.com/a/AbCdEfG", "https://imgur.com/a/AbCdEfG"),
+            ("https://imgur.com/about", "https://imgur.com/about"),
+            ("https://imgur.com/upload", "https://imgur.com/upload"),
+            (
+                "https://i.pximg.net/c/250x250_80_a2/img-master/img/2024/01/01/00/00/00/1_p0_square1200.jpg",
+                "https://i.pximg.net/img-master/img/2024/01/01/00/00/00/1_p0_master1200.jpg"
+            ),
+            (
+                "https://i.pixiv.cat/img-master/img/2024/01/01/00/00/00/1_p0_master1200.jpg",
+                "https://i.pixiv.re/img-master/img/2024/01/01/00/00/00/1_p0_master1200.jpg"
+            ),
+            ("https://example.com/a%20b.png?q=a%2Bb", "https://example.com/a%20b.png?q=a%2Bb"),
+            ("ftp://example.com/image.png", "ftp://example.com/image.png")
+        )
+        for url, expected_result in urls:
+            with self.subTest(url=url):
+                # Act
+                result = canonicalize_url(url)
+
+                # Assert
+                self.assertEqual(result, expected_result)
+
+    async def test_canonicalize_url_when_pixiv_proxy_set_then_route_pixiv_links_through_it(self):
+        # Arrange
+        urls = (
+            "https://i.pximg.net/img-master/img/2024/01/01/00/00/00/1_p0_master1200.jpg",
+            "https://i.pixiv.nl/img-master/img/2024/01/01/00/00/00/1_p0_master1200.jpg"
+        )
+
+        for url in urls:
+            with self.subTest(url=url):
+                # Act
+                result = canonicalize_url(url, "pixiv.example.com")
+
+                # Assert
+                self.assertEqual(
+                    result,
+                    "https://pixiv.example.com/img-master/img/2024/01/01/00/00/00/1_p0_master1200.jpg"
+                )
+
+    async def test_extract_media_items_when_link_has_tracking_parameters_then_strip_them(self):
+        # Arrange
+        msg_event = MagicMock()
+        msg_event.content.msgtype = MessageType.TEXT
+        query = ("https://example.com/image.png?utm_source=chat", "")
+
+        # Act
+        result = await self.bot._extract_media_items(msg_event, EventID(""), query)
+
+        # Assert
+        self.assertEqual(result, [("https://example.com/image.png", "", "")])
+
+    async def test_download_external_media_when_successful_then_return_data(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.http.get = MagicMock(return_value=await self.create_download([b"ab", b"cd"]))
+
+        # Act
+        data, content_type = await self.bot._download_external_media(url)
+
+        # Assert
+        self.assertEqual(data, b"abcd")
+        self.assertEqual(content_type, "image/png")
+
+    async def test_download_external_media_when_too_big_without_length_then_stop_reading(self):
+        # Arrange
+        url = "https://example.com/image.png"
+        self.bot.size_limit = 3
+        self.bot.http.get = MagicMock(
+            return_value=await self.create_download([b"ab", b"cd", b"ef"])
+        )
+
+        with self.assertLogs(self.bot.log, level='ERROR') as logger:
+            # Assert
+            with self.assertRaisesRegex(ValueError, "External image size too big: 4 bytes"):
+                # Act
+                await self.bot._download_external_media(url)
+
+            # Assert
+            self.assertEqual(['ERROR:testlogger:External image size too big: 4'], logger.output)
+
+    async def test_download_external_media_when_wrong_content_type_then_raise_exception(self):
+        # Arrange
+        url = "https://example.com/page.html"
+        self.bot.http.get = MagicMock(
+            return_value=await self.create_download([b"<html>"], content_type="text/html")
+        )
+
+        with self.assertLogs(self.bot.log, level='ERROR'):
+            # Assert
+            with self.assertRaisesRegex(ValueError, "External file type not supported: text/html"):
+                # Act
+                await self.bot._download_external_media(url)
+
+    async def test_downscale_image_when_big_then_shrink_to_jpeg(self):
+        # Arrange
+        output = io.BytesIO()
+        Image.new("RGB", (2560, 1440)).save(output, format="PNG")
+
+        # Act
+        data, content_type = self.bot._downscale_image(output.getvalue(), "image/png")
+
+        # Assert
+        self.assertEqual(content_type, "image/jpeg")
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.size, (1280, 720))
+
+    async def test_downscale_image_when_small_or_video_then_keep_file(self):
+        # Arrange
+        output = io.BytesIO()
+        Image.new("RGB", (640, 360)).save(output, format="PNG")
+        files = [(output.getvalue(), "image/png"), (b"video", "video/mp4")]
+        for data, content_type in files:
+            with self.subTest(content_type=content_type):
+                # Act
+                result = self.bot._downscale_image(data, content_type)
+
+                # Assert
+                self.assertEqual(result, (data, content_type))
+
+    async def test_process_thumbnail_when_reencoded_is_smaller_then_use_it(self):
+        # Arrange
+        image = Image.new("RGB", (640, 360))
+        image.putdata([(x % 256, y % 256, 128) for y in range(360) for x in range(640)])
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+
+        # Act
+        data, content_type, thumbnail_hash = self.bot._process_thumbnail(
+            output.getvalue(), "image/png", "webp", 320, False
         )
 
         # Assert
-        self.assertEqual(media_external_url, "")
-        self.assertEqual(media_url, url)
-        self.assertEqual(content_type, mimetype)
+        self.assertEqual(content_type, "image/webp")
+        self.assertLess(len(data), len(output.getvalue()))
+        self.assertEqual(image_dimensions(data), (320, 180))
+        self.assertEqual(thumbnail_hash, None)
 
-    async def test_trace_by_external_url_when_url_is_correct_then_return_json(self):
+    async def test_process_thumbnail_when_reencoded_is_bigger_or_invalid_then_keep_thumbnail(self):
         # Arrange
-        url = "https://example.com/image.png"
-        json_data = {'test': 1}
-        self.bot.http.get = AsyncMock(return_value=await self.create_resp(200, json=json_data))
+        output = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(output, format="WEBP")
+        files = [(output.getvalue(), "image/webp"), (b"image", "image/png")]
+        for data, content_type in files:
+            with self.subTest(content_type=content_type):
+                # Act
+                result = self.bot._process_thumbnail(data, content_type, "jpeg", 320, False)
+
+                # Assert
+                self.assertEqual(result, (data, content_type, None))
+
+    async def test_optimize_thumbnail_when_disabled_then_keep_thumbnail(self):
+        # Arrange
+        self.bot.config = {"thumbnail_format": "original", "blurhash": "no"}
+        self.bot.cpu_pool.run = AsyncMock()
 
         # Act
-        json_response = await self.bot._trace_by_external_url(url)
+        result = await self.bot._optimize_thumbnail(b"image", "image/png")
 
         # Assert
-        self.assertEqual(json_response, json_data)
+        self.assertEqual(result, (b"image", "image/png", None))
+        self.bot.cpu_pool.run.assert_not_called()
 
-    async def test_trace_by_external_url_when_aiohttp_error_then_raise_exception(self):
+    @unittest.skipUnless(blurhash_available(), "NumPy isn't installed")
+    async def test_encode_blurhash(self):
         # Arrange
-        url = "https://example.com/image.png"
-        self.bot.http.get = AsyncMock(side_effect=ClientError)
+        image = Image.new("RGB", (128, 72))
+        image.putdata([(x * 2, y * 3, 128) for y in range(72) for x in range(128)])
 
-        with self.assertLogs(self.bot.log, level='ERROR') as logger:
-            # Assert
-            with self.assertRaisesRegex(ClientError, "Connection to trace.moe API failed"):
-                # Act
-                await self.bot._trace_by_external_url(url)
+        # Act
+        result = encode_blurhash(image)
 
-            # Assert
-            self.assertEqual(
-                ['ERROR:testlogger:Connection to trace.moe API failed: '],
-                logger.output
-            )
+        # Assert
+        self.assertEqual(result, "L$HUIX2Y$5Sgmaazjtf7gJfQfQfQ")
 
-    async def test_validate_external_url_when_content_type_is_correct_then_return_None(self):
+    async def test_search_when_local_fetch_then_download_and_upload(self):
         # Arrange
         url = "https://example.com/image.png"
-        content_types = ["image/png", "video/mp4"]
-        for content_type in content_types:
-            with self.subTest(content_type=content_type):
-                self.bot.http.head = AsyncMock(
-                    return_value=await self.create_resp(
-                        200,
-                        content_type=content_type,
-                        content_length=self.bot.size_limit
-                    )
-                )
+        response = SearchResponse.from_json(self.api_response_data)
+        self.bot.fetch_strategy = LOCAL
+        self.bot.downscale = False
+        self.bot._download_external_media = AsyncMock(return_value=(b"image_data", "image/png"))
+        self.bot._trace_by_media = AsyncMock(return_value=response)
+        self.bot._trace_by_external_url = AsyncMock()
 
-                # Act
-                result = await self.bot._validate_external_url(url)
+        # Act
+        result = await self.bot._search(url, "", "")
 
-                # Assert
-                self.assertEqual(result, None)
+        # Assert
+        self.assertEqual(result, response)
+        self.bot._trace_by_media.assert_called_once_with(b"image_data", "image/png")
+        self.bot._trace_by_external_url.assert_not_called()
 
-    async def test_validate_external_url_when_content_length_is_correct_then_return_None(self):
+    async def test_search_when_auto_and_api_cannot_fetch_then_download(self):
         # Arrange
         url = "https://example.com/image.png"
-        content_lengths = [self.bot.size_limit, None]
-        for content_length in content_lengths:
-            with self.subTest(content_length=content_length):
-                self.bot.http.head = AsyncMock(
-                    return_value=await self.create_resp(
-                        200,
-                        content_type="image/png",
-                        content_length=content_length
-                    )
-                )
+        response = SearchResponse.from_json(self.api_response_data)
+        error = ClientError("Connection to trace.moe API failed.")
+        error.__cause__ = ClientResponseError(None, (), status=400)
+        self.bot.fetch_strategy = "auto"
+        self.bot.downscale = False
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock(side_effect=error)
+        self.bot._download_external_media = AsyncMock(return_value=(b"image_data", "image/png"))
+        self.bot._trace_by_media = AsyncMock(return_value=response)
 
-                # Act
-                result = await self.bot._validate_external_url(url)
+        # Act
+        result = await self.bot._search(url, "", "")
 
-                # Assert
-                self.assertEqual(result, None)
+        # Assert
+        self.assertEqual(result, response)
+        stats = self.bot.fetch_selector.stats("example.com")
+        self.assertEqual(stats.strategies[REMOTE].failure_rate, 1.0)
+        self.assertEqual(stats.strategies[LOCAL].failure_rate, 0.0)
 
-    async def test_validate_external_url_when_aiohttp_error_then_raise_exception(self):
+    async def test_search_when_auto_and_api_is_down_then_neither_download_nor_blame_host(self):
         # Arrange
         url = "https://example.com/image.png"
-        self.bot.http.head = AsyncMock(side_effect=ClientError)
+        error = ClientError("Connection to trace.moe API failed.")
+        error.__cause__ = ClientResponseError(None, (), status=503)
+        self.bot.fetch_strategy = "auto"
+        self.bot._validate_external_url = AsyncMock()
+        self.bot._trace_by_external_url = AsyncMock(side_effect=error)
+        self.bot._download_external_media = AsyncMock()
 
-        with self.assertLogs(self.bot.log, level='ERROR') as logger:
-            # Assert
-            with self.assertRaisesRegex(ClientError, f"Connection to {url} failed."):
-                # Act
-                await self.bot._validate_external_url(url)
+        # Act
+        with self.assertRaises(ClientError):
+            await self.bot._search(url, "", "")
 
-            # Assert
-            self.assertEqual(
-                ['ERROR:testlogger:Connection failed during checks of image from external URL: '],
-                logger.output
-            )
+        # Assert
+        self.bot._download_external_media.assert_not_called()
+        self.assertEqual(self.bot.fetch_selector.stats("example.com"), None)
 
-    async def test_validate_external_url_when_wrong_content_type_then_raise_exception(self):
+    async def test_fetch_strategy_selector_when_host_unknown_then_try_both(self):
         # Arrange
-        url = "https://example.com/image.png"
-        content_types = [("text/html", "text/html"), (None, "unknown")]
-        for content_type in content_types:
-            with self.subTest(content_type=content_type):
-                self.bot.http.head = AsyncMock(
-                    return_value=await self.create_resp(
-                        200,
-                        content_type=content_type[0],
-                        content_length=self.bot.size_limit
-                    )
-                )
-                with self.assertLogs(self.bot.log, level='ERROR') as logger:
-                    # Assert
-                    with self.assertRaisesRegex(ValueError, ""):
-                        # Act
-                        await self.bot._validate_external_url(url)
+        selector = FetchStrategySelector(max_hosts=16, ttl=60)
 
-                    # Assert
-                    self.assertEqual(
-                        [f'ERROR:testlogger:External file type not supported: {content_type[1]}'],
-                        logger.output
-                    )
+        # Act
+        first = selector.choose("example.com")
+        for _ in range(selector.min_samples):
+            selector.record("example.com", REMOTE, 1.0, False)
+        second = selector.choose("example.com")
 
-    async def test_validate_external_url_when_wrong_size_then_raise_exception(self):
+        # Assert
+        self.assertEqual(first, REMOTE)
+        self.assertEqual(second, LOCAL)
+
+    async def test_fetch_strategy_selector_when_sampled_then_choose_cheaper(self):
         # Arrange
-        url = "https://example.com/image.png"
-        self.bot.http.head = AsyncMock(
-            return_value=await self.create_resp(
-                200,
-                content_type="image/png",
-                content_length=self.bot.size_limit + 1
-            )
+        selector = FetchStrategySelector(max_hosts=16, ttl=60)
+        cases = (
+            ((1.0, False), (3.0, False), REMOTE),
+            ((3.0, False), (1.0, False), LOCAL),
+            ((1.0, True), (3.0, False), LOCAL)
         )
+        for remote, local, expected_result in cases:
+            with self.subTest(remote=remote, local=local):
+                host = f"{remote}{local}.example.com"
+                for _ in range(selector.min_samples):
+                    selector.record(host, REMOTE, *remote)
+                    selector.record(host, LOCAL, *local)
 
-        with self.assertLogs(self.bot.log, level='ERROR') as logger:
-            # Assert
-            with self.assertRaisesRegex(ValueError, "External image size too big"):
                 # Act
-                await self.bot._validate_external_url(url)
+                result = selector.choose(host)
 
-            # Assert
-            self.assertEqual(
-                ['ERROR:testlogger:External image size too big: 25 000 001'],
-                logger.output
-            )
+                # Assert
+                self.assertEqual(result, expected_result)
 
     async def test_get_matrix_media_when_successful_then_return_byte_data(self):
         # Arrange
@@ -374,18 +2340,71 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
                 logger.output
             )
 
-    async def test_trace_by_media_when_request_is_successful_then_return_json(self):
+    async def test_get_matrix_media_when_media_cached_on_disk_then_skip_download(self):
+        # Arrange
+        url = "mxc://matrix.example.com/image.png"
+        bytes_data = b"image_data"
+        self.bot.media_cache = MediaDiskCache(self.enterContext(tempfile.TemporaryDirectory()), 100)
+        self.bot.client.download_media = AsyncMock(return_value=bytes_data)
+        await self.bot._get_matrix_media(url)
+
+        # Act
+        data = await self.bot._get_matrix_media(url)
+
+        # Assert
+        self.assertEqual(data, bytes_data)
+        self.bot.client.download_media.assert_called_once()
+
+    async def test_media_disk_cache_when_full_then_evict_least_recently_used(self):
+        # Arrange
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        cache = MediaDiskCache(directory, 10)
+        await cache.put("mxc://example.com/a", b"aaaa")
+        await asyncio.sleep(0.01)
+        await cache.put("mxc://example.com/b", b"bbbb")
+        await asyncio.sleep(0.01)
+        await cache.get("mxc://example.com/a")
+
+        # Act
+        await cache.put("mxc://example.com/c", b"cccc")
+
+        # Assert
+        self.assertEqual(await cache.get("mxc://example.com/a"), b"aaaa")
+        self.assertEqual(await cache.get("mxc://example.com/b"), None)
+        self.assertEqual(await cache.get("mxc://example.com/c"), b"cccc")
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(len(os.listdir(directory)), 2)
+        self.assertEqual(MediaDiskCache(directory, 10).size, 8)
+
+    async def test_media_disk_cache_when_directory_has_other_files_then_keep_them(self):
+        # Arrange
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        with open(os.path.join(directory, "important_notes.txt"), "wb") as file:
+            file.write(b"notes" * 10)
+
+        # Act
+        cache = MediaDiskCache(directory, 10)
+        await cache.put("mxc://example.com/a", b"aaaa")
+        await cache.put("mxc://example.com/b", b"bbbbbbbb")
+
+        # Assert
+        self.assertEqual(cache.size, 8)
+        self.assertTrue(os.path.exists(os.path.join(directory, "important_notes.txt")))
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+    async def test_trace_by_media_when_request_is_successful_then_return_search_response(self):
         # Arrange
         bytes_data = b"image_data"
         content_type = "image/png"
-        json_data = {'test': 1}
-        self.bot.http.post = AsyncMock(return_value=await self.create_resp(200, json=json_data))
+        self.bot.http.post = AsyncMock(
+            return_value=await self.create_resp(200, json=self.api_response_data)
+        )
 
         # Act
-        json_response = await self.bot._trace_by_media(bytes_data, content_type)
+        response = await self.bot._trace_by_media(bytes_data, content_type)
 
         # Assert
-        self.assertEqual(json_response, json_data)
+        self.assertEqual(response, SearchResponse.from_json(self.api_response_data))
 
     async def test_trace_by_media_when_aiohttp_error_then_raise_exception(self):
         # Arrange
@@ -410,7 +2429,9 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.bot._get_max_results = MagicMock(return_value=5)
 
         # Act
-        message_data = await self.bot._prepare_message_content(self.api_response_data)
+        message_data = self.bot._prepare_message_content(
+            SearchResponse.from_json(self.api_response_data)
+        )
 
         # Assert
         self.assertEqual(message_data.video_url, self.api_response_data["result"][0]["video"])
@@ -426,7 +2447,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
 
         with self.assertLogs(self.bot.log, level='ERROR') as logger:
             # Act
-            message_data = await self.bot._prepare_message_content(data)
+            message_data = self.bot._prepare_message_content(SearchResponse.from_json(data))
 
             # Assert
             self.assertEqual(['ERROR:testlogger:File not found'], logger.output)
@@ -444,7 +2465,7 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.bot._get_max_results = MagicMock(return_value=5)
 
         # Act
-        message_data = await self.bot._prepare_message_content(data)
+        message_data = self.bot._prepare_message_content(SearchResponse.from_json(data))
 
         # Assert
         self.assertEqual(message_data.video_url, "")
@@ -458,75 +2479,78 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         # video/mp4"
         return "video_url"
 
-    async def test_get_link(self):
+    async def test_render_link(self):
         # Arrange
         data = (
             (
-                "<a href=\"https://html.example.com\">Example</a>",
-                "https://html.example.com",
-                "Example",
-                True
+                (
+                    "<a href=\"https://example.com\">Example</a>",
+                    "[Example](https://example.com)"
+                ),
+                "https://example.com",
+                "Example"
             ),
             (
-                "[Example](https://md.example.com)",
-                "https://md.example.com",
-                "Example",
-                False
+                (
+                    "<a href=\"https://example.com?a=1&amp;b=2\">&lt;b&gt;Ex_ample&lt;/b&gt;</a>",
+                    "[<b>Ex\\_ample</b>](https://example.com?a=1&b=2)"
+                ),
+                "https://example.com?a=1&b=2",
+                "<b>Ex_ample</b>"
             )
         )
 
         for elem in data:
             with self.subTest():
                 # Act
-                res = await self.bot._get_link(elem[1], elem[2], elem[3])
+                res = render_link(elem[1], elem[2])
 
             # Assert
             self.assertEqual(res, elem[0])
 
-    async def test_get_titles(self):
+    async def test_render_titles(self):
         # Arrange
         data = (
             (
-                "<a href=\"https://anilist.co/anime/177385\"><h3>Ikoku Nikki</h3></a>"
-                "<blockquote><b>English title:</b> Journal with Witch</blockquote>",
+                (
+                    "<a href=\"https://anilist.co/anime/177385\"><h3>Ikoku Nikki</h3></a>"
+                    "<blockquote><b>English title:</b> Journal with Witch</blockquote>",
+                    "> ### [Ikoku Nikki](https://anilist.co/anime/177385)  \n>  \n"
+                    "> > **English title:** Journal with Witch  \n>  \n"
+                ),
                 "Ikoku Nikki",
                 "Journal with Witch",
-                177385,
-                True
+                177385
             ),
             (
-                "<a href=\"https://anilist.co/anime/177385\"><h3>Ikoku Nikki</h3></a>",
+                (
+                    "<a href=\"https://anilist.co/anime/177385\"><h3>Ikoku Nikki</h3></a>",
+                    "> ### [Ikoku Nikki](https://anilist.co/anime/177385)  \n>  \n"
+                ),
                 "Ikoku Nikki",
                 "",
-                177385,
-                True
-            ),
-            (
-                "> ### [Ikoku Nikki](https://anilist.co/anime/177385)  \n>  \n"
-                "> > **English title:** Journal with Witch  \n>  \n",
-                "Ikoku Nikki",
-                "Journal with Witch",
-                177385,
-                False
+                177385
             ),
             (
-                "> ### [Ikoku Nikki](https://anilist.co/anime/177385)  \n>  \n",
-                "Ikoku Nikki",
-                "",
-                177385,
-                False
-            ),
+                (
+                    "<a href=\"https://anilist.co/anime/1\"><h3>[Tom] &amp; Jerry</h3></a>",
+                    "> ### [\\[Tom\\] & Jerry](https://anilist.co/anime/1)  \n>  \n"
+                ),
+                "[Tom] & Jerry",
+                None,
+                1
+            )
         )
 
         for elem in data:
             with self.subTest():
                 # Act
-                res = await self.bot._get_titles(elem[1], elem[2], elem[3], elem[4])
+                res = render_titles(elem[1], elem[2], elem[3])
 
             # Assert
             self.assertEqual(res, elem[0])
 
-    async def test_get_al_mal_links(self):
+    async def test_render_al_mal_links(self):
         # Arrange
         al_id = 177385
         mal_id = 58788
@@ -534,87 +2558,81 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         mal_url = f"https://myanimelist.net/anime/{mal_id}"
         data = (
             (
-                "<blockquote>"
-                f"<a href=\"{al_url}\">AniList</a>, "
-                f"<a href=\"{mal_url}\">MyAnimeList</a>"
-                "</blockquote>",
-                al_id,
-                mal_id,
-                True
-            ),
-            (
-                "",
-                al_id,
-                None,
-                True
-            ),
-            (
-                f"> > [AniList]({al_url}), "
-                f"[MyAnimeList]({mal_url})  \n>  \n",
+                (
+                    "<blockquote>"
+                    f"<a href=\"{al_url}\">AniList</a>, "
+                    f"<a href=\"{mal_url}\">MyAnimeList</a>"
+                    "</blockquote>",
+                    f"> > [AniList]({al_url}), "
+                    f"[MyAnimeList]({mal_url})  \n>  \n"
+                ),
                 al_id,
-                mal_id,
-                False
+                mal_id
             ),
             (
-                "",
+                ("", ""),
                 al_id,
-                None,
-                False
+                None
             )
         )
 
         for elem in data:
             with self.subTest():
                 # Act
-                res = await self.bot._get_al_mal_links(elem[1], elem[2], elem[3])
+                res = render_al_mal_links(elem[1], elem[2])
 
             # Assert
             self.assertEqual(res, elem[0])
 
-    async def test_get_alternative_titles(self):
+    async def test_render_alternative_titles(self):
         # Arrange
-        synonyms = ["a", "b", "c"]
         data = (
             (
-                "<blockquote>"
-                "<b>Alternative titles:</b> a, b, c"
-                "</blockquote>",
-                synonyms,
-                True
-            ),
-            (
-                "",
-                None,
-                True
+                (
+                    "<blockquote>"
+                    "<b>Alternative titles:</b> a, b, c"
+                    "</blockquote>",
+                    "> > **Alternative titles:** a, b, c  \n>  \n"
+                ),
+                ["a", "b", "c"]
             ),
             (
-                "> > **Alternative titles:** a, b, c  \n>  \n",
-                synonyms,
-                False
+                (
+                    "<blockquote>"
+                    "<b>Alternative titles:</b> &lt;i&gt;a&lt;/i&gt;, *b*"
+                    "</blockquote>",
+                    "> > **Alternative titles:** <i>a</i>, \\*b\\*  \n>  \n"
+                ),
+                ["<i>a</i>", "*b*"]
             ),
             (
-                "",
-                None,
-                False
+                ("", ""),
+                None
             )
         )
 
         for elem in data:
             with self.subTest():
                 # Act
-                res = await self.bot._get_alternative_titles(elem[1], elem[2])
+                res = render_alternative_titles(elem[1])
 
             # Assert
             self.assertEqual(res, elem[0])
 
-    async def test_get_match_data(self):
+    async def test_render_match_data(self):
         # Arrange
         data = (
             (
-                "<blockquote><b>Similarity:</b> 99.61%</blockquote>"
-                "<blockquote><b>Filename:</b> filename.mp4</blockquote>"
-                "<blockquote><b>Episode:</b> 1</blockquote>"
-                "<blockquote><b>Time:</b> 00:04:41 - 00:04:52</blockquote>",
+                (
+                    "<blockquote><b>Similarity:</b> 99.61%</blockquote>"
+                    "<blockquote><b>Filename:</b> filename.mp4</blockquote>"
+                    "<blockquote><b>Episode:</b> 1</blockquote>"
+                    "<blockquote><b>Time:</b> 00:04:41 - 00:04:52</blockquote>",
+                    "> > **Similarity:** 99.61%  \n>  \n"
+                    "> > **Filename:** filename.mp4  \n>  \n"
+                    "> > **Episode:** 1  \n>  \n"
+                    "> > **Time:** 00:04:41 - 00:04:52  \n>  \n"
+                ),
                 {
                     "filename": "filename.mp4",
                     "episode": 1,
@@ -623,109 +2641,55 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
                     "to": 292.6674,
                     "duration": 1439.7716,
                     "similarity": 0.9961237365124272
-                },
-                True
+                }
             ),
             (
-                "<blockquote><b>Similarity:</b> 99.61%</blockquote>"
-                "<blockquote><b>Filename:</b> filename.mp4</blockquote>"
-                "<blockquote><b>Episode:</b> -</blockquote>"
-                "<blockquote><b>Time:</b> 00:04:41 - 00:04:52</blockquote>",
+                (
+                    "<blockquote><b>Similarity:</b> 99.61%</blockquote>"
+                    "<blockquote><b>Filename:</b> [Group] file_name &lt;1&gt;.mp4</blockquote>"
+                    "<blockquote><b>Episode:</b> -</blockquote>"
+                    "<blockquote><b>Time:</b> 01:00:00 - 01:00:01</blockquote>",
+                    "> > **Similarity:** 99.61%  \n>  \n"
+                    "> > **Filename:** \\[Group\\] file\\_name <1>.mp4  \n>  \n"
+                    "> > **Episode:** -  \n>  \n"
+                    "> > **Time:** 01:00:00 - 01:00:01  \n>  \n"
+                ),
                 {
-                    "filename": "filename.mp4",
+                    "filename": "[Group] file_name <1>.mp4",
                     "episode": None,
-                    "from": 281.9483,
-                    "at": 289.7061,
-                    "to": 292.6674,
-                    "duration": 1439.7716,
-                    "similarity": 0.9961237365124272
-                },
-                True
-            ),
-            (
-                "> > **Similarity:** 99.61%  \n>  \n"
-                "> > **Filename:** filename.mp4  \n>  \n"
-                "> > **Episode:** 1  \n>  \n"
-                "> > **Time:** 00:04:41 - 00:04:52  \n>  \n",
-                {
-                    "filename": "filename.mp4",
-                    "episode": 1,
-                    "from": 281.9483,
-                    "at": 289.7061,
-                    "to": 292.6674,
-                    "duration": 1439.7716,
+                    "from": 3600.0,
+                    "at": 3600.5,
+                    "to": 3601.9,
+                    "duration": 7200.0,
                     "similarity": 0.9961237365124272
-                },
-                False
+                }
             )
         )
 
         for elem in data:
             with self.subTest():
                 # Act
-                res = await self.bot._get_match_data(elem[1], elem[2])
+                res = render_match_data(
+                    TraceResult.from_json({**self.api_response_data["result"][0], **elem[1]})
+                )
 
             # Assert
             self.assertEqual(res, elem[0])
 
-    async def test_get_other_result(self):
+    async def test_render_other_result(self):
         # Arrange
         data = (
             (
-                "<blockquote>"
-                "2. <a href=\"https://anilist.co/anime/21034\">Is the Order a Rabbit?? Season 2</a>"
-                " (<a href=\"https://myanimelist.net/anime/29787\">MAL</a>)"
-                " <b>S:</b> 99.61%, <b>Ep:</b> 1, <b>T:</b> 00:04:41 - 00:04:52"
-                "</blockquote>",
-                {
-                    "anilist": {
-                        "id": 21034,
-                        "idMal": 29787,
-                        "title": {
-                            "romaji": "Gochuumon wa Usagi desu ka??",
-                            "english": "Is the Order a Rabbit?? Season 2"
-                        }
-                    },
-                    "filename": "filename.mp4",
-                    "episode": 1,
-                    "from": 281.9483,
-                    "at": 289.7061,
-                    "to": 292.6674,
-                    "duration": 1439.7716,
-                    "similarity": 0.9961237365124272
-                },
-                2,
-                True
-            ),
-            (
-                "<blockquote>"
-                "3. <a href=\"https://anilist.co/anime/21034\">Gochuumon wa Usagi desu ka??</a>"
-                " <b>S:</b> 99.61%, <b>T:</b> 00:04:41 - 00:04:52"
-                "</blockquote>",
-                {
-                    "anilist": {
-                        "id": 21034,
-                        "idMal": None,
-                        "title": {
-                            "romaji": "Gochuumon wa Usagi desu ka??",
-                            "english": None
-                        }
-                    },
-                    "filename": "filename.mp4",
-                    "episode": None,
-                    "from": 281.9483,
-                    "at": 289.7061,
-                    "to": 292.6674,
-                    "duration": 1439.7716,
-                    "similarity": 0.9961237365124272
-                },
-                3,
-                True
-            ),
-            (
-                "> > 1. [Is the Order a Rabbit?? Season 2](https://anilist.co/anime/21034)"
-                " ([MAL](https://myanimelist.net/anime/29787))"
-                " **S:** 99.61%, **Ep:** 1, **T:** 00:04:41 - 00:04:52  \n>  \n",
+                (
+                    "<blockquote>"
+                    "2. <a href=\"https://anilist.co/anime/21034\">Is the Order a Rabbit?? Season 2</a>"
+                    " (<a href=\"https://myanimelist.net/anime/29787\">MAL</a>)"
+                    " <b>S:</b> 99.61%, <b>Ep:</b> 1, <b>T:</b> 00:04:41 - 00:04:52"
+                    "</blockquote>",
+                    "> > 2. [Is the Order a Rabbit?? Season 2](https://anilist.co/anime/21034)"
+                    " ([MAL](https://myanimelist.net/anime/29787))"
+                    " **S:** 99.61%, **Ep:** 1, **T:** 00:04:41 - 00:04:52  \n>  \n"
+                ),
                 {
                     "anilist": {
                         "id": 21034,
@@ -743,12 +2707,17 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
                     "duration": 1439.7716,
                     "similarity": 0.9961237365124272
                 },
-                1,
-                False
+                2
             ),
             (
-                "> > 4. [Gochuumon wa Usagi desu ka??](https://anilist.co/anime/21034)"
-                " **S:** 99.61%, **T:** 00:04:41 - 00:04:52  \n>  \n",
+                (
+                    "<blockquote>"
+                    "3. <a href=\"https://anilist.co/anime/21034\">Gochuumon wa Usagi desu ka??</a>"
+                    " <b>S:</b> 99.61%, <b>T:</b> 00:04:41 - 00:04:52"
+                    "</blockquote>",
+                    "> > 3. [Gochuumon wa Usagi desu ka??](https://anilist.co/anime/21034)"
+                    " **S:** 99.61%, **T:** 00:04:41 - 00:04:52  \n>  \n"
+                ),
                 {
                     "anilist": {
                         "id": 21034,
@@ -766,18 +2735,247 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
                     "duration": 1439.7716,
                     "similarity": 0.9961237365124272
                 },
-                4,
-                False
+                3
             )
         )
 
-        for elem in data:
-            with self.subTest():
+        for elem in data:
+            with self.subTest():
+                # Act
+                res = render_other_result(
+                    TraceResult.from_json({**self.api_response_data["result"][0], **elem[1]}),
+                    elem[2]
+                )
+
+            # Assert
+            self.assertEqual(res, elem[0])
+
+    async def test_render_results(self):
+        # Arrange
+        result = TraceResult.from_json(self.api_response_data["result"][0])
+        results = (result, result, result)
+        data = (
+            (5, 2),
+            (2, 1),
+            (1, 0)
+        )
+
+        for max_results, expected_others in data:
+            with self.subTest(max_results=max_results):
+                # Act
+                html, body = render_results(results, max_results)
+
+                # Assert
+                self.assertTrue(html.startswith("<blockquote><a href=\"https://anilist.co/anime/99939\">"))
+                self.assertTrue(html.endswith("<p><b><sub>Results from trace.moe</sub></b></p></blockquote>"))
+                self.assertTrue(body.startswith("> ### [Nekopara OVA](https://anilist.co/anime/99939)"))
+                self.assertTrue(body.endswith("> **Results from trace.moe**"))
+                self.assertEqual(html.count("<details>"), 1 if expected_others else 0)
+                self.assertEqual(body.count("**Other results:**"), 1 if expected_others else 0)
+                self.assertEqual(html.count("<b>S:</b>"), expected_others)
+                self.assertEqual(body.count("**S:**"), expected_others)
+
+    async def test_render_results_when_no_results_then_return_empty_strings(self):
+        # Act
+        html, body = render_results((), 5)
+
+        # Assert
+        self.assertEqual(html, "")
+        self.assertEqual(body, "")
+
+    async def test_render_batch(self):
+        # Arrange
+        result = SearchResponse.from_json(self.api_response_data).results[0]
+
+        # Act
+        html, body = render_batch([result, "File validation failed - *bad*"], 3)
+
+        # Assert
+        self.assertIn("1. <a href=\"https://anilist.co/anime/99939\">", html)
+        self.assertIn("<blockquote>2. File validation failed - *bad*</blockquote>", html)
+        self.assertIn("> > 2. File validation failed - \\*bad\\*  \n", body)
+        self.assertIn("3 more not traced, the limit is 2 per command.", body)
+        self.assertTrue(body.endswith("> **Results from trace.moe**"))
+
+    async def test_render_history_summary(self):
+        # Arrange
+        result = SearchResponse.from_json(self.api_response_data).results[0]
+
+        # Act
+        html, body = render_history_summary([
+            ("https://matrix.to/#/!room/$1", result),
+            ("https://matrix.to/#/!room/$2", "File validation failed - *bad*")
+        ])
+
+        # Assert
+        self.assertIn(
+            "<a href=\"https://matrix.to/#/!room/$1\">1.</a> Nekopara OVA, 00:01:37, 94.40%",
+            html
+        )
+        self.assertIn("> > [2.](https://matrix.to/#/!room/$2) File validation failed - \\*bad\\*", body)
+
+    def create_anilist_index(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        index = AnilistIndex(os.path.join(directory.name, "anilist.db"), read_only=False)
+        self.addCleanup(index.close)
+        return index, directory.name
+
+    async def test_create_anilist_index_when_missing_or_empty_then_request_titles_from_api(self):
+        # Arrange
+        _, directory = self.create_anilist_index()
+        paths = (os.path.join(directory, "anilist.db"), os.path.join(directory, "missing.db"))
+        for path in paths:
+            with self.subTest(path=path):
+                self.bot.config = {"anilist_index": path}
+
+                with self.assertLogs(self.bot.log, level="ERROR"):
+                    # Act
+                    result = self.bot._create_anilist_index()
+
+                # Assert
+                self.assertIsNone(result)
+                self.assertFalse(os.path.exists(os.path.join(directory, "missing.db")))
+
+    async def test_create_anilist_index_when_filled_then_open_it_read_only(self):
+        # Arrange
+        index, directory = self.create_anilist_index()
+        index.import_entries([self.api_response_data["result"][0]["anilist"]])
+        self.bot.config = {"anilist_index": os.path.join(directory, "anilist.db")}
+
+        # Act
+        result = self.bot._create_anilist_index()
+        self.addCleanup(result.close)
+
+        # Assert
+        self.assertEqual(await result.find("Nekopara OVA"), 99939)
+        with self.assertRaises(sqlite3.OperationalError):
+            result.import_entries([dict(self.api_response_data["result"][0]["anilist"], id=1)])
+
+    async def test_anilist_index_when_entries_imported_then_return_metadata(self):
+        # Arrange
+        index, _ = self.create_anilist_index()
+        entry = self.api_response_data["result"][0]["anilist"]
+
+        # Act
+        imported = index.import_entries([entry, {"id": "x"}, 5, dict(entry, id=1, title={})])
+        result = await index.get_many([99939, 99939, 12345])
+
+        # Assert
+        self.assertEqual(imported, 1)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(list(result), [99939])
+        self.assertEqual(result[99939].title_romaji, "Nekopara OVA")
+        self.assertEqual(result[99939].id_mal, 34658)
+        self.assertEqual(result[99939].synonyms, ("Neko Para OVA",))
+
+    async def test_anilist_index_find_when_title_matches_then_return_id(self):
+        # Arrange
+        index, _ = self.create_anilist_index()
+        index.import_entries([
+            {"id": 1, "title": {"romaji": "Nekopara OVA"}, "synonyms": ["Neko Para OVA"]},
+            {"id": 2, "title": {"romaji": "Nekopara", "english": "Nekopara"}, "synonyms": []},
+            {"id": 3, "title": {"romaji": "100%"}, "synonyms": []}
+        ])
+        cases = [
+            ("nekopara", 2),
+            ("NEKOPARA OVA", 1),
+            ("neko para ova", 1),
+            ("Neko Para", None),
+            ("Nekopara O", 1),
+            ("100", 3),
+            ("%", None),
+            ("Unknown", None)
+        ]
+
+        for title, expected in cases:
+            with self.subTest(title=title):
                 # Act
-                res = await self.bot._get_other_result(elem[1], elem[2], elem[3])
+                result = await index.find(title)
 
-            # Assert
-            self.assertEqual(res, elem[0])
+                # Assert
+                self.assertEqual(result, expected)
+
+    async def test_read_entries_when_different_formats_then_return_media_objects(self):
+        # Arrange
+        _, directory = self.create_anilist_index()
+        files = {
+            "array.json": '[{"id": 1}, {"id": 2}]',
+            "lines.jsonl": '{"id": 1}\n\n{"id": 2}\n',
+            "graphql.json": '{"data": {"Page": {"media": [{"id": 1}, {"id": 2}]}}}'
+        }
+
+        for name, text in files.items():
+            with self.subTest(name=name):
+                path = os.path.join(directory, name)
+                with open(path, "w", encoding="utf-8") as file:
+                    file.write(text)
+
+                # Act
+                result = list(read_entries(path))
+
+                # Assert
+                self.assertEqual(result, [{"id": 1}, {"id": 2}])
+
+    async def test_decode_search_response_when_bare_search_then_fill_titles_from_index(self):
+        # Arrange
+        index, _ = self.create_anilist_index()
+        index.import_entries([self.api_response_data["result"][0]["anilist"]])
+        self.bot.anilist_index = index
+        bare = dict(self.api_response_data["result"][0], anilist=99939)
+        self.api_response_data["result"] = [bare, dict(bare, anilist=12345)]
+        response = await self.create_resp(json=self.api_response_data)
+
+        # Act
+        result = await self.bot._decode_search_response(response)
+
+        # Assert
+        self.assertEqual(result.results[0].anilist.title_romaji, "Nekopara OVA")
+        self.assertEqual(result.results[0].anilist.id_mal, 34658)
+        self.assertEqual(result.results[1].anilist.title_romaji, "AniList 12345")
+        self.assertEqual(result.results[1].anilist.id, 12345)
+
+    async def test_search_response_from_json_when_correct_data_then_return_decoded_response(self):
+        # Arrange
+        data = self.api_response_data
+        data["result"][0]["episode"] = [1, 2]
+
+        # Act
+        response = SearchResponse.from_json(data)
+
+        # Assert
+        self.assertEqual(response.error, "")
+        self.assertEqual(len(response.results), 1)
+        self.assertEqual(
+            response.results[0].anilist,
+            AnilistInfo(
+                id=99939,
+                id_mal=34658,
+                title_romaji="Nekopara OVA",
+                title_english=None,
+                synonyms=("Neko Para OVA",)
+            )
+        )
+        self.assertEqual(response.results[0].episode, "1-2")
+        self.assertEqual(response.results[0].start, 97.75)
+        self.assertEqual(response.results[0].end, 98.92)
+        self.assertFalse(hasattr(response.results[0], "__dict__"))
+
+    async def test_search_response_from_json_when_malformed_data_then_raise_exception(self):
+        # Arrange
+        data = (
+            None,
+            {"result": None},
+            {"error": "", "result": [{"anilist": 1}]},
+            {"error": "", "result": [{"anilist": {"id": 1, "title": {}}}]},
+            {"error": "", "result": [{**self.api_response_data["result"][0], "from": "x"}]}
+        )
+        for elem in data:
+            with self.subTest(data=elem):
+                # Assert
+                with self.assertRaises(ValueError):
+                    # Act
+                    SearchResponse.from_json(elem)
 
     async def test_prepare_message_when_correct_data_provided_then_return_MediaMessageEventContent(self):
         # Arrange
@@ -796,6 +2994,8 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         video = b"video_data"
         self.bot._get_max_results = MagicMock(return_value=5)
         self.bot._get_mute = MagicMock(return_value=False)
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(side_effect=lambda image, kind: (image, kind, None))
         self.bot._get_video_preview = AsyncMock(return_value=(video, video_mime, duration))
         self.bot._get_preview_thumbnail = AsyncMock(return_value=(image, image_mime))
         self.bot.client.upload_media = AsyncMock(side_effect=self.get_video_image)
@@ -829,6 +3029,185 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(message_data.info.thumbnail_info.height, height)
         self.assertEqual(message_data.info.thumbnail_info.width, width)
 
+    async def test_prepare_message_when_video_has_moov_then_use_its_dimensions_and_duration(self):
+        # Arrange
+        output = io.BytesIO()
+        Image.new("RGB", (320, 180)).save(output, format="JPEG")
+        image = output.getvalue()
+        video = self.create_mp4(640, 360, 2500)
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(side_effect=lambda image, kind: (image, kind, None))
+        self.bot._get_video_preview = AsyncMock(return_value=(video, "video/mp4", 2000))
+        self.bot._get_preview_thumbnail = AsyncMock(return_value=(image, "image/jpeg"))
+        self.bot.client.upload_media = AsyncMock(side_effect=self.get_video_image)
+        msg_data = MessageData(
+            body="Body text",
+            html="HTML text",
+            video_url="https://example.com/video.mp4",
+            image_url="https://example.com/image.jpg"
+        )
+
+        # Act
+        message_data = await self.bot._prepare_message(msg_data)
+
+        # Assert
+        self.assertEqual(message_data.info.duration, 2500)
+        self.assertEqual((message_data.info.width, message_data.info.height), (640, 360))
+        self.assertEqual(
+            (message_data.info.thumbnail_info.width, message_data.info.thumbnail_info.height),
+            (320, 180)
+        )
+
+    async def test_prepare_message_when_moov_has_no_duration_then_keep_header_duration(self):
+        # Arrange
+        output = io.BytesIO()
+        Image.new("RGB", (320, 180)).save(output, format="JPEG")
+        video = self.create_mp4(640, 360, 0)
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(side_effect=lambda image, kind: (image, kind, None))
+        self.bot._get_video_preview = AsyncMock(return_value=(video, "video/mp4", 2000))
+        self.bot._get_preview_thumbnail = AsyncMock(return_value=(output.getvalue(), "image/jpeg"))
+        self.bot.client.upload_media = AsyncMock(return_value="mxc://example.com/media")
+        msg_data = MessageData(
+            body="Body text",
+            html="HTML text",
+            video_url="https://example.com/video.mp4",
+            image_url="https://example.com/image.jpg"
+        )
+
+        # Act
+        message_data = await self.bot._prepare_message(msg_data)
+
+        # Assert
+        self.assertEqual(message_data.info.duration, 2000)
+        self.assertEqual((message_data.info.width, message_data.info.height), (640, 360))
+
+    async def test_prepare_message_when_video_is_streamed_then_upload_it_chunk_by_chunk(self):
+        # Arrange
+        output = io.BytesIO()
+        Image.new("RGB", (320, 180)).save(output, format="JPEG")
+        image = output.getvalue()
+        video = self.create_mp4(640, 360, 2500) + b"\x00" * 100_000
+        response = MagicMock()
+        response.content.iter_chunked = lambda size: self.iterate(video, size)
+        stream = PreviewStream(response, len(video))
+        uploaded = []
+
+        async def upload_media(data, **kwargs):
+            if kwargs["mime_type"] == "video/mp4":
+                self.assertNotIsInstance(data, bytes)
+                uploaded.append(b"".join([chunk async for chunk in data]))
+                return "video_url"
+            return "image_url"
+
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(side_effect=lambda image, kind: (image, kind, None))
+        self.bot._get_video_preview = AsyncMock(return_value=(stream, "video/mp4", 2000))
+        self.bot._get_preview_thumbnail = AsyncMock(return_value=(image, "image/jpeg"))
+        self.bot.client.upload_media = AsyncMock(side_effect=upload_media)
+        msg_data = MessageData(
+            body="Body text",
+            html="HTML text",
+            video_url="https://example.com/video.mp4",
+            image_url="https://example.com/image.jpg"
+        )
+
+        # Act
+        message_data = await self.bot._prepare_message(msg_data)
+
+        # Assert
+        self.assertEqual(uploaded, [video])
+        self.assertEqual(message_data.url, "video_url")
+        self.assertEqual(message_data.info.size, len(video))
+        self.assertEqual(message_data.info.duration, 2500)
+        self.assertEqual((message_data.info.width, message_data.info.height), (640, 360))
+        self.assertEqual(len(stream.head), PreviewStream.head_size)
+        response.release.assert_called_once()
+
+    async def test_prepare_message_when_thumbnail_processing_fails_then_video_is_not_opened(self):
+        # Arrange
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._get_preview_thumbnail = AsyncMock(return_value=(b"image", "image/jpeg"))
+        self.bot._optimize_thumbnail = AsyncMock(side_effect=RuntimeError("pool shut down"))
+        self.bot._get_video_preview = AsyncMock()
+        msg_data = MessageData(
+            body="Body text",
+            html="HTML text",
+            video_url="https://example.com/video.mp4",
+            image_url="https://example.com/image.jpg"
+        )
+
+        # Act
+        with self.assertRaises(RuntimeError):
+            await self.bot._prepare_message(msg_data)
+
+        # Assert
+        self.bot._get_video_preview.assert_not_called()
+        self.assertEqual(self.bot.load.bytes, 0)
+
+    async def test_prepare_message_when_thumbnail_shrunk_then_video_keeps_frame_size(self):
+        # Arrange
+        original = io.BytesIO()
+        Image.new("RGB", (1280, 720)).save(original, format="JPEG")
+        shrunk = io.BytesIO()
+        Image.new("RGB", (320, 180)).save(shrunk, format="WEBP")
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(
+            return_value=(shrunk.getvalue(), "image/webp", None)
+        )
+        self.bot._get_video_preview = AsyncMock(return_value=(b"video", "video/mp4", 2000))
+        self.bot._get_preview_thumbnail = AsyncMock(
+            return_value=(original.getvalue(), "image/jpeg")
+        )
+        self.bot.client.upload_media = AsyncMock(return_value="mxc://example.com/media")
+        msg_data = MessageData(
+            body="Body text",
+            html="HTML text",
+            video_url="https://example.com/video.mp4",
+            image_url="https://example.com/image.jpg"
+        )
+
+        # Act
+        message_data = await self.bot._prepare_message(msg_data)
+
+        # Assert
+        self.assertEqual((message_data.info.width, message_data.info.height), (1280, 720))
+        thumbnail_info = message_data.info.thumbnail_info
+        self.assertEqual((thumbnail_info.width, thumbnail_info.height), (320, 180))
+
+    async def test_prepare_message_when_thumbnail_has_blurhash_then_add_it_to_info(self):
+        # Arrange
+        output = io.BytesIO()
+        Image.new("RGB", (320, 180)).save(output, format="JPEG")
+        image = output.getvalue()
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(
+            return_value=(image, "image/webp", "LKO2?U%2Tw=w]~RBVZRi};RPxuwH")
+        )
+        self.bot._get_video_preview = AsyncMock(return_value=(b"video", "video/mp4", 2000))
+        self.bot._get_preview_thumbnail = AsyncMock(return_value=(b"thumbnail", "image/jpeg"))
+        self.bot.client.upload_media = AsyncMock(return_value="mxc://example.com/media")
+        msg_data = MessageData(
+            body="Body text",
+            html="HTML text",
+            video_url="https://example.com/video.mp4",
+            image_url="https://example.com/image.jpg"
+        )
+
+        # Act
+        message_data = await self.bot._prepare_message(msg_data)
+
+        # Assert
+        info = message_data.info.serialize()
+        self.assertEqual(info[BLURHASH_KEY], "LKO2?U%2Tw=w]~RBVZRi};RPxuwH")
+        self.assertEqual(info["thumbnail_info"][BLURHASH_KEY], "LKO2?U%2Tw=w]~RBVZRi};RPxuwH")
+        self.assertEqual(info["thumbnail_info"]["mimetype"], "image/webp")
+        self.assertEqual(info["thumbnail_info"]["size"], len(image))
+
+    async def iterate(self, data, size):
+        for i in range(0, len(data), size):
+            yield data[i:i + size]
+
     async def test_prepare_message_when_cannot_detect_image_dimensions_then_return_MediaMessageEventContent_with_default_size(self):
         # Arrange
         image = "image"
@@ -838,6 +3217,8 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         video = b"video_data"
         self.bot._get_max_results = MagicMock(return_value=5)
         self.bot._get_mute = MagicMock(return_value=False)
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(side_effect=lambda image, kind: (image, kind, None))
         self.bot._get_video_preview = AsyncMock(return_value=(video, video_mime, duration))
         self.bot._get_preview_thumbnail = AsyncMock(return_value=(image, image_mime))
         self.bot.client.upload_media = AsyncMock(side_effect=self.get_video_image)
@@ -914,6 +3295,8 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         video = b"video_data"
         self.bot._get_max_results = MagicMock(return_value=5)
         self.bot._get_mute = MagicMock(return_value=False)
+        self.bot._choose_preview_size = MagicMock(return_value="m")
+        self.bot._optimize_thumbnail = AsyncMock(side_effect=lambda image, kind: (image, kind, None))
         self.bot._get_video_preview = AsyncMock(return_value=(video, video_mime, duration))
         self.bot._get_preview_thumbnail = AsyncMock(return_value=(image, image_mime))
         self.bot.client.upload_media = AsyncMock(side_effect=MatrixResponseError(""))
@@ -998,6 +3381,25 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(video_type, content_type)
         self.assertEqual(video_duration, 50000)
 
+    async def test_get_video_preview_when_length_is_known_then_return_stream(self):
+        # Arrange
+        self.bot._get_preview_size = MagicMock(return_value="l")
+        self.bot._get_mute = MagicMock(return_value=False)
+        response = await self.create_resp(200, content_type="video/mp4", content_length=1000)
+        self.bot.http.get = AsyncMock(return_value=response)
+
+        # Act
+        video, video_type, video_duration = await self.bot._get_video_preview(
+            "https://example.com/video.mp4"
+        )
+
+        # Assert
+        self.assertIsInstance(video, PreviewStream)
+        self.assertEqual(len(video), 1000)
+        self.assertEqual(video_type, "video/mp4")
+        self.assertEqual(video_duration, 50000)
+        response.read.assert_not_called()
+
     async def test_get_video_preview_when_exception_then_return_empty_values(self):
         # Arrange
         self.bot._get_preview_size = MagicMock(return_value="l")
@@ -1019,6 +3421,93 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
             self.assertEqual(video_type, "")
             self.assertEqual(video_duration, 0)
 
+    async def test_hedge_policy_when_enough_samples_and_budget_then_hedge_after_p90(self):
+        # Arrange
+        policy = HedgePolicy(ratio=0.5)
+
+        # Act
+        early = policy.delay()
+        for latency in range(1, 21):
+            policy.record(latency / 10)
+        delay = policy.delay()
+        allowed = policy.take()
+        denied = policy.take()
+
+        # Assert
+        self.assertEqual(early, None)
+        self.assertEqual(delay, 1.8)
+        self.assertTrue(allowed)
+        self.assertFalse(denied)
+        self.assertEqual((policy.requests, policy.hedged), (2, 1))
+
+    async def test_get_preview_when_first_request_is_slow_then_use_hedged_one(self):
+        # Arrange
+        policy = self.bot.hedge_policies["video"] = HedgePolicy(ratio=1.0)
+        for _ in range(20):
+            policy.record(0.01)
+        slow = MagicMock()
+        fast = MagicMock()
+
+        async def get(*args, **kwargs):
+            if self.bot.http.get.call_count == 1:
+                await asyncio.sleep(1)
+                return slow
+            return fast
+
+        self.bot.http.get = AsyncMock(side_effect=get)
+
+        # Act
+        result = await self.bot._get_preview(
+            "https://example.com/video.mp4",
+            {"size": "m"},
+            "video"
+        )
+
+        # Assert
+        self.assertIs(result, fast)
+        self.assertEqual(self.bot.http.get.call_count, 2)
+        self.assertEqual(policy.hedge_wins, 1)
+        # The first request's time is recorded, not the faster hedged one's
+        self.assertGreaterEqual(policy._latencies[-1], 0.01)
+
+    async def test_get_preview_when_no_budget_then_wait_for_first_request(self):
+        # Arrange
+        policy = self.bot.hedge_policies["video"] = HedgePolicy(ratio=0.1)
+        for _ in range(20):
+            policy.record(0.001)
+        response = MagicMock()
+
+        async def get(*args, **kwargs):
+            await asyncio.sleep(0.02)
+            return response
+
+        self.bot.http.get = AsyncMock(side_effect=get)
+
+        # Act
+        result = await self.bot._get_preview(
+            "https://example.com/video.mp4",
+            {"size": "m"},
+            "video"
+        )
+
+        # Assert
+        self.assertIs(result, response)
+        self.bot.http.get.assert_called_once()
+        self.assertEqual(policy.hedged, 0)
+
+    async def test_get_preview_when_videos_are_slow_then_thumbnails_keep_own_percentile(self):
+        # Arrange
+        for _ in range(20):
+            self.bot.hedge_policies["video"].record(5)
+            self.bot.hedge_policies["image"].record(0.1)
+
+        # Act
+        video_delay = self.bot.hedge_policies["video"].delay()
+        image_delay = self.bot.hedge_policies["image"].delay()
+
+        # Assert
+        self.assertEqual((video_delay, image_delay), (5, 0.1))
+
     async def test_get_preview_thumbnail_when_success_then_return_valid_data(self):
         # Arrange
         self.bot._get_preview_size = MagicMock(return_value="l")
@@ -1060,14 +3549,36 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
 
     async def test_get_quota_when_success_then_return_valid_data(self):
         # Arrange
-        json = {"test": 1}
+        json = {
+            "id": "127.0.0.1",
+            "priority": 0,
+            "concurrency": 1,
+            "quota": 1000,
+            "quotaUsed": 43
+        }
         self.bot.http.get = AsyncMock(return_value=await self.create_resp(200, json=json))
 
         # Act
         result = await self.bot._get_quota()
 
         # Assert
-        self.assertEqual(result, json)
+        self.assertEqual(result, QuotaInfo(priority=0, concurrency=1, quota=1000, quota_used=43))
+
+    async def test_get_quota_when_response_is_malformed_then_return_None(self):
+        # Arrange
+        self.bot.http.get = AsyncMock(return_value=await self.create_resp(200, json={"test": 1}))
+
+        with self.assertLogs(self.bot.log, level='ERROR') as logger:
+            # Act
+            result = await self.bot._get_quota()
+
+            # Assert
+            self.assertEqual(
+                ["ERROR:testlogger:Invalid response from trace.moe API: "
+                 "Malformed quota response: KeyError('priority')"],
+                logger.output
+            )
+            self.assertEqual(result, None)
 
     async def test_get_quota_when_exception_then_return_None(self):
         # Arrange
@@ -1086,13 +3597,8 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
 
     async def test_prepare_message_quota_return_TextMessageEventContent(self):
         # Arrange
-        data = {
-          "id": "127.0.0.1",
-          "priority": 0,
-          "concurrency": 1,
-          "quota": 1000,
-          "quotaUsed": 43
-        }
+        data = QuotaState(priority=0, concurrency=1, quota=1000, quota_used=43)
+
         # Act
         result = await self.bot._prepare_message_quota(data)
 
@@ -1100,6 +3606,69 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
         self.assertIsInstance(result, TextMessageEventContent)
         self.assertEqual(result.msgtype, MessageType.NOTICE)
 
+    async def test_get_quota_state_when_state_is_fresh_then_skip_api(self):
+        # Arrange
+        self.bot.config = {"quota_ttl": 300}
+        self.bot.quota.update(QuotaInfo(priority=0, concurrency=1, quota=1000, quota_used=43))
+        self.bot._get_quota = AsyncMock()
+
+        # Act
+        result = await self.bot._get_quota_state()
+
+        # Assert
+        self.assertEqual(result.quota_used, 43)
+        self.bot._get_quota.assert_not_called()
+
+    async def test_get_quota_state_when_state_is_stale_then_refresh_from_api(self):
+        # Arrange
+        self.bot.config = {"quota_ttl": 0}
+        self.bot.quota.update(QuotaInfo(priority=0, concurrency=1, quota=1000, quota_used=43))
+        self.bot._get_quota = AsyncMock(
+            return_value=QuotaInfo(priority=0, concurrency=2, quota=1000, quota_used=50)
+        )
+        await asyncio.sleep(0.01)
+
+        # Act
+        result = await self.bot._get_quota_state()
+
+        # Assert
+        self.assertEqual(result.concurrency, 2)
+        self.assertEqual(result.quota_used, 50)
+        self.bot._get_quota.assert_called_once()
+
+    async def test_get_quota_state_when_never_loaded_and_api_fails_then_return_None(self):
+        # Arrange
+        self.bot.config = {}
+        self.bot.quota = QuotaState()
+        self.bot._get_quota = AsyncMock(return_value=None)
+
+        # Act
+        result = await self.bot._get_quota_state()
+
+        # Assert
+        self.assertEqual(result, None)
+
+    async def test_trace_by_external_url_when_successful_then_update_quota_state(self):
+        # Arrange
+        self.bot.quota.update(QuotaInfo(priority=0, concurrency=1, quota=1000, quota_used=43))
+        resp = await self.create_resp(200, json=self.api_response_data)
+        resp.headers.update({
+            "x-ratelimit-limit": "60",
+            "x-ratelimit-remaining": "59",
+            "x-ratelimit-reset": "1653892574"
+        })
+        self.bot.http.get = AsyncMock(return_value=resp)
+
+        # Act
+        await self.bot._trace_by_external_url("https://example.com/image.png")
+
+        # Assert
+        self.assertEqual(self.bot.quota.quota_used, 44)
+        self.assertEqual(self.bot.quota.quota_remaining, 956)
+        self.assertEqual(self.bot.quota.rate_limit, 60)
+        self.assertEqual(self.bot.quota.rate_remaining, 59)
+        self.assertEqual(self.bot.quota.rate_reset, 1653892574)
+
     async def test_get_preview_size(self):
         # Arrange
         config = (
@@ -1120,6 +3689,43 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
                 # Assert
                 self.assertEqual(result, expected_result)
 
+    async def test_choose_preview_size_when_adaptive_then_fit_latency_budget(self):
+        # Arrange
+        self.bot.config = {"preview_size": "l", "adaptive_preview": "yes", "preview_budget": 4}
+        cases = [
+            (1_000_000, 1, "l"),
+            (1_000_000, 3, "m"),
+            (100_000, 1, "s"),
+        ]
+
+        for throughput, commands, expected in cases:
+            with self.subTest(throughput=throughput, commands=commands):
+                self.bot.preview_sizer = PreviewSizer()
+                self.bot.preview_sizer.record_transfer(throughput, 1.0)
+                self.bot.preview_sizer.record_preview("l", 1_200_000)
+
+                # Act
+                with self.bot.load.command(commands):
+                    result = self.bot._choose_preview_size()
+
+                # Assert
+                self.assertEqual(result, expected)
+
+    async def test_choose_preview_size_when_not_adaptive_or_not_measured_then_use_configured_size(self):
+        # Arrange
+        self.bot.preview_sizer.record_transfer(1000, 1.0)
+        self.bot.config = {"preview_size": "m", "adaptive_preview": "no"}
+
+        # Act
+        static = self.bot._choose_preview_size()
+        self.bot.config["adaptive_preview"] = "yes"
+        self.bot.preview_sizer = PreviewSizer()
+        not_measured = self.bot._choose_preview_size()
+
+        # Assert
+        self.assertEqual(static, "m")
+        self.assertEqual(not_measured, "m")
+
     async def test_get_mute(self):
         # Arrange
         config = (
@@ -1177,6 +3783,53 @@ class TestAnimeTraceBot(unittest.IsolatedAsyncioTestCase):
                 # Assert
                 self.assertEqual(result, expected_result)
 
+    async def test_cpu_pool_when_job_done_then_return_result(self):
+        # Act
+        result = await self.bot.cpu_pool.run(sum, [1, 2, 3])
+
+        # Assert
+        self.assertEqual(result, 6)
+        self.assertEqual(self.bot.cpu_pool.stats()["completed"], 1)
+        self.assertEqual(self.bot.cpu_pool.pending, 0)
+
+    async def test_cpu_pool_when_full_then_reject_job(self):
+        # Arrange
+        pool = CPUPool(workers=1, max_queue=1)
+        release = threading.Event()
+        jobs = [asyncio.create_task(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        # Assert
+        with self.assertRaises(PoolFullError):
+            # Act
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(*jobs)
+        self.assertEqual(pool.stats()["rejected"], 1)
+        pool.shutdown()
+
+    async def test_cpu_pool_when_queued_job_cancelled_then_drop_it(self):
+        # Arrange
+        pool = CPUPool(workers=1, max_queue=1)
+        release = threading.Event()
+        calls = []
+        running = asyncio.create_task(pool.run(release.wait))
+        queued = asyncio.create_task(pool.run(calls.append, 1))
+        await asyncio.sleep(0)
+
+        # Act
+        queued.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+        release.set()
+        await running
+
+        # Assert
+        self.assertEqual(calls, [])
+        self.assertEqual(pool.pending, 0)
+        self.assertEqual(pool.stats()["cancelled"], 1)
+        pool.shutdown()
+
     async def test_get_image_dimensions_when_correct_data_then_return_dimensions(self):
         # Arrange
         # white 5x10 png rectangle